@@ -0,0 +1,159 @@
+import json
+import os
+import sys
+import queue
+import threading
+import numpy as np
+
+#ファイル先頭のヘッダ(JSON)の領域
+HEADER_SIZE = 4096
+MAGIC = "optprop-archive-1"
+
+def record_dtype(mu, ndim, nobj):
+    """
+    1世代分のレコードの型
+    - gen : 世代数
+    - n : 個体数(mu未満の場合は残りをnanで埋める)
+    - genes : (mu, ndim)の遺伝子
+    - fitness : (mu, nobj)の評価値
+    """
+    return np.dtype([("gen", "<i8"), ("n", "<i8"),
+                     ("genes", "<f8", (mu, ndim)), ("fitness", "<f8", (mu, nobj))])
+
+class RunArchive(object):
+    """
+    各世代の個体群の遺伝子と評価値を1つのファイルに追記していくクラス
+    世代ごとに固定長のレコードを書き足すので、np.memmapでそのまま読める。
+    個体は評価値の良い順(deapのFitnessの比較順)に並べて保存し、
+    行番号がその世代の順位になる。
+    ファイルへの書き込みは別スレッドで行い、世代のループを止めない。
+
+    途中から再開した場合(resume=True)は、既に同じ形式のファイルがあれば追記する。
+    同じ世代のレコードが複数ある場合は読み出し側で最後のものを使う。
+    新しく実行した場合は既存のファイルを作り直す(前の実行の世代と混ざらないように)。
+
+    # attributes
+        - path(str)
+            保存先ファイルパス
+        - mu, ndim, nobj(int)
+            個体数、遺伝子数、評価値の数
+        - meta(dict)
+            ヘッダに保存する任意の情報(tipr, hubr, r_Rなど)
+        - resume(bool)
+            Trueなら既存のファイルに追記する
+    # method
+        - append(gen, pop)
+            1世代分の個体群を追記する
+        - close
+            書き込みが終わるのを待ってファイルを閉じる
+    """
+    def __init__(self, path, mu, ndim, nobj, meta=None, resume=False):
+        self.path = path
+        self.mu = mu
+        self.ndim = ndim
+        self.nobj = nobj
+        self.meta = meta or {}
+        self.dtype = record_dtype(mu, ndim, nobj)
+        header = {"magic": MAGIC, "mu": mu, "ndim": ndim, "nobj": nobj, "meta": self.meta}
+        if resume and os.path.exists(path) and self.__compatible(read_header(path)):
+            self.__f = open(path, mode='r+b')
+            #書きかけのレコードは切り捨てる
+            n = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+            self.__f.truncate(HEADER_SIZE + n * self.dtype.itemsize)
+            self.__f.seek(0, os.SEEK_END)
+        else:
+            self.__f = open(path, mode='wb')
+            self.__f.write(json.dumps(header).encode("ascii").ljust(HEADER_SIZE - 1) + b"\n")
+            self.__f.flush()
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__write)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __compatible(self, header):
+        return header.get("magic") == MAGIC and (header["mu"], header["ndim"], header["nobj"]) == (self.mu, self.ndim, self.nobj)
+
+    def append(self, gen, pop):
+        pop = sorted(pop, key=lambda ind: ind.fitness, reverse=True)[:self.mu]
+        #整数の列があるのでnp.fullでnanにはできない
+        rec = np.zeros(1, dtype=self.dtype)
+        rec["genes"] = np.nan
+        rec["fitness"] = np.nan
+        rec["gen"] = gen
+        rec["n"] = len(pop)
+        rec["genes"][0, :len(pop)] = [list(ind) for ind in pop]
+        rec["fitness"][0, :len(pop)] = [ind.fitness.values for ind in pop]
+        self.__queue.put(rec.tobytes())
+
+    def __write(self):
+        while True:
+            data = self.__queue.get()
+            if data is None:
+                break
+            self.__f.write(data)
+            self.__f.flush()
+
+    def close(self):
+        if self.__thread is not None:
+            self.__queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+            self.__f.close()
+
+def read_header(path):
+    with open(path, mode='rb') as f:
+        return json.loads(f.read(HEADER_SIZE).decode("ascii"))
+
+class ArchiveReader(object):
+    """
+    RunArchiveで保存したファイルをメモリマップで読むクラス
+    # attributes
+        - header(dict)
+        - records(np.memmap)
+            全レコード(gen, n, genes, fitness)
+    # method
+        - generation(gen)
+            (genes, fitness)を返す 行が順位(0が最良)
+    """
+    def __init__(self, path):
+        self.header = read_header(path)
+        dtype = record_dtype(self.header["mu"], self.header["ndim"], self.header["nobj"])
+        n = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+        self.records = np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(n,))
+
+    @property
+    def generations(self):
+        return np.unique(self.records["gen"])
+
+    def generation(self, gen):
+        idx = np.nonzero(self.records["gen"] == gen)[0]
+        if len(idx) == 0:
+            raise Exception("generation {0} is not in the archive".format(gen))
+        rec = self.records[idx[-1]]
+        n = rec["n"]
+        return rec["genes"][:n], rec["fitness"][:n]
+
+def export_rotor(path, gen, rank, fname):
+    """
+    アーカイブから任意の世代、順位の個体のimpoファイルを作る
+    ヘッダのmetaにtipr, hubr, r_Rが保存されている必要がある
+    """
+    from model import RotorModel
+    reader = ArchiveReader(path)
+    meta = reader.header["meta"]
+    genes, fitness = reader.generation(gen)
+    ind = list(genes[rank])
+    chords = ind[:int(len(ind)/2)]
+    betas = ind[int(len(ind)/2):]
+    radii = [a * meta["tipr"] for a in meta["r_R"]]
+    rm = RotorModel("bestRotor", meta["tipr"], meta["hubr"], len(meta["r_R"]), radii, chords, betas)
+    rm.writefile(fname)
+    return fitness[rank]
+
+if __name__ == "__main__":
+    #python archive.py [アーカイブ] [世代] [順位] [出力ファイル]
+    if len(sys.argv) != 5:
+        print("usage: python archive.py archive gen rank output")
+        sys.exit(1)
+    fit = export_rotor(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4])
+    print("fit:" + str(fit))
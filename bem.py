@@ -0,0 +1,228 @@
+import numpy as np
+import re
+from xrotor import CPUT_COLUMNS
+
+#aeroファイルの項目名と属性名の対応
+AERO_KEYS = {
+    "Zero-lift alpha": "a0",
+    "d(Cl)/d(alpha)@stall": "dclda_stall",
+    "d(Cl)/d(alpha)": "dclda",
+    "Maximum Cl": "clmax",
+    "Minimum Cl": "clmin",
+    "Cl increment to stall": "dcl_stall",
+    "Minimum Cd": "cdmin",
+    "Cl at minimum Cd": "cldmin",
+    "d(Cd)/d(Cl**2)": "dcdcl2",
+    "Reference Re number": "reref",
+    "Re scaling exponent": "rexp",
+    "Cm": "cmconst",
+    "Mcrit": "mcrit",
+}
+
+def read_aero(fname):
+    """
+    xrotorのaeroファイルを読み込む
+    # argument
+        - fname(str)
+            aeroファイルパス(Xrotor.aeroと同じ形式)
+    # return
+        - sections(dict list)
+            r/Rの昇順に並べた翼型パラメータ
+            キーはAERO_KEYSの値と"r_R"
+    """
+    sections = []
+    with open(fname) as f:
+        for line in f:
+            m = re.search(r"r/R\s*=\s*([-+.\dEe]+)", line)
+            if m:
+                sections.append({"r_R": float(m.group(1))})
+                continue
+            if not sections:
+                continue
+            #1行に2項目並んでいることがある
+            for label, value in re.findall(r"([^:]+?)\s*:\s*([-+.\dEe]+)", line):
+                label = re.sub(r"\s*\(deg\)$", "", label.strip())
+                if label in AERO_KEYS:
+                    sections[-1][AERO_KEYS[label]] = float(value)
+    if not sections:
+        raise Exception("no aero section in {0}".format(fname))
+    return sorted(sections, key=lambda s: s["r_R"])
+
+class BEM(object):
+    """
+    翼素運動量理論によるプロペラ解析クラス
+    xrotor.exeの代わりにプロセス内で計算する。
+    個体群全体を1回のnumpy演算でまとめて解析する。
+
+    誘導速度(軸方向vi、周方向ut)について
+    翼素の推力と運動量理論の釣り合いを解析点ごとに二分法で解く。
+    周方向の誘導速度は誘導速度が合成速度に垂直という条件から決める。
+    翼端損失はPrandtlの式、翼型特性はaeroファイルの線形揚力+放物線抗力モデル
+    (Re補正あり、マッハ数補正なし)で近似する。
+
+    # attributes
+        - nb(int)
+            ブレード枚数
+        - n(int)
+            半径方向の解析点数(Xrotor.nに相当)
+        - dens(float)
+            大気密度
+        - rmu(float)
+            粘性係数
+        - vso(float)
+            音速
+        - sections(dict list)
+            read_aeroで読み込んだ翼型パラメータ
+        - converged(bool ndarray)
+            直前のsolveで収束したかどうか(個体ごと)
+    # method
+        - aero(fname)
+            aeroファイル読み込み
+        - solve(chords, betas, radii, tipr, hubr, rpm, velo, n)
+            ## argument
+                - chords(array like)
+                    (個体数, 断面数)の翼弦長[m]
+                - betas(array like)
+                    (個体数, 断面数)の取付角[deg]
+                - radii(array like)
+                    断面の半径位置[m]
+                - tipr, hubr(float)
+                    プロペラ半径、ハブ半径[m]
+                - rpm(float or list)
+                    解析するrpm 複数指定するとcputの行に相当する運転点が増える
+                - velo(float)
+                    流入速度[m/s]
+                - n(int)
+                    半径方向の解析点数(Noneならself.n)
+            ## return
+                - result(ndarray)
+                    (個体数, 運転点数, len(CPUT_COLUMNS))
+                    列の並びはcputと同じ(result[i][0][10]が推力、result[i][0][-1]が効率)
+                    収束しなかった個体はnan
+    """
+    def __init__(self, nb, aerof=None, n=30, maxiter=60, tol=1e-6):
+        self.nb = nb
+        self.n = n
+        self.maxiter = maxiter
+        self.tol = tol
+        self.dens = 1.226
+        self.rmu = 1.78e-5
+        self.vso = 340.0
+        self.sections = None
+        self.converged = None
+        if aerof is not None:
+            self.aero(aerof)
+
+    def aero(self, fname):
+        self.sections = read_aero(fname)
+
+    def __aero_at(self, r_R):
+        #断面位置r/Rにおける翼型パラメータを線形補間
+        xs = [s["r_R"] for s in self.sections]
+        return {key: np.interp(r_R, xs, [s.get(key, 0.0) for s in self.sections])
+                for key in AERO_KEYS.values()}
+
+    def __polar(self, alpha, re, p):
+        #alpha[rad]からcl,cdを求める
+        a0 = np.radians(p["a0"])
+        cl = p["dclda"] * (alpha - a0)
+        #失速後は傾きをd(Cl)/d(alpha)@stallに落とす
+        over = np.maximum(cl - p["clmax"], 0.0)
+        under = np.minimum(cl - p["clmin"], 0.0)
+        ratio = p["dclda_stall"] / p["dclda"]
+        cl = cl - (over + under) * (1.0 - ratio)
+        stall = (over + under) / p["dclda"]
+        cd = (p["cdmin"] + p["dcdcl2"] * (cl - p["cldmin"])**2)\
+            * (np.maximum(re, 1.0) / p["reref"])**p["rexp"]
+        cd = cd + 2.0 * np.sin(stall)**2
+        return cl, cd
+
+    def solve(self, chords, betas, radii, tipr, hubr, rpm, velo, n=None):
+        if self.sections is None:
+            raise Exception("aero file is not loaded")
+        chords = np.atleast_2d(np.asarray(chords, dtype=float))
+        betas = np.atleast_2d(np.radians(np.asarray(betas, dtype=float)))
+        radii = np.asarray(radii, dtype=float)
+        rpm = np.atleast_1d(np.asarray(rpm, dtype=float))
+
+        #解析点(等間隔セルの中点)
+        edges = np.linspace(hubr, tipr, (self.n if n is None else n) + 1)
+        r = 0.5 * (edges[1:] + edges[:-1])
+        dr = np.diff(edges)
+        #断面値を解析点へ線形補間(半径位置は全個体共通なので重みを使い回す)
+        idx = np.clip(np.searchsorted(radii, r) - 1, 0, len(radii) - 2)
+        w = np.clip((r - radii[idx]) / (radii[idx + 1] - radii[idx]), 0.0, 1.0)
+        # 形状 (個体数, 運転点数, 解析点数)
+        c = ((1 - w) * chords[:, idx] + w * chords[:, idx + 1])[:, None, :]
+        beta = ((1 - w) * betas[:, idx] + w * betas[:, idx + 1])[:, None, :]
+        omega = (rpm * np.pi / 30.0)[None, :, None]
+        p = self.__aero_at(r / tipr)
+        B = self.nb
+        V = velo
+
+        def state(vi):
+            #軸方向誘導速度viにおける翼素の状態と運動量の釣り合いの残差
+            va = V + vi
+            #誘導速度は合成速度Wに垂直とする(渦理論)
+            ut = np.minimum(vi * va / np.maximum(omega * r, 1e-9), 0.9 * omega * r)
+            vt = omega * r - ut
+            phi = np.arctan2(va, vt)
+            W2 = va**2 + vt**2
+            cl, cd = self.__polar(beta - phi, self.dens * np.sqrt(W2) * c / self.rmu, p)
+            cn = cl * np.cos(phi) - cd * np.sin(phi)
+            ct = cl * np.sin(phi) + cd * np.cos(phi)
+            #Prandtlの翼端損失
+            f = 0.5 * B * (tipr - r) / (r * np.maximum(np.sin(phi), 1e-6))
+            F = np.maximum(2.0 / np.pi * np.arccos(np.clip(np.exp(-f), 0.0, 1.0)), 1e-4)
+            k = B * c * W2 * np.maximum(cn, 0.0) / (8.0 * np.pi * r * F)
+            return va * vi - k, W2, cn, ct
+
+        #残差は vi=0 で0以下、vi=hi で正になるので二分法で解く
+        shape = np.broadcast(c, omega).shape
+        lo = np.zeros(shape)
+        hi = np.broadcast_to(2.0 * omega * r + V, shape).copy()
+        bracket = state(hi)[0] > 0
+        for it in range(self.maxiter):
+            mid = 0.5 * (lo + hi)
+            pos = state(mid)[0] > 0
+            hi = np.where(pos, mid, hi)
+            lo = np.where(pos, lo, mid)
+            if np.all(hi - lo <= self.tol * (1.0 + hi)):
+                break
+        done = bracket & (hi - lo <= self.tol * (1.0 + hi))
+        g, W2, cn, ct = state(0.5 * (lo + hi))
+
+        #推力とトルクを積分
+        q = 0.5 * self.dens * W2 * B * c
+        T = np.sum(q * cn * dr, axis=-1)
+        Q = np.sum(q * ct * r * dr, axis=-1)
+        om = omega[..., 0]
+        P = Q * om
+        n = om / (2.0 * np.pi)
+        D = 2.0 * tipr
+        with np.errstate(divide="ignore", invalid="ignore"):
+            eff = np.where(P > 0, T * V / P, 0.0)
+            J = V / (n * D)
+            Ct = T / (self.dens * n**2 * D**4)
+            Cp = P / (self.dens * n**3 * D**5)
+
+        cols = {
+            "J": J, "V": V, "rpm": rpm[None, :], "Dbeta": 0.0,
+            "rho": self.dens, "mu": self.rmu, "VSound": self.vso,
+            "Ct": Ct, "Cp": Cp, "P": P, "T": T, "Q": Q, "Efficiency": eff,
+        }
+        result = np.empty(T.shape + (len(CPUT_COLUMNS),))
+        for i, name in enumerate(CPUT_COLUMNS):
+            result[..., i] = cols[name]
+        self.converged = done.all(axis=(1, 2))
+        result[~self.converged] = np.nan
+        return result
+
+if __name__ == "__main__":
+    r_R = [0.1, 0.3, 0.5, 0.7, 0.9, 1.0]
+    init = [2.0000e-02, 2.0000e-02, 2.0000e-02, 2.0000e-02, 2.0000e-02,
+           2.0000e-02, 7.3204e+01, 5.2122e+01, 3.8006e+01, 2.9634e+01,
+           2.3030e+01, 2.0777e+01]
+    bem = BEM(2, "AG14_Re50000.txt")
+    res = bem.solve([init[:6]], [init[6:]], [a * 0.065 for a in r_R], 0.065, 0.005, [6500, 9500], 0.1)
+    print(res)
@@ -0,0 +1,243 @@
+"""
+評価パイプラインの処理速度の計測
+xrotor.exeの代わりに擬似xrotor(fakexrotor.py)を使い、
+main.py(newnsga3)、main_mp.py、sqp.pyの評価回数/秒と1世代(sqpは1反復)あたりの時間を
+並列の方式、並列数、batch_sizeを変えて計測する。
+各条件は別のプロセスで実行するので、前の条件のセッションやタイムアウトの学習は引き継がない。
+結果はJSONに保存し、compareでコミット間の比較ができる。
+
+    python benchmark.py [--quick] [--out 出力ファイル]
+    python benchmark.py compare 前.json 後.json
+
+出力ファイルを省略するとbenchmark/[コミットのハッシュ].jsonに保存する。
+キャッシュは無効にして計測する(同じ個体の再評価も解析の回数に数える)。
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def cases(opt):
+    """
+    計測する条件のリスト
+    """
+    workers = [int(w) for w in opt.workers.split(",")]
+    batches = [int(b) for b in opt.batch.split(",")]
+    suites = opt.suites.split(",")
+    res = []
+    if "main" in suites:
+        res.append({"suite": "main", "parallel": "serial", "workers": 1, "batch_size": 1})
+        for parallel in ("thread", "process", "asyncio"):
+            for w in workers:
+                for b in (batches if parallel != "asyncio" else [1]):
+                    res.append({"suite": "main", "parallel": parallel, "workers": w, "batch_size": b})
+    if "main_mp" in suites:
+        for w in workers:
+            res.append({"suite": "main_mp", "parallel": "process", "workers": w, "batch_size": 1})
+    if "sqp" in suites:
+        res.append({"suite": "sqp", "parallel": "serial", "workers": 1, "batch_size": 1})
+        for parallel in ("thread", "process"):
+            for w in workers:
+                res.append({"suite": "sqp", "parallel": parallel, "workers": w, "batch_size": 1})
+    for case in res:
+        case.update(mu=opt.mu, ngen=opt.ngen, maxiter=opt.maxiter, seed=opt.seed)
+    return res
+
+def distribution(values):
+    if len(values) == 0:
+        return None
+    v = np.asarray(values, dtype=float)
+    return {"mean": float(v.mean()), "p50": float(np.median(v)), "max": float(v.max())}
+
+def bench_main(case, tmp):
+    import random
+    from main import newnsga3
+    ga = newnsga3()
+    ga.MU = case["mu"]
+    ga.NGEN = case["ngen"]
+    ga.parallel = case["parallel"]
+    ga.thread = case["workers"]
+    ga.batch_size = case["batch_size"]
+    ga.use_cache = False
+    ga.archive_file = None
+    ga.checkpoint_file = None
+    #世代ごとの時間はmetrics_fileから読む
+    ga.metrics = True
+    ga.metrics_file = os.path.join(tmp, "metrics.jsonl")
+    #同じ条件なら同じ個体群を評価するよう、numpyの乱数も含めてそろえる
+    random.seed(case["seed"])
+    np.random.seed(case["seed"])
+    start = time.perf_counter()
+    pop, logbook = ga.main(case["seed"])
+    wall = time.perf_counter() - start
+    with open(ga.metrics_file) as f:
+        lines = [json.loads(line) for line in f]
+    return {"evals": int(sum(logbook.select("evals"))), "wall": wall,
+            "generation_time": distribution([line["generation_time"] for line in lines]),
+            "timeouts": int(sum(logbook.select("timeouts"))),
+            "failures": int(sum(logbook.select("failures")))}
+
+def bench_main_mp(case, tmp):
+    import random
+    import main_mp
+    main_mp.MU = case["mu"]
+    main_mp.NGEN = case["ngen"]
+    main_mp.workers = case["workers"]
+    main_mp.use_cache = False
+    main_mp.archive_file = None
+    main_mp.checkpoint_file = None
+    random.seed(case["seed"])
+    np.random.seed(case["seed"])
+    start = time.perf_counter()
+    pop, logbook = main_mp.main()
+    wall = time.perf_counter() - start
+    #main_mpには世代ごとの計測がないので平均だけ
+    return {"evals": int(sum(logbook.select("evals"))), "wall": wall,
+            "generation_time": {"mean": wall / case["ngen"]}}
+
+def bench_sqp(case, tmp):
+    import sqp
+    from executor import make_executor
+    executor = make_executor(case["parallel"], case["workers"])
+    try:
+        start = time.perf_counter()
+        res = sqp.optimize(sqp.init, executor, {"ftol": 1e-9, "disp": False, "maxiter": case["maxiter"]})
+        wall = time.perf_counter() - start
+    finally:
+        executor.shutdown()
+    return {"evals": int(res.nfev_xrotor), "wall": wall,
+            "generation_time": {"mean": wall / max(res.nit, 1)}}
+
+BENCHES = {"main": bench_main, "main_mp": bench_main_mp, "sqp": bench_sqp}
+
+def run_case(case, fake, timeout):
+    """
+    1つの条件を別のプロセスで実行して結果の辞書を返す
+    """
+    env = dict(os.environ)
+    exe = [sys.executable, os.path.join(HERE, "fakexrotor.py")] + fake
+    #xrotor.split_commandで元に戻せる形で渡す
+    env["XROTOR_EXE"] = subprocess.list2cmdline(exe) if os.name == "nt" else " ".join(shlex.quote(a) for a in exe)
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "result.json")
+        try:
+            ps = subprocess.run([sys.executable, os.path.abspath(__file__), "case", json.dumps(case), out],
+                                cwd=HERE, env=env, timeout=timeout,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except subprocess.TimeoutExpired:
+            return dict(case, error="timed out after {0} s".format(timeout))
+        if ps.returncode != 0 or not os.path.exists(out):
+            tail = ps.stdout.decode("utf-8", "replace").strip().splitlines()[-5:]
+            return dict(case, error="exit code {0}: {1}".format(ps.returncode, " | ".join(tail)))
+        with open(out) as f:
+            result = json.load(f)
+    result["evals_per_sec"] = result["evals"] / result["wall"] if result["wall"] > 0 else None
+    return dict(case, **result)
+
+def commit():
+    #計測したソースのコミット(未コミットの変更があればdirty)
+    try:
+        head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=HERE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.strip() != b""
+        return head, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def fake_args(opt):
+    return ["--latency", str(opt.latency), "--jitter", str(opt.jitter),
+            "--diverge", str(opt.diverge), "--hang", str(opt.hang), "--seed", str(opt.seed)]
+
+def benchmark(opt):
+    head, dirty = commit()
+    report = {"commit": head, "dirty": dirty,
+              "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "host": platform.node(), "python": platform.python_version(),
+              "cpu_count": os.cpu_count(),
+              "fake": {"latency": opt.latency, "jitter": opt.jitter, "diverge": opt.diverge,
+                       "hang": opt.hang, "seed": opt.seed},
+              "results": []}
+    print("{0:<8} {1:<8} {2:>7} {3:>5} {4:>6} {5:>8} {6:>9} {7:>9}".format(
+        "suite", "parallel", "workers", "batch", "evals", "wall[s]", "evals/s", "gen[s]"))
+    for case in cases(opt):
+        result = run_case(case, fake_args(opt), opt.timeout)
+        report["results"].append(result)
+        if "error" in result:
+            print("{0:<8} {1:<8} {2:>7} {3:>5} error: {4}".format(
+                case["suite"], case["parallel"], case["workers"], case["batch_size"], result["error"]))
+            continue
+        print("{0:<8} {1:<8} {2:>7} {3:>5} {4:>6} {5:>8.2f} {6:>9.2f} {7:>9.3f}".format(
+            case["suite"], case["parallel"], case["workers"], case["batch_size"], result["evals"],
+            result["wall"], result["evals_per_sec"], result["generation_time"]["mean"]))
+    out = opt.out
+    if out is None:
+        out = os.path.join(HERE, "benchmark", "{0}.json".format((head or "unknown")[:12] + ("-dirty" if dirty else "")))
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, mode="w") as f:
+        json.dump(report, f, indent=1)
+    print("saved " + out)
+    return report
+
+def compare(before, after):
+    """
+    2つの結果ファイルの評価回数/秒を条件ごとに比べる
+    """
+    reports = []
+    for path in (before, after):
+        with open(path) as f:
+            reports.append(json.load(f))
+    key = lambda r: (r["suite"], r["parallel"], r["workers"], r["batch_size"])
+    old = {key(r): r for r in reports[0]["results"] if "error" not in r}
+    print("{0} -> {1}".format((reports[0]["commit"] or "?")[:12], (reports[1]["commit"] or "?")[:12]))
+    print("{0:<8} {1:<8} {2:>7} {3:>5} {4:>10} {5:>10} {6:>7}".format(
+        "suite", "parallel", "workers", "batch", "before/s", "after/s", "ratio"))
+    for r in reports[1]["results"]:
+        if "error" in r or key(r) not in old:
+            continue
+        a, b = old[key(r)]["evals_per_sec"], r["evals_per_sec"]
+        print("{0:<8} {1:<8} {2:>7} {3:>5} {4:>10.2f} {5:>10.2f} {6:>7.2f}".format(
+            r["suite"], r["parallel"], r["workers"], r["batch_size"], a, b, b / a if a else float("nan")))
+
+def options(argv=None):
+    parser = argparse.ArgumentParser(description="throughput benchmark with the fake xrotor")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--quick", action="store_true", help="small grid for CI")
+    parser.add_argument("--suites", default="main,main_mp,sqp")
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument("--batch", default="1,4")
+    parser.add_argument("--mu", type=int, default=48)
+    parser.add_argument("--ngen", type=int, default=5)
+    parser.add_argument("--maxiter", type=int, default=3, help="SLSQP iterations for sqp")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--diverge", type=float, default=0.02)
+    parser.add_argument("--hang", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=900.0, help="limit per case [s]")
+    opt = parser.parse_args(argv)
+    if opt.quick:
+        opt.workers, opt.batch, opt.mu, opt.ngen, opt.maxiter = "1,2", "1,4", 16, 3, 1
+    return opt
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "case":
+        #run_caseから呼ばれる子プロセス
+        case = json.loads(sys.argv[2])
+        with tempfile.TemporaryDirectory() as tmp:
+            result = BENCHES[case["suite"]](case, tmp)
+        with open(sys.argv[3], mode="w") as f:
+            json.dump(result, f)
+    elif len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        benchmark(options())
@@ -0,0 +1,503 @@
+"""
+評価を複数のマシンに分散するためのブローカとワーカ
+
+GAを動かす側(ドライバ)が個体の評価をブローカに投げ、
+TCPで接続したワーカが手元でxrotorを実行して結果を返す。
+
+    ドライバ(BrokerExecutor) <-> ブローカ(Broker) <-> ワーカ(WorkerAgent) * n
+
+- 通信はmultiprocessing.connection(認証付き、pickleで送受信)
+  ワーカは受け取った関数をそのまま実行するので、認証キーは環境変数OPTPROP_AUTHKEYで
+  全てのマシンに同じ値を必ず指定する(未指定や以前の既定値"optprop"では起動しない)
+- ブローカは既定で127.0.0.1で待ち受ける
+  他のマシンのワーカを使う場合は待ち受けるアドレスを明示する
+- 評価の中身(関数と個体)はドライバでpickleしたバイト列のままブローカを素通りする
+  そのためブローカはdeapやxrotorを読み込まなくてよい
+- ワーカはheartbeat秒ごとに生存を知らせ、3回分途絶えると切断とみなして
+  実行中だった評価を待ち行列の先頭に戻す(retries回まで)
+- ワーカは手元の残りがbatchの半分を切った時点で次のバッチを要求し、
+  往復の待ち時間を評価の裏に隠す
+
+同じマシンで試す場合
+    export OPTPROP_AUTHKEY=[共有する秘密の文字列]
+    python broker.py broker 6000
+    python broker.py worker 127.0.0.1:6000 4 main
+他のマシンからつなぐ場合はブローカの待ち受けアドレスを指定する
+    python broker.py broker 6000 0.0.0.0
+    main.pyでnewnsga3.parallel = "broker"、newnsga3.broker = ("127.0.0.1", 6000)として実行
+ワーカの最後の引数はドライバとして実行するスクリプトのモジュール名
+(__main__で定義されたクラスや関数を読み込むために使う)
+"""
+import os
+import sys
+import time
+import queue
+import socket
+import pickle
+import importlib
+import itertools
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import Process, AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+#認証キーとして受け付けない値(空と以前の既定値)
+INSECURE_KEYS = (b"", b"optprop")
+HEARTBEAT = 5.0#ワーカが生存を知らせる間隔[s]
+BATCH = 4#ワーカが1回に受け取る評価の数
+
+class BrokerError(Exception):
+    pass
+
+def get_authkey(authkey=None):
+    """
+    接続の認証キー
+    authkeyを省略すると環境変数OPTPROP_AUTHKEYから読む
+    未指定や推測できる値ならBrokerErrorを送出する
+    """
+    if authkey is None:
+        authkey = os.environ.get("OPTPROP_AUTHKEY", "")
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    if authkey in INSECURE_KEYS:
+        raise BrokerError("set a shared secret in OPTPROP_AUTHKEY (an empty or default key is refused)")
+    return authkey
+
+def parse_address(text):
+    #"host:port"を(host, port)にする
+    host, port = text.rsplit(":", 1)
+    return (host, int(port))
+
+def disconnect(conn):
+    #別スレッドが受信待ちだとcloseだけでは相手に切断が伝わらないのでshutdownする
+    try:
+        sock = socket.socket(fileno=os.dup(conn.fileno()))
+        sock.shutdown(socket.SHUT_RDWR)
+        sock.close()
+    except OSError:
+        pass
+    conn.close()
+
+class Broker(object):
+    """
+    評価の待ち行列を持ち、ドライバから受け取った評価をワーカに配るクラス
+
+    # attributes
+        - address(tuple)
+            待ち受けるアドレス(host, port) 既定では同じマシンからの接続だけ受け付ける
+        - authkey(bytes)
+            認証キー(Noneなら環境変数OPTPROP_AUTHKEY)
+        - heartbeat(float)
+            ワーカの生存確認の間隔[s] この3倍の間音沙汰がなければ切断する
+        - retries(int)
+            ワーカの切断で評価をやり直す回数の上限
+            超えた評価は(ワーカを落とす個体とみなして)失敗としてドライバに返す
+    # method
+        - serve_forever
+            待ち受けを始め、closeされるまで戻らない
+        - start
+            別スレッドで待ち受けを始める
+        - close
+    """
+    def __init__(self, address=("127.0.0.1", 6000), authkey=None, heartbeat=HEARTBEAT, retries=3):
+        self.address = tuple(address)
+        self.authkey = get_authkey(authkey)
+        self.heartbeat = heartbeat
+        self.retries = retries
+        self.__events = queue.Queue()
+        self.__listener = None
+        self.__ready = threading.Event()
+        self.__closed = False
+        self.__conns = set()#名乗る前のものも含めた全ての接続
+        self.__workers = {}#接続 -> ワーカの状態
+        self.__drivers = {}#接続 -> そのドライバの評価のキー
+        self.__tasks = {}#キー -> [ドライバの接続, ドライバ側の番号, 中身, やり直した回数]
+        self.__queue = deque()
+        self.__setup = None
+        self.__keys = itertools.count()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.__ready.wait()
+        return self
+
+    def close(self):
+        self.__closed = True
+        self.__events.put((None, None))
+
+    def serve_forever(self):
+        self.__listener = Listener(self.address, authkey=self.authkey)
+        self.address = self.__listener.address
+        accept = threading.Thread(target=self.__accept)
+        accept.daemon = True
+        accept.start()
+        self.__ready.set()
+        try:
+            while not self.__closed:
+                try:
+                    conn, msg = self.__events.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    pass
+                else:
+                    if conn is not None:
+                        self.__handle(conn, msg)
+                self.__check()
+                self.__dispatch()
+        finally:
+            self.__closed = True
+            self.__wake()
+            self.__listener.close()
+            for conn in list(self.__workers):
+                self.__send(conn, ("stop",))
+            for conn in list(self.__conns):
+                disconnect(conn)
+
+    def __wake(self):
+        #listenerをcloseしてもacceptは戻らないので、自分に接続して起こす
+        host, port = self.address[:2]
+        try:
+            socket.create_connection(("127.0.0.1" if host in ("0.0.0.0", "") else host, port), timeout=1.0).close()
+        except OSError:
+            pass
+
+    def __accept(self):
+        while not self.__closed:
+            try:
+                conn = self.__listener.accept()
+            except (AuthenticationError, EOFError):
+                continue
+            except OSError:
+                if self.__closed:
+                    break
+                continue
+            if self.__closed:
+                disconnect(conn)
+                break
+            self.__conns.add(conn)
+            reader = threading.Thread(target=self.__read, args=(conn,))
+            reader.daemon = True
+            reader.start()
+
+    def __read(self, conn):
+        #受信はスレッドで行い、処理は全てserve_foreverのスレッドで行う
+        try:
+            while True:
+                self.__events.put((conn, conn.recv()))
+        except Exception:
+            #切断(こちらから切断した場合も含む)
+            self.__events.put((conn, None))
+
+    def __send(self, conn, msg):
+        try:
+            conn.send(msg)
+        except (OSError, ValueError):
+            #切断の処理は受信側と同じ経路で行う
+            self.__events.put((conn, None))
+
+    def __handle(self, conn, msg):
+        if conn in self.__workers:
+            self.__workers[conn]["last"] = time.monotonic()
+        elif conn not in self.__drivers and msg is not None and msg[0] != "hello":
+            #切断済みの相手からの残りは捨てる
+            return
+        if msg is None or msg[0] == "bye":
+            self.__drop(conn)
+        elif msg[0] == "hello":
+            if msg[1] == "worker":
+                self.__workers[conn] = {"name": msg[2], "last": time.monotonic(), "inflight": set(), "credit": 0}
+                print("worker connected: {0}".format(msg[2]))
+                if self.__setup is not None:
+                    self.__send(conn, ("setup", self.__setup))
+            else:
+                self.__drivers[conn] = set()
+        elif msg[0] == "setup":
+            self.__setup = msg[1]
+            for worker in self.__workers:
+                self.__send(worker, ("setup", self.__setup))
+        elif msg[0] == "submit":
+            for tid, payload in msg[1]:
+                key = next(self.__keys)
+                self.__tasks[key] = [conn, tid, payload, 0]
+                self.__drivers[conn].add(key)
+                self.__queue.append(key)
+        elif msg[0] == "ready":
+            self.__workers[conn]["credit"] += msg[1]
+        elif msg[0] == "result":
+            key, ok, payload = msg[1:]
+            worker = self.__workers.get(conn)
+            if worker is None or key not in worker["inflight"]:
+                return
+            worker["inflight"].discard(key)
+            self.__reply(key, ok, payload)
+
+    def __reply(self, key, ok, payload):
+        #ドライバが切断済みなら結果は捨てる
+        task = self.__tasks.pop(key, None)
+        if task is None:
+            return
+        driver, tid = task[0], task[1]
+        self.__drivers[driver].discard(key)
+        self.__send(driver, ("result", tid, ok, payload))
+
+    def __drop(self, conn):
+        worker = self.__workers.pop(conn, None)
+        if worker is not None:
+            print("worker lost: {0} ({1} tasks requeued)".format(worker["name"], len(worker["inflight"])))
+            for key in worker["inflight"]:
+                task = self.__tasks.get(key)
+                if task is None:
+                    continue
+                task[3] += 1
+                if task[3] > self.retries:
+                    error = BrokerError("evaluation lost {0} workers".format(task[3]))
+                    self.__reply(key, False, pickle.dumps(error))
+                else:
+                    self.__queue.appendleft(key)
+        keys = self.__drivers.pop(conn, None)
+        if keys is not None:
+            for key in keys:
+                self.__tasks.pop(key, None)
+        self.__conns.discard(conn)
+        disconnect(conn)
+
+    def __check(self):
+        #heartbeatが途絶えたワーカを切断する
+        limit = time.monotonic() - 3 * self.heartbeat
+        for conn, worker in list(self.__workers.items()):
+            if worker["last"] < limit:
+                self.__drop(conn)
+
+    def __dispatch(self):
+        for conn, worker in list(self.__workers.items()):
+            items = []
+            while worker["credit"] > len(items) and self.__queue:
+                key = self.__queue.popleft()
+                #切断したドライバの評価は飛ばす
+                if key in self.__tasks:
+                    items.append((key, self.__tasks[key][2]))
+            if items:
+                worker["credit"] -= len(items)
+                worker["inflight"].update(key for key, payload in items)
+                self.__send(conn, ("tasks", items))
+            if not self.__queue:
+                break
+
+class WorkerAgent(object):
+    """
+    ブローカに接続し、受け取った評価を手元で実行して結果を返すクラス
+    runはブローカから終了を指示されるとTrue、接続が切れるとFalseを返す
+
+    # attributes
+        - address(tuple)
+            ブローカのアドレス(host, port)
+        - batch(int)
+            1回に要求する評価の数
+        - heartbeat(float)
+            生存を知らせる間隔[s](ブローカと同じ値にする)
+    """
+    def __init__(self, address, authkey=None, batch=BATCH, heartbeat=HEARTBEAT, name=None):
+        self.address = tuple(address)
+        self.authkey = get_authkey(authkey)
+        self.batch = batch
+        self.heartbeat = heartbeat
+        #os.unameはWindowsにないのでsocketからホスト名を取る
+        self.name = name or "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+    def run(self):
+        conn = Client(self.address, authkey=self.authkey)
+        lock = threading.Lock()
+        def send(msg):
+            with lock:
+                conn.send(msg)
+        stop = threading.Event()
+        def beat():
+            #評価の最中もスレッドから生存を知らせる
+            while not stop.wait(self.heartbeat):
+                try:
+                    send(("heartbeat",))
+                except OSError:
+                    break
+        beater = threading.Thread(target=beat)
+        beater.daemon = True
+        send(("hello", "worker", self.name))
+        beater.start()
+        pending = deque()
+        requested = 0
+        stopped = False
+        try:
+            while True:
+                #手元の残りが半分を切ったら次のバッチを要求する
+                if len(pending) + requested <= self.batch // 2:
+                    n = self.batch - len(pending) - requested
+                    send(("ready", n))
+                    requested += n
+                if not pending or conn.poll(0):
+                    msg = conn.recv()
+                    if msg[0] == "setup":
+                        initializer, initargs = pickle.loads(msg[1])
+                        if initializer is not None:
+                            initializer(*initargs)
+                    elif msg[0] == "tasks":
+                        pending.extend(msg[1])
+                        requested -= len(msg[1])
+                    elif msg[0] == "stop":
+                        stopped = True
+                        break
+                    continue
+                key, payload = pending.popleft()
+                send(("result", key) + self.execute(payload))
+        except (EOFError, OSError):
+            pass
+        finally:
+            stop.set()
+            conn.close()
+        return stopped
+
+    def execute(self, payload):
+        #評価を実行し(成功したか, 戻り値か例外のpickle)を返す
+        try:
+            func, args = pickle.loads(payload)
+            return True, pickle.dumps(func(*args))
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                return False, pickle.dumps(e)
+            except Exception:
+                return False, pickle.dumps(BrokerError(repr(e)))
+
+class BrokerExecutor(object):
+    """
+    ブローカ経由でワーカに評価させる実行器(executor.make_executorの"broker")
+    map、submit、shutdownはexecutor.pyの他の実行器と同じ
+
+    # argument
+        - address(tuple)
+            ブローカのアドレス(host, port)
+        - workers(int)
+            同時に投げる評価の目安(定常状態GAで使う)
+        - initializer, initargs
+            各ワーカで最初に呼ぶ関数とその引数
+        - authkey(bytes)
+            認証キー(Noneなら環境変数OPTPROP_AUTHKEY)
+    """
+    kind = "broker"
+    def __init__(self, address, workers=None, initializer=None, initargs=(), authkey=None):
+        self.workers = workers or os.cpu_count()
+        self.conn = Client(tuple(address), authkey=get_authkey(authkey))
+        self.__lock = threading.Lock()
+        self.__futures = {}
+        self.__ids = itertools.count()
+        self.conn.send(("hello", "driver"))
+        if initializer is not None:
+            self.conn.send(("setup", pickle.dumps((initializer, initargs))))
+        self.__reader = threading.Thread(target=self.__read)
+        self.__reader.daemon = True
+        self.__reader.start()
+
+    def __read(self):
+        try:
+            while True:
+                msg = self.conn.recv()
+                future = self.__futures.pop(msg[1])
+                value = pickle.loads(msg[3])
+                if msg[2]:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        except (EOFError, OSError):
+            pass
+        for tid in list(self.__futures):
+            self.__futures.pop(tid).set_exception(BrokerError("connection to broker lost"))
+
+    def __submit(self, func, arglist):
+        futures = []
+        items = []
+        with self.__lock:
+            for args in arglist:
+                tid = next(self.__ids)
+                future = Future()
+                #結果が先に届いても取りこぼさないよう送る前に登録する
+                self.__futures[tid] = future
+                futures.append(future)
+                items.append((tid, pickle.dumps((func, args), protocol=pickle.HIGHEST_PROTOCOL)))
+            self.conn.send(("submit", items))
+        return futures
+
+    def submit(self, func, *args):
+        return self.__submit(func, [args])[0]
+
+    def map(self, func, items):
+        return [f.result() for f in self.__submit(func, [(item,) for item in items])]
+
+    def shutdown(self):
+        try:
+            with self.__lock:
+                self.conn.send(("bye",))
+        except OSError:
+            pass
+        self.conn.close()
+        self.__reader.join()
+
+def run_worker(address, main=None, batch=BATCH):
+    """
+    ワーカを1つ動かす
+    応答が遅れて切断された場合はつなぎ直し、
+    ブローカから終了を指示されるか、ブローカに接続できなくなったら戻る
+    初期化(mainの読み込みやinitializer)で例外が出た場合も、
+    起動し直しても同じ失敗を繰り返すだけなので表示して戻る
+    mainを指定するとそのモジュールを__main__として読み込む
+    """
+    try:
+        if main is not None:
+            module = importlib.import_module(main)
+            sys.modules["__main__"] = module
+        agent = WorkerAgent(address, batch=batch)
+        while True:
+            if agent.run():
+                return
+    except ConnectionError:
+        return
+    except Exception:
+        traceback.print_exc()
+        print("worker stopped: initialization failed")
+        return
+
+def run_workers(address, procs=1, main=None, batch=BATCH):
+    """
+    ワーカをprocs個のプロセスで動かす
+    異常終了したワーカ(評価中にxrotorごと落ちたなど)は起動し直す
+    ブローカが切断されて全てのワーカが正常終了したら戻る
+    """
+    def spawn():
+        p = Process(target=run_worker, args=(address, main, batch))
+        p.start()
+        return p
+    workers = [spawn() for i in range(procs)]
+    while workers:
+        time.sleep(1.0)
+        for i, p in enumerate(workers):
+            if p.exitcode is not None and p.exitcode != 0:
+                workers[i] = spawn()
+        workers = [p for p in workers if p.exitcode is None]
+
+if __name__ == "__main__":
+    #python broker.py broker [port] [待ち受けるhost(既定は127.0.0.1)]
+    #python broker.py worker [host:port] [プロセス数] [ドライバのモジュール名]
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        address = parse_address(sys.argv[2]) if len(sys.argv) > 2 else ("127.0.0.1", 6000)
+        procs = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+        main = sys.argv[4] if len(sys.argv) > 4 else None
+        run_workers(address, procs, main)
+    else:
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 6000
+        host = sys.argv[3] if len(sys.argv) > 3 else "127.0.0.1"
+        broker = Broker((host, port))
+        print("broker listening on {0}:{1}".format(host, port))
+        try:
+            broker.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,140 @@
+import numpy as np
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+class EvaluationCache(object):
+    """
+    評価値のメモ化を行うクラス
+    遺伝子をtolで量子化した値と解析条件の組をキーとし、
+    同一(またはほぼ同一)の個体の再評価を省略する。
+    容量を超えた分は最後に参照された時刻が古いものから捨てる(LRU)。
+    pathを指定するとファイルに保存でき、次回の実行を途中から温まった状態で始められる。
+
+    # attributes
+        - conditions(tuple)
+            解析条件(エンジン、rpm1, rpm2, velo, aerof, 形状の寸法、ペナルティの閾値など)
+            条件が異なる評価値は別物として扱う
+            記憶した評価値に影響する入力は全て含めること(cache_fileで次回に持ち越すため)
+            個体にfidelity属性(解析の忠実度)があればそれも条件に含める
+        - tol(float or float list)
+            遺伝子の量子化幅
+            遺伝子ごとに指定する場合はリスト
+        - maxsize(int)
+            記憶する評価値の最大数
+        - path(str)
+            保存先ファイルパス(Noneなら保存しない)
+        - hits(int)
+            ヒット数
+        - misses(int)
+            ミス数
+    # method
+        - get(individual)
+            評価値を返す(なければNone)
+        - put(individual, fitness)
+            評価値を記憶する
+        - evaluate(individuals, func)
+            ヒットしなかった個体だけをfunc(個体のリスト)で評価し、
+            individualsと同じ順の評価値のリストを返す
+            statusが"ok"でない評価値(タイムアウトや解析の失敗、main.Outcomeを参照)は記憶しない
+        - counters(reset)
+            ヒット数とミス数の辞書を返す
+            reset=Trueなら返した後に0に戻す(世代ごとの集計用)
+        - load
+        - save
+    """
+    def __init__(self, conditions=(), tol=1e-6, maxsize=100000, path=None):
+        self.conditions = tuple(conditions)
+        self.tol = tol
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __getstate__(self):
+        #ロックはpickleできないので除く
+        state = self.__dict__.copy()
+        del state["_EvaluationCache__lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def key(self, individual):
+        q = np.round(np.asarray(individual, dtype=float) / self.tol).astype(np.int64)
+        fidelity = getattr(individual, "fidelity", None)
+        if fidelity is not None:
+            return (self.conditions, fidelity, tuple(q.tolist()))
+        return (self.conditions, tuple(q.tolist()))
+
+    def get(self, individual):
+        key = self.key(individual)
+        with self.__lock:
+            if key in self.__data:
+                self.__data.move_to_end(key)
+                self.hits += 1
+                return self.__data[key]
+            self.misses += 1
+            return None
+
+    def put(self, individual, fitness):
+        key = self.key(individual)
+        with self.__lock:
+            self.__data[key] = tuple(fitness)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def evaluate(self, individuals, func):
+        fitnesses = [self.get(ind) for ind in individuals]
+        #同じ世代の中での重複も1回だけ評価する
+        todo = OrderedDict()
+        for i, (ind, fit) in enumerate(zip(individuals, fitnesses)):
+            if fit is None:
+                todo.setdefault(self.key(ind), []).append(i)
+        first = [individuals[idx[0]] for idx in todo.values()]
+        for idx, ind, fit in zip(todo.values(), first, func(first)):
+            #タイムアウトなどは次に評価すれば解析できることがあるので記憶しない
+            if getattr(fit, "status", "ok") == "ok":
+                self.put(ind, fit)
+            for i in idx:
+                fitnesses[i] = tuple(fit)
+        return fitnesses
+
+    def counters(self, reset=False):
+        with self.__lock:
+            res = {"hits": self.hits, "misses": self.misses}
+            if reset:
+                self.hits = 0
+                self.misses = 0
+        return res
+
+    def load(self, path=None):
+        path = self.path if path is None else path
+        with open(path, mode='rb') as f:
+            data = pickle.load(f)
+        with self.__lock:
+            self.__data = OrderedDict(data)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def save(self, path=None):
+        path = self.path if path is None else path
+        if path is None:
+            return
+        with self.__lock:
+            data = list(self.__data.items())
+        #書き込み途中で落ちても既存のファイルを壊さない
+        tmp = path + ".tmp"
+        with open(tmp, mode='wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
@@ -0,0 +1,72 @@
+import os
+import pickle
+import random
+import threading
+import numpy as np
+
+class Checkpoint(object):
+    """
+    GAの途中経過をファイルに保存するクラス
+    状態はその場でpickleしてスナップショットを取り、
+    ファイルへの書き込みは別スレッドで行うので世代のループを止めない。
+    一時ファイルに書いてからos.replaceで置き換えるため、
+    書き込み中に落ちても前回のチェックポイントは壊れない。
+
+    # attributes
+        - path(str)
+            保存先ファイルパス
+        - interval(int)
+            保存する世代の間隔
+    # method
+        - due(gen)
+            genで保存するかどうか
+        - save(state)
+            状態(dict)を保存する
+            乱数の状態はここで追加される
+        - close
+            書き込み中の保存が終わるのを待つ
+    """
+    def __init__(self, path, interval=10):
+        self.path = path
+        self.interval = interval
+        self.__thread = None
+
+    def due(self, gen):
+        return (gen + 1) % self.interval == 0
+
+    def save(self, state):
+        state = dict(state)
+        state["random"] = random.getstate()
+        state["np_random"] = np.random.get_state()
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        #前回の書き込みが終わっていなければ待つ(同時に書かない)
+        self.close()
+        self.__thread = threading.Thread(target=self.__write, args=(data,))
+        self.__thread.start()
+
+    def __write(self, data):
+        tmp = self.path + ".tmp"
+        with open(tmp, mode='wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def close(self):
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+def load_checkpoint(path):
+    """
+    Checkpoint.saveで保存した状態を読み込み、乱数の状態を復元する
+    個体の復元にはdeapのcreatorでクラスを作成しておく必要がある
+    # return
+        - state(dict)
+            pop, logbook, genなど
+    """
+    with open(path, mode='rb') as f:
+        state = pickle.load(f)
+    random.setstate(state["random"])
+    np.random.set_state(state["np_random"])
+    return state
@@ -0,0 +1,249 @@
+"""
+収束の指標と早期終了の判定
+世代ごとに個体群の評価値と遺伝子から収束の指標を求め、終了条件を満たしたかを判定する。
+前の世代までの値は最良値と直近の履歴だけを持つので、1世代あたりの計算は個体群の大きさだけで決まる。
+
+    - dbest, dmean : 個体群の最良値、平均値の前の世代からの改善量(評価値の目的ごと、良くなる向きが正)
+    - div : 遺伝子空間での多様性(遺伝子ごとの標準偏差を定義域の幅で割った値の平均)
+    - hv : 第1フロントのハイパーボリューム(多目的でuse_hv=Trueのときだけ)
+           参照点は最初の世代の最悪点から決めて固定する(参照点より悪い個体は数えない)
+           厳密な計算は目的数とともに急に重くなるので、exact_max_objを超える目的数では
+           モンテカルロ法で推定する(相対誤差はおよそ1/sqrt(samples))
+
+終了条件(Noneの条件は使わない)
+    - 停滞 : window世代の間、これまでの最良値(多目的ではハイパーボリューム)の改善がtol(相対)以下
+    - 目標 : 全ての目的でtargetと同じかそれより良い個体が現れた
+    - 実行時間 : 経過時間がmax_time[s]を超えた(途中経過から再開した分も通算する)
+    - 評価回数 : 評価回数の合計がmax_evalsを超えた
+判定は世代の終わりに行うので、実行時間と評価回数は最後の1世代分だけ上限を超えることがある。
+
+解析の忠実度(main.newnsga3.multi_fidelity)が切り替わると評価値の基準が変わるので、
+最良値、履歴、ハイパーボリュームの参照点をその世代から取り直す(停滞の判定もやり直しになる)。
+
+    convergence = Convergence(weights, BOUND_LOW, BOUND_UP, use_hv=True)
+    convergence.start()
+    for gen in ...:
+        record.update(convergence.update(values, genes, nevals))
+        reason = convergence.stop(window=30, tol=1e-4)
+        if reason is not None:
+            break
+"""
+import time
+from collections import deque
+import numpy as np
+from selection import sort_nondominated
+
+def hypervolume(points, ref):
+    """
+    最小化の点集合が参照点との間に支配する体積
+    最後の目的で並べて切り分け、1つ少ない目的の体積を足し合わせる(目的数mで点の数のm-1乗程度)
+    # argument
+        - points(ndarray)
+            (点の数, 目的の数) 最小化の評価値
+        - ref(ndarray)
+            参照点
+    # return
+        - hv(float)
+    """
+    points = np.asarray(points, dtype=float)
+    points = points[np.all(points < ref, axis=1)]
+    if len(points) == 0:
+        return 0.0
+    m = points.shape[1]
+    if m == 1:
+        return float(ref[0] - points[:, 0].min())
+    points = points[np.argsort(points[:, -1], kind="stable")]
+    if m == 2:
+        #1つ目の目的の最小値を更新する点だけが面積を増やす
+        hv = 0.0
+        front = ref[0]
+        for i in range(len(points)):
+            if points[i, 0] < front:
+                hv += (front - points[i, 0]) * (ref[1] - points[i, 1])
+                front = points[i, 0]
+        return float(hv)
+    hv = 0.0
+    for i in range(len(points)):
+        top = points[i + 1, -1] if i + 1 < len(points) else ref[-1]
+        if top > points[i, -1]:
+            hv += hypervolume(points[:i + 1, :-1], ref[:-1]) * (top - points[i, -1])
+    return float(hv)
+
+def hypervolume_mc(points, ref, samples=20000, seed=0, chunk=2000):
+    """
+    最小化の点集合が参照点との間に支配する体積をモンテカルロ法で推定する
+    点の最小値と参照点で囲んだ箱に一様な点を打ち、いずれかの点に支配される割合から求める
+    乱数は毎回同じ系列を使う(同じ点集合なら同じ値になり、GAの乱数の状態も変えない)
+    # argument
+        - points(ndarray)
+            (点の数, 目的の数) 最小化の評価値
+        - ref(ndarray)
+            参照点
+        - samples(int)
+            打つ点の数
+    # return
+        - hv(float)
+    """
+    points = np.asarray(points, dtype=float)
+    points = points[np.all(points < ref, axis=1)]
+    if len(points) == 0:
+        return 0.0
+    low = points.min(axis=0)
+    u = np.random.default_rng(seed).random((samples, points.shape[1]))
+    x = low + u * (ref - low)
+    hit = 0
+    for i in range(0, samples, chunk):
+        #(打った点, 点集合, 目的)で比べ、全ての目的で点集合のどれかより悪ければ支配される
+        hit += np.count_nonzero(np.any(np.all(points[None, :, :] <= x[i:i + chunk, None, :], axis=2), axis=1))
+    return float(np.prod(ref - low) * hit / samples)
+
+class Convergence(object):
+    """
+    世代ごとの収束の指標と終了条件の判定
+    チェックポイントに入れて保存し、再開後も同じ履歴で続ける
+
+    # attributes
+        - weights(ndarray)
+            評価値の重み(deapのweightsと同じ)
+        - low, up(ndarray)
+            遺伝子の下限、上限(多様性の正規化に使う)
+        - margin(float)
+            ハイパーボリュームの参照点を最初の世代の最悪点から離す割合(評価値の幅に対する比)
+        - use_hv(bool)
+            多目的のときハイパーボリュームを計算する
+            Falseならhvを記録せず、停滞の判定もしない(1目的では常に最良値で判定する)
+        - exact_max_obj(int)
+            ハイパーボリュームを厳密に計算する目的数の上限(超えるとモンテカルロ法で推定)
+        - samples(int)
+            モンテカルロ法で打つ点の数
+        - gen(int)
+            updateした世代数
+        - evals(int)
+            評価回数の合計
+        - elapsed(float)
+            startからの経過時間の合計[s]
+        - best(ndarray)
+            直前の世代の個体群の最良値(wvalues)
+        - mean(ndarray)
+            直前の世代の個体群の平均値(wvalues)
+        - score(float)
+            これまでの最良値(多目的ではハイパーボリューム) 停滞の判定に使う
+        - ref(ndarray)
+            ハイパーボリュームの参照点(最小化の評価値)
+        - fidelity
+            直前の世代の評価値の忠実度(Noneなら区別しない)
+        - history(deque)
+            停滞の判定に使う(忠実度, これまでの最良値)の履歴
+        - reason(str)
+            終了した理由(終了していなければNone)
+    # method
+        - start
+            経過時間の計測を始める(再開したときも呼ぶ)
+        - update(values, genes, nevals, fidelity)
+            1世代分の個体群で指標を更新する
+            fidelityが直前の世代と異なれば最良値、履歴、参照点を取り直す
+            ## return
+                - record(dict)
+                    logbookに追加する指標(dbest, dmean, div, 多目的でuse_hv=Trueならhv)
+        - stop(window, tol, target, max_time, max_evals)
+            終了条件を判定する
+            targetは評価値と同じ向き(weightsを掛ける前)で、判定に使わない目的はnanにする
+            ## return
+                - reason(str)
+                    満たした条件("target", "time", "evals", "stagnation" 満たしていなければNone)
+    """
+    def __init__(self, weights, low, up, margin=0.1, use_hv=False, exact_max_obj=3, samples=20000):
+        self.weights = np.atleast_1d(np.asarray(weights, dtype=float))
+        self.low = np.asarray(low, dtype=float)
+        self.up = np.asarray(up, dtype=float)
+        self.margin = margin
+        self.use_hv = use_hv
+        self.exact_max_obj = exact_max_obj
+        self.samples = samples
+        self.gen = 0
+        self.evals = 0
+        self.elapsed = 0.0
+        self.best = None
+        self.mean = None
+        self.score = None
+        self.ref = None
+        self.fidelity = None
+        self.history = deque()
+        self.reason = None
+        self.__last = None
+        self.__w = None
+
+    def __getstate__(self):
+        #計測中の時刻は別のプロセスでは意味がないので保存しない
+        state = self.__dict__.copy()
+        state["_Convergence__last"] = None
+        return state
+
+    def start(self):
+        self.__last = time.perf_counter()
+
+    def update(self, values, genes, nevals, fidelity=None):
+        now = time.perf_counter()
+        if self.__last is not None:
+            self.elapsed += now - self.__last
+        self.__last = now
+        self.gen += 1
+        self.evals += nevals
+
+        if fidelity != self.fidelity:
+            #基準の異なる評価値とは比べない
+            self.best = self.mean = self.score = self.ref = None
+            self.history.clear()
+            self.fidelity = fidelity
+
+        w = np.asarray(values, dtype=float).reshape(len(values), -1) * self.weights
+        best = w.max(axis=0)
+        mean = w.mean(axis=0)
+        record = {"dbest": np.zeros_like(best) if self.best is None else best - self.best,
+                  "dmean": np.zeros_like(mean) if self.mean is None else mean - self.mean}
+        self.best, self.mean = best, mean
+        self.__w = w
+
+        genes = np.asarray(genes, dtype=float)
+        width = np.broadcast_to(self.up - self.low, genes.shape[1:])
+        record["div"] = float(np.mean(genes.std(axis=0) / width))
+
+        if len(self.weights) == 1:
+            score = float(best[0])
+        elif self.use_hv:
+            f = -w
+            if self.ref is None:
+                worst, ideal = f.max(axis=0), f.min(axis=0)
+                self.ref = worst + self.margin * np.maximum(worst - ideal, np.finfo(float).eps)
+            front = f[sort_nondominated(w, 1)[0]]
+            if len(self.weights) <= self.exact_max_obj:
+                record["hv"] = score = hypervolume(front, self.ref)
+            else:
+                record["hv"] = score = hypervolume_mc(front, self.ref, self.samples)
+        else:
+            return record
+        self.score = score if self.score is None else max(self.score, score)
+        self.history.append((fidelity, self.score))
+        return record
+
+    def stop(self, window=None, tol=0.0, target=None, max_time=None, max_evals=None):
+        reason = None
+        if target is not None and self.__w is not None:
+            target = np.atleast_1d(np.asarray(target, dtype=float)) * self.weights
+            #nanの目的は判定に使わない
+            if np.any(np.all(np.isnan(target) | (self.__w >= target), axis=1)):
+                reason = "target"
+        if reason is None and max_time is not None and self.elapsed >= max_time:
+            reason = "time"
+        if reason is None and max_evals is not None and self.evals >= max_evals:
+            reason = "evals"
+        if reason is None and window is not None:
+            #window世代前の最良値と比べる
+            while len(self.history) > window + 1:
+                self.history.popleft()
+            if len(self.history) == window + 1:
+                old = self.history[0][1]
+                if self.history[-1][1] - old <= tol * abs(old):
+                    reason = "stagnation"
+        self.reason = reason
+        return reason
@@ -0,0 +1,150 @@
+import os
+import asyncio
+import inspect
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+#プロセスプールの各ワーカが保持する最適化オブジェクト(init_workerで設定)
+_owner = None
+
+def init_worker(owner):
+    """
+    プロセスプールのワーカ初期化関数
+    ownerのinit_workerを呼び、以降のcall_workerの呼び出し先にする
+    """
+    global _owner
+    _owner = owner
+    if hasattr(owner, "init_worker"):
+        owner.init_worker()
+
+def call_worker(name, *args):
+    """
+    ワーカが保持するオブジェクトのメソッドnameを呼ぶ
+    toolbox.register("evaluate", call_worker, "evaluate")のように使うと
+    個体だけがプロセス間を行き来する
+    """
+    return getattr(_owner, name)(*args)
+
+class SerialExecutor(object):
+    """
+    並列化せずに呼び出し元で順に実行する
+    """
+    kind = "serial"
+    def __init__(self, workers=None):
+        self.workers = 1
+
+    def map(self, func, items):
+        return [func(item) for item in items]
+
+    def submit(self, func, *args):
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self):
+        pass
+
+class PoolExecutor(object):
+    """
+    concurrent.futuresのスレッドプール、プロセスプールで実行する
+    # argument
+        - kind(str)
+            "thread" or "process"
+        - workers(int)
+            並列数(Noneなら論理コア数)
+        - initializer, initargs
+            プロセスプールのワーカ初期化関数とその引数
+    """
+    def __init__(self, kind, workers=None, initializer=None, initargs=()):
+        self.kind = kind
+        self.workers = workers or os.cpu_count()
+        if kind == "thread":
+            self.pool = ThreadPoolExecutor(self.workers)
+        elif kind == "process":
+            self.pool = ProcessPoolExecutor(self.workers, initializer=initializer, initargs=initargs)
+        else:
+            raise Exception("unknown pool kind: {0}".format(kind))
+
+    def map(self, func, items):
+        items = list(items)
+        #プロセス間通信の回数を減らすためにまとめて送る
+        chunksize = max(1, len(items) // (self.workers * 4)) if self.kind == "process" else 1
+        return list(self.pool.map(func, items, chunksize=chunksize))
+
+    def submit(self, func, *args):
+        return self.pool.submit(func, *args)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+class AsyncioExecutor(object):
+    """
+    専用スレッドで動くイベントループ上で実行する
+    funcがコルーチン関数(async def)ならそのままawaitし、
+    同時に実行する数をworkersに制限する。
+    通常の関数はイベントループの既定スレッドプールで実行する。
+    """
+    kind = "asyncio"
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.loop = asyncio.new_event_loop()
+        self.__sem = None
+        self.__thread = threading.Thread(target=self.loop.run_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    async def __run(self, func, *args):
+        if self.__sem is None:
+            self.__sem = asyncio.Semaphore(self.workers)
+        async with self.__sem:
+            if inspect.iscoroutinefunction(func):
+                return await func(*args)
+            return await self.loop.run_in_executor(None, func, *args)
+
+    def submit(self, func, *args):
+        return asyncio.run_coroutine_threadsafe(self.__run(func, *args), self.loop)
+
+    def map(self, func, items):
+        futures = [self.submit(func, item) for item in items]
+        return [f.result() for f in futures]
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.__thread.join()
+        self.loop.close()
+
+def make_executor(kind="thread", workers=None, owner=None, address=None):
+    """
+    並列化の方式を選んで実行器を作る
+    # argument
+        - kind(str)
+            "serial" : 並列化しない
+            "thread" : スレッドプール
+            "process" : プロセスプール(ownerをワーカに複製する)
+            "asyncio" : イベントループ(非同期サブプロセス向け)
+            "broker" : 他のマシンのワーカ(ownerをワーカに複製する、broker.pyを参照)
+        - workers(int)
+            並列数(Noneなら論理コア数)
+        - owner(object)
+            プロセスプール、ブローカの各ワーカに渡すオブジェクト
+            ワーカ側ではowner.init_workerが呼ばれる
+        - address(tuple)
+            "broker"のときのブローカのアドレス(host, port)
+    # return
+        map(func, items)、submit(func, *args)、shutdownを持つ実行器
+    """
+    if kind == "serial":
+        return SerialExecutor()
+    if kind == "thread":
+        return PoolExecutor("thread", workers)
+    if kind == "process":
+        return PoolExecutor("process", workers, initializer=init_worker, initargs=(owner,))
+    if kind == "asyncio":
+        return AsyncioExecutor(workers)
+    if kind == "broker":
+        from broker import BrokerExecutor
+        return BrokerExecutor(address, workers, initializer=init_worker, initargs=(owner,))
+    raise Exception("unknown executor: {0}".format(kind))
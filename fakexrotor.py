@@ -0,0 +1,281 @@
+"""
+xrotor.exeの代わりに使う決定的な擬似xrotor
+Windows以外の環境(CIなど)で最適化の動作確認や処理速度の計測をするためのもの。
+
+Xrotorが組み立てるコマンド(plop, aero, impo, dens, oper(n, velo, rpm, addc, vseq, clrc, cput), quit)を
+標準入力から1行ずつ読み、cputでxrotorと同じ列の表を書き出す。
+解析結果はbem.pyで形状ファイルから計算するので、同じ形状には常に同じ値を返す。
+認識できないコマンドにはxrotorと同じく"command not recognized"を返すので、
+XrotorSession(常駐セッション)の番兵もそのまま使える。
+
+遅延、発散、無限ループは形状ファイルの内容とseedから決まる乱数で起こすので、
+同じ設計は何度解析しても同じ振る舞いになる(キャッシュやタイムアウトの試験に使える)。
+    - 発散 : cputの効率の列が"********"になる(parse_cputでCputError)
+    - 無限ループ : 最初のaddcで止まったまま応答しない(タイムアウトで打ち切られる)
+
+Xrotor.exe(環境変数XROTOR_EXE)に指定して使う。
+    XROTOR_EXE="python fakexrotor.py --latency 0.05 --diverge 0.05 --hang 0.01" python main.py
+オプションは環境変数FAKE_XROTOR_LATENCYなどでも指定できる(コマンドライン引数が優先)。
+pythonとnumpyの読み込みがあるので、起動には--startupとは別に0.2s程度かかる。
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+import numpy as np
+from bem import BEM
+from xrotor import CPUT_COLUMNS
+
+class FakeXrotor(object):
+    """
+    擬似xrotorの本体
+    1行ずつfeedに渡すと、xrotorのメニュー(トップ、aero、oper)をたどってコマンドを解釈する
+
+    # attributes
+        - latency(float)
+            1ケース(addc)あたりの解析時間[s]
+        - jitter(float)
+            解析時間のばらつき(latencyに対する比、設計ごとに決まる)
+        - startup(float)
+            起動時間[s]
+        - diverge(float)
+            発散する設計の割合
+        - hang(float)
+            無限ループに陥る設計の割合
+        - hang_time(float)
+            無限ループの代わりに止まる時間[s]
+        - seed(int)
+            発散などを決める乱数の種
+        - out
+            画面出力先
+    # method
+        - feed(line)
+            1行分のコマンドを処理する
+            quitでFalseを返す
+    """
+    def __init__(self, latency=0.0, jitter=0.0, startup=0.0, diverge=0.0, hang=0.0,
+                 hang_time=3600.0, seed=0, out=sys.stdout):
+        self.latency = latency
+        self.jitter = jitter
+        self.startup = startup
+        self.diverge = diverge
+        self.hang = hang
+        self.hang_time = hang_time
+        self.seed = seed
+        self.out = out
+        self.bem = BEM(2)
+        self.geometry = None
+        self.key = b""
+        self.velo = 1.0
+        self.rpm = 160.0
+        self.cases = []
+        self.__menu = "top"
+        self.__expect = []
+        if self.startup > 0:
+            time.sleep(self.startup)
+
+    def print(self, text):
+        self.out.write(text + "\n")
+        self.out.flush()
+
+    def random(self, salt):
+        #形状ファイルの内容とseedから決まる[0, 1)の値
+        digest = hashlib.md5(self.key + bytes("{0}:{1}".format(self.seed, salt), "ascii")).digest()
+        return int.from_bytes(digest[:8], "little") / 2.0**64
+
+    def feed(self, line):
+        line = line.strip()
+        #引数待ちのコマンド(impoのファイル名など)
+        if self.__expect:
+            handler = self.__expect.pop(0)
+            handler(line)
+            return True
+        tokens = line.split()
+        command = tokens[0].lower() if tokens else ""
+        handler = getattr(self, "_{0}_{1}".format(self.__menu, command), None)
+        if handler is None:
+            #XrotorSessionはこの行に現れる番兵で出力の終わりを判定する
+            self.print(" *** {0} command not recognized.  Type a \"?\" for list".format(line))
+            return True
+        return handler(tokens[1:])
+
+    def __wait(self, handler, count=1):
+        self.__expect.extend([handler] * count)
+
+    #---トップメニュー---
+    def _top_(self, args):
+        return True
+
+    def _top_plop(self, args):
+        #グラフィックの設定は読み飛ばす
+        self.__menu = "plop"
+        return True
+
+    def _plop_(self, args):
+        self.__menu = "top"
+        return True
+
+    def _plop_g(self, args):
+        return True
+
+    def _top_aero(self, args):
+        self.__menu = "aero"
+        return True
+
+    def _aero_(self, args):
+        self.__menu = "top"
+        return True
+
+    def _aero_read(self, args):
+        def read(fname):
+            self.bem.aero(fname)
+        if args:
+            read(args[0])
+        else:
+            self.__wait(read)
+        return True
+
+    def _top_impo(self, args):
+        def read(fname):
+            with open(fname, mode="rb") as f:
+                self.key = f.read()
+            lines = self.key.decode("ascii").splitlines()
+            tipr, hubr, sn = lines[1].split()
+            table = np.array([l.split() for l in lines[2:2 + int(sn)]], dtype=float)
+            self.geometry = (float(tipr), float(hubr), table[:, 0], table[:, 1], table[:, 2])
+        def blades(value):
+            self.bem.nb = int(value)
+        if args:
+            read(args[0])
+        else:
+            self.__wait(read)
+        self.__wait(blades)
+        #設計進行速度は使わない
+        self.__wait(lambda value: None)
+        return True
+
+    def _top_dens(self, args):
+        def dens(value):
+            self.bem.dens = float(value)
+        if args:
+            dens(args[0])
+        else:
+            self.__wait(dens)
+        return True
+
+    def _top_oper(self, args):
+        self.__menu = "oper"
+        return True
+
+    def _top_quit(self, args):
+        return False
+
+    #---operメニュー---
+    def _oper_(self, args):
+        self.__menu = "top"
+        return True
+
+    def _oper_n(self, args):
+        def stations(value):
+            self.bem.n = int(value)
+        if args:
+            stations(args[0])
+        else:
+            self.__wait(stations)
+        return True
+
+    def _oper_velo(self, args):
+        def velo(value):
+            self.velo = float(value)
+        if args:
+            velo(args[0])
+        else:
+            self.__wait(velo)
+        return True
+
+    def _oper_rpm(self, args):
+        def rpm(value):
+            self.rpm = float(value)
+        if args:
+            rpm(args[0])
+        else:
+            self.__wait(rpm)
+        return True
+
+    def _oper_addc(self, args):
+        if self.random("hang") < self.hang:
+            time.sleep(self.hang_time)
+        if self.latency > 0:
+            time.sleep(self.latency * (1.0 + self.jitter * (2.0 * self.random("latency") - 1.0)))
+        self.cases.append((self.velo, self.rpm))
+        return True
+
+    def _oper_vseq(self, args):
+        #速度の範囲の入力3つは既定値のまま読み飛ばす
+        self.__wait(lambda value: None, 3)
+        return True
+
+    def _oper_clrc(self, args):
+        self.cases = []
+        return True
+
+    def _oper_cput(self, args):
+        def write(fname):
+            text = self.table()
+            if fname:
+                with open(fname, mode="w") as f:
+                    f.write(text)
+            else:
+                self.out.write(text)
+                self.out.flush()
+        if args:
+            write(args[0])
+        else:
+            self.__wait(write)
+        return True
+
+    def table(self):
+        """
+        解析ケースの表をcputと同じ形式の文字列で返す
+        """
+        lines = [" XROTOR  fake", " ", "#" + "".join("{0:>13}".format(c) for c in CPUT_COLUMNS)]
+        diverged = self.random("diverge") < self.diverge
+        for velo, rpm in self.cases:
+            if self.geometry is None or self.bem.sections is None:
+                continue
+            tipr, hubr, radii, chords, betas = self.geometry
+            row = self.bem.solve([chords], [betas], radii, tipr, hubr, [rpm], velo)[0, 0]
+            cells = ["{0:13.5g}".format(v) for v in row]
+            if diverged or not np.isfinite(row).all():
+                cells[-1] = "     ********"
+            lines.append(" " + "".join(cells))
+        return "\n".join(lines) + "\n"
+
+def options(argv=None):
+    """
+    コマンドライン引数と環境変数から設定を読む
+    """
+    env = lambda name, default: type(default)(os.environ.get("FAKE_XROTOR_" + name.upper(), default))
+    parser = argparse.ArgumentParser(description="deterministic stand-in for xrotor.exe")
+    parser.add_argument("--latency", type=float, default=env("latency", 0.0))
+    parser.add_argument("--jitter", type=float, default=env("jitter", 0.0))
+    parser.add_argument("--startup", type=float, default=env("startup", 0.0))
+    parser.add_argument("--diverge", type=float, default=env("diverge", 0.0))
+    parser.add_argument("--hang", type=float, default=env("hang", 0.0))
+    parser.add_argument("--hang-time", type=float, default=env("hang_time", 3600.0))
+    parser.add_argument("--seed", type=int, default=env("seed", 0))
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    opt = options(argv)
+    fake = FakeXrotor(opt.latency, opt.jitter, opt.startup, opt.diverge, opt.hang, opt.hang_time, opt.seed)
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        if not fake.feed(line):
+            break
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+島モデルのGA
+個体群を複数の島に分け、島ごとに別のプロセスで進化させる。
+interval世代ごとに各島の上位migrants個体を隣の島へ送り(移住)、
+届いている個体で自分の島の下位個体を置き換える。
+上位、下位は非優越ソートのランク(同じフロントの中は混雑距離)で決めるので、
+多目的(NSGA-III)の島でも1つ目の目的だけで選ぶことはない(rankedを参照)。
+送受信はキューへの書き込みと届いている分の読み出しだけで他の島を待たないので、
+島の間で全体の同期は取らない。
+
+各島はnsga3.mainをそのまま実行するので、評価の並列化(parallel, thread)も島ごとに行われる。
+同時に使うコア数はおよそ 島の数 × thread になる。
+archive_file、checkpoint_file、cache_fileは島ごとに別のファイル名にする。
+途中からの再開には対応していない。
+
+    python island.py [島の数] [ring or full]
+"""
+import os
+import sys
+import copy
+import queue
+import random
+import numpy as np
+from multiprocessing import Process, Queue
+from deap import tools
+
+def ranked(individuals, k):
+    """
+    非優越ソートのランクが良い順にk個体を選ぶ
+    最後に入るフロントからは混雑距離が大きい個体を残す(tools.selNSGA2と同じ)
+    1目的ならselBestと同じ個体が選ばれる
+    """
+    return tools.selNSGA2(individuals, k)
+
+class Migration(object):
+    """
+    1つの島の移住を受け持つクラス
+    nsga3.migrationに設定すると、世代ごとにnsga3.migrateから呼ばれる
+
+    # attributes
+        - index(int)
+            島の番号
+        - inboxes(Queue list)
+            各島の受信キュー
+        - topology(str)
+            "ring" : 次の番号の島へ送る
+            "full" : 他の全ての島へ送る
+        - interval(int)
+            移住の間隔[世代]
+        - migrants(int)
+            1回に送る個体数
+        - sent, received(int)
+            送った個体数、受け取った個体数
+    # method
+        - neighbors
+            送り先の島の番号のリスト
+        - exchange(gen, pop)
+            移住を行い、新しい個体群を返す
+    """
+    def __init__(self, index, inboxes, topology="ring", interval=10, migrants=5):
+        if topology not in ("ring", "full"):
+            raise Exception("unknown topology: {0}".format(topology))
+        self.index = index
+        self.inboxes = inboxes
+        self.topology = topology
+        self.interval = interval
+        self.migrants = migrants
+        self.sent = 0
+        self.received = 0
+
+    def neighbors(self):
+        n = len(self.inboxes)
+        if self.topology == "ring":
+            return [(self.index + 1) % n] if n > 1 else []
+        return [i for i in range(n) if i != self.index]
+
+    def exchange(self, gen, pop):
+        if gen % self.interval == self.interval - 1:
+            #キューへの書き込みは後から別スレッドで行われるので複製して送る
+            emigrants = [copy.deepcopy(ind) for ind in ranked(pop, self.migrants)]
+            for i in self.neighbors():
+                self.inboxes[i].put(emigrants)
+                self.sent += len(emigrants)
+        #届いている分だけ受け取る(待たない)
+        immigrants = []
+        while True:
+            try:
+                immigrants.extend(self.inboxes[self.index].get_nowait())
+            except queue.Empty:
+                break
+        #一度に入れ替えるのは個体群の半分まで(新しく届いたものを優先)
+        immigrants = immigrants[-(len(pop) // 2):]
+        if not immigrants:
+            return pop
+        self.received += len(immigrants)
+        #最後のフロントから混雑した個体を外して入れ替える
+        return ranked(pop, len(pop) - len(immigrants)) + immigrants
+
+def island_path(path, index):
+    #"run.arc" -> "run.island0.arc"
+    root, ext = os.path.splitext(path)
+    return "{0}.island{1}{2}".format(root, index, ext)
+
+def run_island(factory, index, inboxes, results, topology, interval, migrants, mu, seed):
+    """
+    島のプロセスで実行する関数
+    factory()で作ったGAを実行し、(島の番号, 最終世代, logbook)をresultsに入れる
+    """
+    ga = factory()
+    ga.migration = Migration(index, inboxes, topology, interval, migrants)
+    if mu is not None:
+        ga.MU = mu
+    for name in ("archive_file", "checkpoint_file", "cache_file"):
+        if getattr(ga, name, None) is not None:
+            setattr(ga, name, island_path(getattr(ga, name), index))
+    #forkでは親の乱数の状態を引き継ぐので島ごとに初期化し直す
+    seed = None if seed is None else seed + index
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        pop, logbook = ga.main(seed)
+        print("island {0}: sent {1}, received {2}".format(index, ga.migration.sent, ga.migration.received))
+        results.put((index, pop, logbook))
+    finally:
+        #送り先の島が先に終わっていても書き込みの完了を待たない
+        for inbox in inboxes:
+            inbox.cancel_join_thread()
+
+def run_islands(factory, islands=4, topology="ring", interval=10, migrants=5, mu=None, seed=None):
+    """
+    島モデルでGAを実行する
+    # argument
+        - factory(callable)
+            引数なしで呼ぶと設定済みのGA(nsga3の継承クラス)を返す関数やクラス
+            島のプロセスに渡すのでpickleできること
+        - islands(int)
+            島の数
+        - topology(str)
+            "ring" or "full"
+        - interval(int)
+            移住の間隔[世代]
+        - migrants(int)
+            1回に送る個体数
+        - mu(int)
+            島ごとの人口(Noneならfactoryの設定のまま)
+        - seed(int)
+            乱数の種(島ごとにseed + 島の番号を使う)
+    # return
+        - (pop, logbooks)
+            全ての島の最終世代をまとめた個体群(非優越ソートのランク順)と島ごとのlogbook
+    """
+    inboxes = [Queue() for i in range(islands)]
+    results = Queue()
+    procs = [Process(target=run_island,
+                     args=(factory, i, inboxes, results, topology, interval, migrants, mu, seed))
+             for i in range(islands)]
+    for p in procs:
+        p.start()
+    #結果を受け取るためにdeapのクラスを作っておく
+    factory().create()
+    collected = {}
+    try:
+        while len(collected) < islands:
+            try:
+                index, pop, logbook = results.get(timeout=1.0)
+            except queue.Empty:
+                for i, p in enumerate(procs):
+                    if i not in collected and p.exitcode not in (None, 0):
+                        raise Exception("island {0} failed with exit code {1}".format(i, p.exitcode))
+                continue
+            collected[index] = (pop, logbook)
+    finally:
+        for p in procs:
+            if p.exitcode is None and len(collected) < islands:
+                p.terminate()
+            p.join()
+    everyone = [ind for i in range(islands) for ind in collected[i][0]]
+    return ranked(everyone, len(everyone)), [collected[i][1] for i in range(islands)]
+
+if __name__ == "__main__":
+    from main import newnsga3
+    islands = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    topology = sys.argv[2] if len(sys.argv) > 2 else "ring"
+    #人口を島に分ける
+    mu = newnsga3().MU // islands
+    pop, logbooks = run_islands(newnsga3, islands, topology, mu=mu)
+    for k, ind in enumerate(pop[:10]):
+        print("fit" + str(k + 1) + ":" + str(ind.fitness.values))
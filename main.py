@@ -1,10 +1,20 @@
 #author --fujita yuki--
 # -*- coding: utf-8 -*-
 from nsga3_base import nsga3
-from xrotor import Xrotor
+from xrotor import Xrotor, AsyncXrotor, XrotorBatch, CputError, parse_cput, read_cput, open_sessions, close_sessions, adaptive_timeout
 from model import RotorModel
+from workspace import scratch
+from bem import BEM
+from cache import EvaluationCache
+from surrogate import Surrogate
+from archive import RunArchive
 from scipy import interpolate
-import sys,os
+from scipy.optimize import minimize
+import metrics
+import sys,os,time
+import threading
+from functools import partial
+from collections import Counter
 import numpy as np
 
 #ディープ
@@ -57,8 +67,9 @@ from deap import tools
 設計諸元において効率が最大となるプロペラの形状モデルファイルを作成するプログラム
 最適化は遺伝的アルゴリズムを用いている。
 最適化のアルゴリズムはnsga3_base.pyから継承している。
-各世代ごとの最適解をbestRotorgen[世代数].txtとして出力し、
-各世代において暫定最適解複数候補をbestRotor[0~199].txtとして出力する。
+各世代の全個体の遺伝子と評価値をrun.arcに追記していき、
+archive.pyで任意の世代、順位の個体のモデルファイルを書き出せる。
+最終世代の暫定最適解複数候補はbestRotor[1~200].txtとして出力する。
 
 プロペラの性能計算はcrotorを使用している。
 http://www.esotec.org/sw/crotor.html
@@ -71,6 +82,25 @@ self.aerofに指定した翼型モデルファイルは
 http://web.mit.edu/drela/Public/web/xrotor/xrotor_doc.txt
 のAERO欄を参照
 """
+class Outcome(tuple):
+    """
+    評価値に解析の結果の種類などを付けたタプル
+    プロセスプールのワーカからも評価値と一緒に返せるようにするためのもの
+    # attributes
+        - status(str)
+            "ok", "timeout"(xrotorが時間内に終わらなかった), "failed"(それ以外の失敗)
+        - penalty(float)
+            評価値に含まれるペナルティ
+        - timings(dict)
+            段階ごとの所要時間(metrics.evaluationを参照、計測しないときはNone)
+    """
+    def __new__(cls, values, status="ok", penalty=0.0, timings=None):
+        obj = tuple.__new__(cls, values)
+        obj.status = status
+        obj.penalty = penalty
+        obj.timings = timings
+        return obj
+
 class newnsga3(nsga3):
     def __init__(self):
         super().__init__()
@@ -102,11 +132,88 @@ class newnsga3(nsga3):
         self.MUTPB = 0.5#突然変異の確立(1を100%とする)
         self.cx_eta = 20
         self.mut_eta = 20
-        self.thread = 1
+        self.thread = None#並列数(Noneなら論理コア数)
+        self.parallel = "thread"#"serial", "thread", "process", "asyncio", "broker"
+        self.solver_limit = None#parallel="asyncio"のときに同時に起動するxrotorの数
+        self.batch_size = 1#1回のxrotor起動で解析する個体数
+        #Trueならcputをファイルに書かず標準出力から読む
+        self.cput_stdout = False
+        #代理モデルによる子個体の事前選別
+        self.use_surrogate = False
+        self.surrogate_fraction = 0.3#予測が良い順に解析する割合
+        self.surrogate_explore = 0.1#残りから無作為に解析する割合
+        self.surrogate_min = 100#選別を始める評価済み個体数
+        #上位個体の局所探索(メメティックGA)
+        self.memetic = False
+        self.memetic_interval = 10#局所探索を行う世代の間隔
+        self.memetic_top = 4#局所探索する上位個体の数
+        self.memetic_maxfev = 50#1個体あたりの局所探索の評価回数
+        self.memetic_budget = 5000#局所探索の評価回数の合計の上限
+        self.memetic_used = 0
+        #解析の忠実度(半径方向の解析点数Xrotor.n)の切り替え
+        self.multi_fidelity = False
+        self.coarse_n = 10#粗い解析の解析点数
+        self.fine_n = 30#詳細な解析の解析点数(xrotorの既定値)
+        self.coarse_generations = 50#粗い解析だけで進める世代数
+        self.fidelity_promote = 0.3#以降の世代で粗い解析の上位から詳細な解析に回す子個体の割合
+        #各世代の個体群の保存先(Noneなら保存しない)
+        self.archive_file = "run.arc"
+        #途中経過の保存
+        self.checkpoint_file = "checkpoint.pkl"
+        self.checkpoint_interval = 10
+        #xrotorを常駐させて使い回すか
+        self.session = True
+        #解析時間の分布からタイムアウトを決めるか(xrotor.AdaptiveTimeoutを参照)
+        self.adaptive_timeout = True
+        self.timeout_quantile = 0.99
+        self.timeout_multiple = 3.0#所要時間のquantileの何倍をタイムアウトにするか
+        self.timeout_floor = 0.5#タイムアウトの下限[s]
+        self.timeout_ceiling = 7.0#タイムアウトの上限[s](学習前はこの値)
+        #評価の段階ごとの所要時間の計測(metrics.pyを参照)
+        self.metrics = False
+        self.metrics_file = "metrics.jsonl"#世代ごとの集計の保存先(Noneなら保存しない)
+        #解析エンジン
+        #"xrotor" : xrotor.exeで1個体ずつ解析
+        #"bem" : bem.pyで個体群をまとめてプロセス内で解析
+        self.engine = "xrotor"
+        #評価値のキャッシュ
+        self.use_cache = True
+        self.cache_tol = 1e-6#遺伝子の量子化幅
+        self.cache_size = 100000
+        self.cache_file = None#保存先(Noneなら保存しない)
+        #早期終了(convergence.pyを参照 Noneの条件は使わない)
+        self.stagnation_window = None#この世代数の間、最良の効率が改善しなければ終了(例えば50)
+        self.stagnation_tol = 1e-4#改善とみなす最良の効率の変化(相対)
+        self.target_efficiency = None#この効率(ペナルティを引いた値)に達したら終了
+        self.max_time = None#実行時間の上限[s]
+        self.max_evals = None#評価回数の上限
 
     def setup(self):
         super().setup()
         self.toolbox.register("select", tools.selTournament,  tournsize = 10)
+        #選択がトーナメントなので定常状態GAの生存選択はエリート保存にする
+        self.toolbox.register("replace", tools.selBest)
+        if self.engine == "bem":
+            self.bem = BEM(self.b, self.aerof)
+        if self.use_surrogate:
+            self.surrogate = Surrogate(self.BOUND_LOW, self.BOUND_UP, self.weights)
+        if self.parallel == "asyncio":
+            AsyncXrotor.limit = self.solver_limit or self.thread
+        self.configure_timeout()
+        if self.target_efficiency is not None:
+            #obj1 = -効率 + ペナルティ
+            self.target = (-self.target_efficiency,)
+        self.outcomes = Counter()
+        #定常状態GAでは評価がドライバ側の複数のスレッドから呼ばれるので集計をロックする
+        self.tally_lock = threading.Lock()
+        metrics.enabled = self.metrics
+        self.collector = metrics.Collector()
+        self.eval_time = 0.0
+        if self.use_cache:
+            #キャッシュするのはペナルティ込みの評価値なので、評価値を変える入力は全て条件に含める
+            conditions = (self.engine, self.rpm1, self.rpm2, self.velo, self.aerof, self.tipr, self.hubr,
+                          self.b, self.fs, tuple(self.r_R), self.T1, self.T2)
+            self.cache = EvaluationCache(conditions, self.cache_tol, self.cache_size, self.cache_file)
 
     def beauty(self,x,y):
         yd = [(y[i+1] - y[i])/(x[i+1] - x[i]) for i in range(len(x)-1)]
@@ -124,39 +231,65 @@ class newnsga3(nsga3):
         x, y = interpolate.splev(u,tck)
         return x, y
 
-    def evaluate(self,individual):
-        #プロセスid取得(並列処理用)
-        id = os.getpid()
-
+    def model(self, individual):
         #rotorモデル作成
         chords = individual[:int(len(individual)/2)]
         betas = individual[int(len(individual)/2):]
         radii = [a * self.tipr for a in self.r_R]
-        rotorf = "rotor" + str(id)
-        resultf = "res" + str(id)
+        return RotorModel("dumrotor", self.tipr, self.hubr, self.sn, radii, chords, betas)
 
-        rm = RotorModel("dumrotor" + str(id), self.tipr, self.hubr, self.sn, radii, chords, betas)
-        rm.writefile(rotorf)
+    def xrotor(self, rotorf, resultf, cls=Xrotor, n=None):
         #xrotorコマンド設定
-        xr = Xrotor(self.b, self.fs)
+        xr = cls(self.b, self.fs)
         xr.aero(self.aerof)
         xr.impo(rotorf)
+        #常駐xrotorでは前の設計の解析点数が残るので毎回指定する
+        if n is not None:
+            xr.n = n
         xr.velo = self.velo
         xr.rpm = self.rpm1
         xr.oper()
         xr.rpm = self.rpm2
         xr.oper()
-        xr.cput(resultf)
-        res = xr.call(timeout = 7)
-        penalty = 0
+        xr.cput(None if self.cput_stdout else resultf)
+        return xr
+
+    def configure_timeout(self):
+        #このプロセスのタイムアウト制御に設定を反映する
+        adaptive_timeout.enabled = self.adaptive_timeout
+        adaptive_timeout.quantile = self.timeout_quantile
+        adaptive_timeout.multiple = self.timeout_multiple
+        adaptive_timeout.floor = self.timeout_floor
+        adaptive_timeout.ceiling = self.timeout_ceiling
+
+    def status(self, res, result):
+        #解析の結果の種類(統計ではタイムアウトとそれ以外の失敗を分けて数える)
+        if res is None:
+            return "timeout"
+        return "ok" if result is not None else "failed"
+
+    def result(self, res, resultf):
+        #xrotorの出力からcputの表を読む(失敗時はNone)
         try:
             if res == None:
+                raise CputError("failed to complete xrotor")
+            if self.cput_stdout:
+                return parse_cput(res[0], ncase=2)
+            return read_cput(resultf, ncase=2)
+        except CputError as e:
+            print(e)
+            return None
+
+    def objective(self, result):
+        #cputの表から評価値を計算(失敗時はresult=None)
+        penalty = 0
+        try:
+            if result is None:
                 raise Exception("failed to complete xrotor")
             else:
-                result = np.loadtxt(resultf, skiprows=3)
-                eff = result[0][-1]
-                T1 = result[0][10]
-                T2 = result[1][10]
+                eff = result["Efficiency"][0]
+                T1 = result["T"][0]
+                T2 = result["T"][1]
                 #ペナルティ
                 if T1 < self.T1:
                     penalty += (self.T1 - T1)
@@ -168,15 +301,6 @@ class newnsga3(nsga3):
             T = -1
             penalty += 10
 
-        try:
-            os.remove(rotorf)
-        except Exception as e:
-            print(e)
-        try:
-            os.remove(resultf)
-        except Exception as e:
-            print(e)
-
         #目的値
         obj1 = -eff + penalty
         #x, y = self.spline(radii,chords,100)
@@ -185,10 +309,400 @@ class newnsga3(nsga3):
         #obj3 = self.beauty(x, y)
 
 
-        return (obj1,)
+        return Outcome((obj1,), penalty=penalty)
+
+    def evaluate(self,individual):
+        with metrics.evaluation() as timings:
+            #評価ごとに一意な作業ディレクトリ(抜けるときにファイルごと削除)
+            with scratch() as ws:
+                rotorf = os.path.join(ws, "rotor")
+                resultf = os.path.join(ws, "res")
+                with metrics.phase("write"):
+                    self.model(individual).writefile(rotorf)
+                xr = self.xrotor(rotorf, resultf, n=self.fidelity(individual))
+                res = xr.call()
+                with metrics.phase("parse"):
+                    result = self.result(res, resultf)
+        fit = self.objective(result)
+        fit.status = self.status(res, result)
+        fit.timings = timings
+        return fit
+
+    async def evaluate_async(self, individual):
+        """
+        evaluateのコルーチン版
+        xrotorをasyncioのサブプロセスとして起動し、待ち時間にスレッドを占有しない
+        """
+        with metrics.evaluation() as timings:
+            with scratch() as ws:
+                rotorf = os.path.join(ws, "rotor")
+                resultf = os.path.join(ws, "res")
+                with metrics.phase("write"):
+                    self.model(individual).writefile(rotorf)
+                xr = self.xrotor(rotorf, resultf, AsyncXrotor, self.fidelity(individual))
+                res = await xr.call()
+                with metrics.phase("parse"):
+                    result = self.result(res, resultf)
+        fit = self.objective(result)
+        fit.status = self.status(res, result)
+        fit.timings = timings
+        return fit
+
+    def evaluate_chunk(self, individuals):
+        """
+        個体のリストを1回のxrotor起動でまとめて評価する
+        """
+        fitnesses = [None] * len(individuals)
+        for n, idx in self.by_fidelity(individuals):
+            with metrics.evaluation() as timings:
+                batch = XrotorBatch(self.b, self.fs, self.aerof, self.velo, [self.rpm1, self.rpm2], n)
+                results = batch.run([self.model(individuals[i]) for i in idx])
+            for i, result, status in zip(idx, results, batch.status):
+                fitnesses[i] = self.objective(result)
+                fitnesses[i].status = status
+            #まとめて計測した時間は先頭の個体に付ける
+            fitnesses[idx[0]].timings = timings
+        return fitnesses
+
+    def evaluate_batch(self, individuals):
+        """
+        BEMで個体群をまとめて評価する
+        評価値の定義はevaluateと同じ
+        # return
+            - fitnesses(tuple list)
+                evaluateの戻り値を個体の数だけ並べたもの
+        """
+        if len(individuals) == 0:
+            return []
+        if len(self.by_fidelity(individuals)) > 1:
+            #忠実度ごとに分けて解析
+            fitnesses = [None] * len(individuals)
+            for n, idx in self.by_fidelity(individuals):
+                for i, fit in zip(idx, self.evaluate_batch([individuals[i] for i in idx])):
+                    fitnesses[i] = fit
+            return fitnesses
+        with metrics.evaluation() as timings:
+            genes = np.array(individuals, dtype=float)
+            radii = [a * self.tipr for a in self.r_R]
+            with metrics.phase("bem"):
+                result = self.bem.solve(genes[:, :self.sn], genes[:, self.sn:], radii,
+                                        self.tipr, self.hubr, [self.rpm1, self.rpm2], self.velo,
+                                        self.fidelity(individuals[0]))
+        eff = result[:, 0, -1]
+        T1 = result[:, 0, 10]
+        T2 = result[:, 1, 10]
+        #ペナルティ
+        penalty = np.maximum(self.T1 - T1, 0) + np.maximum(self.T2 - T2, 0)
+        #収束しなかった個体はxrotorの失敗時と同じ扱い
+        failed = np.isnan(result).any(axis=(1, 2))
+        eff = np.where(failed, 0, eff)
+        penalty = np.where(failed, 10, penalty)
+        fitnesses = [Outcome((float(obj1),), "failed" if f else "ok", float(p))
+                     for obj1, f, p in zip(-eff + penalty, failed, penalty)]
+        #まとめて計測した時間は先頭の個体に付ける
+        fitnesses[0].timings = timings
+        return fitnesses
+
+    def fidelity(self, individual):
+        #個体の評価値の忠実度(解析点数) 付いていなければNone(解析の既定値)
+        return getattr(individual, "fidelity", None)
+
+    def by_fidelity(self, individuals):
+        #忠実度ごとに個体の添字をまとめる
+        groups = {}
+        for i, ind in enumerate(individuals):
+            groups.setdefault(self.fidelity(ind), []).append(i)
+        return list(groups.items())
+
+    def level(self, gen):
+        #世代genで個体群の評価値をそろえる忠実度(multi_fidelityでなければNone)
+        if not self.multi_fidelity:
+            return None
+        return self.coarse_n if gen < self.coarse_generations else self.fine_n
+
+    def tag(self, individuals, n):
+        #評価する前の個体に忠実度を付ける
+        if n is not None:
+            for ind in individuals:
+                ind.fidelity = n
+
+    def align_fidelity(self, pop, level):
+        """
+        個体群の評価値を忠実度levelにそろえる
+        粗い解析から詳細な解析に切り替わった世代で親を再評価し、
+        選択で忠実度の異なる評価値を比べないようにする
+        # return
+            - nevals(int)
+                再評価した個体数
+        """
+        if level is None:
+            return 0
+        stale = [ind for ind in pop if ind.fitness.valid and self.fidelity(ind) != level]
+        if not stale:
+            return 0
+        self.tag(stale, level)
+        for ind, fit in zip(stale, self.evaluate_all(stale)):
+            ind.fitness.values = fit
+        if self.use_surrogate:
+            #粗い解析で学習した代理モデルは捨てる
+            self.surrogate = Surrogate(self.BOUND_LOW, self.BOUND_UP, self.weights)
+        return len(stale)
+
+    def evaluate_offspring(self, offspring, level):
+        """
+        子個体を評価する
+        multi_fidelityで詳細な解析の世代では、まず全体を粗い解析で評価し、
+        上位fidelity_promoteの割合だけを詳細な解析で評価し直す。
+        残りは淘汰に加えない(粗い評価値と詳細な評価値を比べないため)
+        # return
+            - (offspring, evaluated, nevals)
+                淘汰に加える子個体、評価した個体、評価回数
+        """
+        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+        coarse = level is not None and level != self.coarse_n and len(invalid_ind) > 0
+        self.tag(invalid_ind, self.coarse_n if coarse else level)
+        for ind, fit in zip(invalid_ind, self.evaluate_all(invalid_ind)):
+            ind.fitness.values = fit
+        if not coarse:
+            return offspring, invalid_ind, len(invalid_ind)
+        k = max(1, int(round(len(invalid_ind) * self.fidelity_promote)))
+        promoted = tools.selBest(invalid_ind, k)
+        self.tag(promoted, level)
+        for ind, fit in zip(promoted, self.evaluate_all(promoted)):
+            ind.fitness.values = fit
+        kept = set(id(ind) for ind in promoted)
+        rejected = set(id(ind) for ind in invalid_ind) - kept
+        offspring = [ind for ind in offspring if id(ind) not in rejected]
+        return offspring, promoted, len(invalid_ind) + len(promoted)
 
-    def main(self,seed=None):
-        self.setup()
+    def evaluate_one(self, individual):
+        #解析エンジンによらず1個体を評価
+        if self.engine == "bem":
+            return self.evaluate_batch([individual])[0]
+        return self.evaluate(individual)
+
+    def refine(self, maxfev, individual):
+        """
+        1個体を初期値として範囲制約付きの局所探索(Powell法)を行う
+        目的関数はペナルティ込みの評価値(weightsで最小化に向きをそろえる)
+        # return
+            - (genes, fitness, nfev)
+                見つかった最良の遺伝子と評価値、評価回数
+        """
+        best = [list(individual), tuple(individual.fitness.values)]
+        sign = -self.weights[0]
+        nfev = [0]
+        def f(x):
+            nfev[0] += 1
+            #元の個体と同じ忠実度で評価する
+            candidate = creator.Individual(x)
+            self.tag([candidate], self.fidelity(individual))
+            fit = self.evaluate_one(candidate)
+            if sign * fit[0] < sign * best[1][0]:
+                best[0], best[1] = list(x), tuple(fit)
+            return sign * fit[0]
+        minimize(f, list(individual), method="Powell", bounds=list(zip(self.BOUND_LOW, self.BOUND_UP)),
+                 options={"maxfev": maxfev, "xtol": 1e-4, "ftol": 1e-6})
+        return best[0], best[1], nfev[0]
+
+    def memetic_step(self, gen, pop):
+        """
+        memetic_interval世代ごとに上位memetic_top個体を並列に局所探索し、
+        改善した遺伝子と評価値を個体群に書き戻す
+        # return
+            - nfev(int)
+                局所探索での評価回数
+        """
+        if not self.memetic or gen % self.memetic_interval != self.memetic_interval - 1:
+            return 0
+        remain = self.memetic_budget - self.memetic_used
+        maxfev = min(self.memetic_maxfev, remain // self.memetic_top)
+        if maxfev <= 0:
+            return 0
+        #同じ遺伝子の個体は1回だけ探索する
+        elites = list({tuple(ind): ind for ind in tools.selBest(pop, len(pop))}.values())[:self.memetic_top]
+        results = self.toolbox.map(partial(self.worker_method("refine"), maxfev), elites)
+        nfev = 0
+        for ind, (genes, fit, n) in zip(elites, results):
+            nfev += n
+            if ind.fitness.values != fit:
+                ind[:] = genes
+                ind.fitness.values = fit
+                if self.use_cache:
+                    self.cache.put(ind, fit)
+        self.memetic_used += nfev
+        return nfev
+
+    def evaluate_all(self, individuals):
+        """
+        個体のリストを評価し、評価値のリストを返す
+        use_cacheならキャッシュにない個体だけ評価する
+        """
+        if self.use_cache:
+            return self.cache.evaluate(individuals, self.evaluate_raw)
+        return self.evaluate_raw(individuals)
+
+    def evaluate_raw(self, individuals):
+        """
+        キャッシュを通さずに個体のリストを評価する
+        """
+        start = time.perf_counter()
+        if self.engine == "bem":
+            fitnesses = self.evaluate_batch(individuals)
+        elif self.batch_size > 1:
+            #batch_size個ずつまとめてワーカに渡す
+            chunks = [individuals[i:i + self.batch_size] for i in range(0, len(individuals), self.batch_size)]
+            results = self.toolbox.map(self.worker_method("evaluate_chunk"), chunks)
+            fitnesses = [fit for chunk in results for fit in chunk]
+        else:
+            fitnesses = list(self.toolbox.map(self.toolbox.evaluate, individuals))
+        #解析の結果の種類を世代ごとに数える
+        with self.tally_lock:
+            self.outcomes.update(getattr(fit, "status", "ok") for fit in fitnesses)
+            self.outcomes["penalized"] += sum(1 for fit in fitnesses if getattr(fit, "penalty", 0) > 0)
+            for fit in fitnesses:
+                self.collector.add(getattr(fit, "timings", None))
+            self.eval_time += time.perf_counter() - start
+        return fitnesses
+
+    def write_metrics(self, gen, record, elapsed):
+        """
+        世代ごとの所要時間の集計をmetrics_fileに1行追記する
+        # argument
+            - record(dict)
+                その世代のlogbookの記録(評価回数、キャッシュの当たり外れ、失敗の数など)
+            - elapsed(float)
+                その世代全体の所要時間[s]
+        """
+        #評価のスレッドが集計中でも取りこぼさないよう、取り出しとリセットはまとめて行う
+        with self.tally_lock:
+            phases = self.collector.summary(reset=True)
+            eval_time, self.eval_time = self.eval_time, 0.0
+        if not self.metrics or self.metrics_file is None:
+            return
+        line = {"gen": gen, "generation_time": elapsed, "evaluation_time": eval_time,
+                "timeout": adaptive_timeout.timeout(), "phases": phases}
+        for key in ("evals", "hits", "misses", "timeouts", "failures", "penalized", "n", "div"):
+            if key in record:
+                line[key] = record[key]
+        if self.stop_reason is not None:
+            line["stop"] = self.stop_reason
+        metrics.write(self.metrics_file, line)
+
+    def init_worker(self):
+        super().init_worker()
+        self.configure_timeout()
+        metrics.enabled = self.metrics
+        if self.session and self.engine == "xrotor":
+            open_sessions()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop("cache", None)
+        state.pop("surrogate", None)
+        state.pop("archive", None)
+        state.pop("tally_lock", None)
+        return state
+
+    def prescreen(self, offspring):
+        """
+        代理モデルで予測した評価値が悪い子個体を取り除く
+        解析に回すのは予測上位とexplore分の無作為な個体だけ
+        """
+        invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+        if not self.use_surrogate or len(self.surrogate) < self.surrogate_min:
+            return offspring
+        selected, rejected = self.surrogate.screen(invalid_ind, self.surrogate_fraction, self.surrogate_explore)
+        rejected = set(id(ind) for ind in rejected)
+        return [ind for ind in offspring if id(ind) not in rejected]
+
+    def log_header(self):
+        header = ("gen", "evals", "hits", "misses", "timeouts", "failures", "penalized") + super().log_header()[2:]
+        if self.multi_fidelity:
+            header = ("gen", "n") + header[1:]
+        return header
+
+    def steady_children(self, parents, gen):
+        return self.prescreen(super().steady_children(parents, gen))
+
+    def evaluate_steady(self, individuals, gen):
+        #定常状態GAでは粗い解析からの選抜はせず、その世代の忠実度で評価する
+        self.tag(individuals, self.level(gen))
+        return self.evaluate_all(individuals)
+
+    def steady_accept(self, individual, gen):
+        #忠実度が切り替わる前に投入した子は個体群と比べられないので捨てる
+        level = self.level(gen)
+        if level is not None and self.fidelity(individual) != level:
+            return False
+        if self.use_surrogate:
+            self.surrogate.add([individual], [individual.fitness.values])
+        return True
+
+    def steady_record(self, gen, pop, logbook, stats, nevals):
+        #次の世代の忠実度に親をそろえる
+        level = self.level(gen + 1)
+        nevals += self.align_fidelity(pop, level)
+        if self.archive is not None:
+            self.archive.append(gen, pop)
+        record = stats.compile(pop)
+        if self.use_cache:
+            record.update(self.cache.counters(reset=True))
+        with self.tally_lock:
+            record.update(timeouts=self.outcomes["timeout"], failures=self.outcomes["failed"],
+                          penalized=self.outcomes["penalized"])
+            self.outcomes.clear()
+        if level is not None:
+            record["n"] = level
+        stop = self.converged(gen, record, [ind.fitness.values for ind in pop], [list(ind) for ind in pop],
+                              nevals, level)
+        logbook.record(gen=gen, evals=nevals, **record)
+        print(logbook.stream)
+        now = time.perf_counter()
+        self.write_metrics(gen, logbook[-1], now - self.steady_mark)
+        self.steady_mark = now
+        return stop
+
+    def evolve_steady(self, seed=None):
+        self.steady_mark = time.perf_counter()
+        pop, logbook = super().evolve_steady(seed)
+        if self.use_cache:
+            self.cache.save()
+        return pop, logbook
+
+    def checkpoint_state(self, gen, pop, logbook):
+        state = super().checkpoint_state(gen, pop, logbook)
+        if self.use_cache:
+            state["cache"] = self.cache
+        if self.use_surrogate:
+            state["surrogate"] = self.surrogate
+        state["memetic_used"] = self.memetic_used
+        return state
+
+    def restore_state(self, state):
+        if "cache" in state:
+            self.cache = state["cache"]
+        if "surrogate" in state:
+            self.surrogate = state["surrogate"]
+        self.memetic_used = state.get("memetic_used", 0)
+
+    def main(self,seed=None,resume=None):
+        if self.session and self.engine == "xrotor":
+            open_sessions()
+        self.archive = None
+        if self.archive_file is not None:
+            meta = {"tipr": self.tipr, "hubr": self.hubr, "r_R": self.r_R}
+            self.archive = RunArchive(self.archive_file, self.MU, self.NDIM, len(self.weights), meta,
+                                      resume=resume is not None)
+        try:
+            return super().main(seed, resume)
+        finally:
+            if self.archive is not None:
+                self.archive.close()
+            if self.session and self.engine == "xrotor":
+                close_sessions()
+
+    def evolve(self,seed=None,state=None):
         # Initialize statistics object
         stats = tools.Statistics(lambda ind: ind.fitness.values)
         stats.register("avg", np.mean, axis=0)
@@ -196,65 +710,96 @@ class newnsga3(nsga3):
         stats.register("min", np.min, axis=0)
         stats.register("max", np.max, axis=0)
 
-        logbook = tools.Logbook()
-        logbook.header = "gen", "evals", "std", "min", "avg", "max"
+        self.memetic_used = 0
+        if state is None:
+            logbook = tools.Logbook()
+            logbook.header = self.log_header()
 
-        #初期化(個体生成のこと)
-        pop = self.toolbox.population(n=self.MU)
+            #初期化(個体生成のこと)
+            pop = self.toolbox.population(n=self.MU)
+            start = 0
+        else:
+            #途中経過から再開
+            pop, logbook, start = state["pop"], state["logbook"], state["gen"] + 1
+            self.restore_state(state)
+        self.start_convergence(state)
 
         #進化の始まり
         # Begin the generational process
-        for gen in range(self.NGEN):
+        for gen in range(start, self.NGEN):
+            gen_start = time.perf_counter()
+            #解析の忠実度(切り替わった世代では親を再評価)
+            level = self.level(gen)
+            nevals = self.align_fidelity(pop, level)
 
             if(gen == 0):
                 #0世代目の評価
                 # Evaluate the individuals with an invalid fitness
                 invalid_ind = [ind for ind in pop if not ind.fitness.valid]
-                fitnesses = self.toolbox.map(self.toolbox.evaluate, invalid_ind)
+                self.tag(invalid_ind, level)
+                fitnesses = self.evaluate_all(invalid_ind)
                 for ind, fit in zip(invalid_ind, fitnesses):
                     ind.fitness.values = fit
+                nevals += len(invalid_ind)
 
             else:
-                offspring = algorithms.varAnd(pop, self.toolbox, self.CXPB, self.MUTPB)
+                offspring = self.vary(pop)
+                offspring = self.prescreen(offspring)
                 #評価
                 # Evaluate the individuals with an invalid fitness
-                invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-                fitnesses = self.toolbox.map(self.toolbox.evaluate, invalid_ind)
-                for ind, fit in zip(invalid_ind, fitnesses):
-                    ind.fitness.values = fit
+                offspring, invalid_ind, n = self.evaluate_offspring(offspring, level)
+                nevals += n
 
                 #淘汰
                 # Select the next generation population from parents and offspring
                 pop = self.toolbox.select(pop + offspring, self.MU)
 
+            #代理モデルの学習データに追加(次の世代で作り直す)
+            if self.use_surrogate:
+                self.surrogate.add(invalid_ind, [ind.fitness.values for ind in invalid_ind])
+
+            #上位個体の局所探索
+            nlocal = self.memetic_step(gen, pop)
+
+            #他の島との移住
+            pop = self.migrate(gen, pop)
+
             #評価
-            pop_fit = np.array([ind.fitness.values for ind in pop])
-            chords = pop[0][:int(len(pop[0])/2)]
-            betas = pop[0][int(len(pop[0])/2):]
-            radii = [a * self.tipr for a in self.r_R]
-            rotorf = "bestRotorgen"+ str(gen)+".txt"
-            rm = RotorModel("bestRotor", self.tipr, self.hubr, self.sn, radii, chords, betas)
-            rm.writefile(rotorf)
+            #全個体の遺伝子と評価値をアーカイブに追記
+            if self.archive is not None:
+                self.archive.append(gen, pop)
             record = stats.compile(pop)
-            k = 0
-            for ind in pop:
-                k += 1
-                chords = ind[:int(len(ind)/2)]
-                betas = ind[int(len(ind)/2):]
-                radii = [a * self.tipr for a in self.r_R]
-                rotorf = "bestRotor" + str(k) + ".txt"
-                rm = RotorModel("bestRotor", self.tipr, self.hubr, self.sn, radii, chords, betas)
-                rm.writefile(rotorf)
             # Compile statistics about the new population
-            logbook.record(gen=gen, evals=len(invalid_ind), **record)
+            if self.use_cache:
+                record.update(self.cache.counters(reset=True))
+            record.update(timeouts=self.outcomes["timeout"], failures=self.outcomes["failed"],
+                          penalized=self.outcomes["penalized"])
+            self.outcomes.clear()
+            if level is not None:
+                record["n"] = level
+            stop = self.converged(gen, record, [ind.fitness.values for ind in pop], [list(ind) for ind in pop],
+                                  nevals + nlocal, level)
+            logbook.record(gen=gen, evals=nevals + nlocal, **record)
             print(logbook.stream)
+            self.write_metrics(gen, logbook[-1], time.perf_counter() - gen_start)
+            self.save_checkpoint(gen, pop, logbook)
+            if stop:
+                self.stop_message(gen)
+                break
 
+        if self.use_cache:
+            self.cache.save()
         return pop, logbook
 
 if __name__ == "__main__":
 
     ng = newnsga3()
-    pop, stats = ng.main()
+    #python main.py resume [チェックポイントファイル] で途中から再開
+    if len(sys.argv) > 2 and sys.argv[1] == "resume":
+        ng.checkpoint_file = sys.argv[2]
+        pop, stats = ng.resume()
+    else:
+        pop, stats = ng.main()
     pop_fit = np.array([ind.fitness.values for ind in pop])
     try:
         k = 0
@@ -2,9 +2,19 @@
 # -*- coding: utf-8 -*-
 """
 main.pyの並列処理用プログラム
+main.pyでもnewnsga3.parallel = "process"とすればプロセスプールで実行できる
+brokerにアドレスを指定すると他のマシンのワーカで評価する(broker.pyを参照)
+use_shared_memory = Trueなら個体を共有メモリでワーカに渡す(sharedpop.pyを参照)
+ワーカは python broker.py worker [host:port] [プロセス数] main_mp で起動する
 """
-from xrotor import Xrotor
+from xrotor import Xrotor, read_cput, open_sessions
 from model import RotorModel
+from workspace import scratch
+from cache import EvaluationCache
+from checkpoint import Checkpoint, load_checkpoint
+from archive import RunArchive
+from broker import BrokerExecutor
+from sharedpop import SharedPopulation, attach
 from scipy import interpolate
 import sys,os
 import numpy as np
@@ -44,6 +54,17 @@ MU = 200#人口の数
 NGEN = 300#世代数
 CXPB = 1.0#交叉の確立(1を100%とする)
 MUTPB = 0.7#突然変異の確立(1を100%とする)
+session = True#xrotorを常駐させて使い回すか
+use_cache = True#評価値のキャッシュを使うか
+cache_tol = 1e-6#遺伝子の量子化幅
+cache_size = 100000
+cache_file = None#キャッシュの保存先(Noneなら保存しない)
+archive_file = "run_mp.arc"#各世代の個体群の保存先(Noneなら保存しない)
+checkpoint_file = "checkpoint_mp.pkl"#途中経過の保存先(Noneなら保存しない)
+checkpoint_interval = 10#途中経過を保存する世代の間隔
+broker = None#分散評価のブローカのアドレス(host, port) Noneならこのマシンのプロセスプール
+workers = 4#プロセスプールの並列数(Noneなら論理コア数)
+use_shared_memory = True#プロセスプールとの遺伝子と評価値の受け渡しに共有メモリを使うか
 
 # Create uniform reference point
 ref_points = tools.uniform_reference_points(NOBJ, P)
@@ -58,63 +79,60 @@ creator.create("Individual", list, fitness=creator.FitnessMin)
 #=====================================================
 #評価関数の定義
 #=====================================================
-def evaluate(individual):
+def analyze(individual):
+    """
+    評価値と制約の値(2つの運転点の推力)を返す
+    解析に失敗したときの推力はnan
+    """
     global tipr, hubr, oT1, oT2, rpm1, rpm2, r_R, sn, b, fs, velo, aerof
-    #プロセスid取得(並列処理用)
-    id = os.getpid()
-
     #rotorモデル作成
     chords = individual[:int(len(individual)/2)]
     betas = individual[int(len(individual)/2):]
     radii = [a * tipr for a in r_R]
-    rotorf = "rotor" + str(id)
-    resultf = "res" + str(id)
-
-    rm = RotorModel("dumrotor" + str(id), tipr, hubr, sn, radii, chords, betas)
-    rm.writefile(rotorf)
-    #xrotorコマンド設定
-    xr = Xrotor(b, fs)
-    xr.aero(aerof)
-    xr.impo(rotorf)
-    xr.velo = velo
-    xr.rpm = rpm1
-    xr.oper()
-    xr.rpm = rpm2
-    xr.oper()
-    xr.cput(resultf)
-    res = xr.call(timeout = 7)
-    penalty = 0
-    try:
-        if res == None:
-            raise Exception("failed to complete xrotor")
-        else:
-            result = np.loadtxt(resultf, skiprows=3)
-            eff = result[0][-1]
-            T1 = result[0][10]
-            T2 = result[1][10]
-            #ペナルティ
-            if T1 < oT1:
-                penalty += (oT1 - T1)
-            if T2 < oT2:
-                penalty += (oT2 - T2)
-    except Exception as e:
-        print(e)
-        eff = 0
-        T = -1
-        penalty += 10
 
-    try:
-        os.remove(rotorf)
-    except Exception as e:
-        print(e)
-    try:
-        os.remove(resultf)
-    except Exception as e:
-        print(e)
+    #評価ごとに一意な作業ディレクトリ(抜けるときにファイルごと削除)
+    with scratch() as ws:
+        rotorf = os.path.join(ws, "rotor")
+        resultf = os.path.join(ws, "res")
+        rm = RotorModel("dumrotor", tipr, hubr, sn, radii, chords, betas)
+        rm.writefile(rotorf)
+        #xrotorコマンド設定
+        xr = Xrotor(b, fs)
+        xr.aero(aerof)
+        xr.impo(rotorf)
+        xr.velo = velo
+        xr.rpm = rpm1
+        xr.oper()
+        xr.rpm = rpm2
+        xr.oper()
+        xr.cput(resultf)
+        res = xr.call()
+        penalty = 0
+        try:
+            if res == None:
+                raise Exception("failed to complete xrotor")
+            else:
+                result = read_cput(resultf, ncase=2)
+                eff = result["Efficiency"][0]
+                T1 = result["T"][0]
+                T2 = result["T"][1]
+                #ペナルティ
+                if T1 < oT1:
+                    penalty += (oT1 - T1)
+                if T2 < oT2:
+                    penalty += (oT2 - T2)
+        except Exception as e:
+            print(e)
+            eff = 0
+            T1 = T2 = np.nan
+            penalty += 10
 
     #目的値
     obj1 = -eff + penalty
-    return (obj1,)
+    return (obj1, T1, T2)
+
+def evaluate(individual):
+    return analyze(individual)[:NOBJ]
 #いじるのここまで)
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -139,77 +157,136 @@ toolbox.register("select", tools.selTournament,  tournsize = 10)
 #=====================================================
 #最適化アルゴリズム本体
 #=====================================================
-def main():
+def main(resume=None):
     global CXPB, MUTPB, MU, NGEN, tipr, hubr, sn, r_R, toolbox
 
-    #同時並列数(空白にすると最大数になる)
-    pool = Pool(4)
-    toolbox.register("map", pool.map)
-    # Initialize statistics object
-    stats = tools.Statistics(lambda ind: ind.fitness.values)
-    stats.register("avg", np.mean, axis=0)
-    stats.register("std", np.std, axis=0)
-    stats.register("min", np.min, axis=0)
-    stats.register("max", np.max, axis=0)
-
-    logbook = tools.Logbook()
-    logbook.header = "gen", "evals", "std", "min", "avg", "max"
-
-    #初期化(個体生成のこと)
-    pop = toolbox.population(n=MU)
-
-    #進化の始まり
-    # Begin the generational process
-    for gen in range(NGEN):
-
-        if(gen == 0):
-            #0世代目の評価
-            # Evaluate the individuals with an invalid fitness
-            invalid_ind = [ind for ind in pop if not ind.fitness.valid]
-            fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-            for ind, fit in zip(invalid_ind, fitnesses):
-                ind.fitness.values = fit
+    #途中経過の読み込み(乱数の状態も復元される)
+    state = load_checkpoint(resume) if resume is not None else None
+    checkpointer = Checkpoint(checkpoint_file, checkpoint_interval) if checkpoint_file is not None else None
+    archive = None
+    if archive_file is not None:
+        archive = RunArchive(archive_file, MU, NDIM, NOBJ, {"tipr": tipr, "hubr": hubr, "r_R": r_R},
+                             resume=resume is not None)
+
+    #例外で抜けてもプロセスプールと共有メモリを必ず解放する
+    pool = None
+    shared = None
+    try:
+        #同時並列数(空白にすると最大数になる)
+        #各ワーカプロセスで常駐xrotorを使う
+        if broker is not None:
+            pool = BrokerExecutor(broker, initializer=open_sessions if session else None)
+        elif use_shared_memory:
+            #1世代の子の数(MU)分の共有配列 列は評価値と制約の値(analyzeの戻り値)
+            shared = SharedPopulation(MU, NDIM, NOBJ + 2)
+            pool = Pool(workers, initializer=attach,
+                        initargs=(shared.spec(), analyze, open_sessions if session else None))
+        else:
+            pool = Pool(workers, initializer=open_sessions if session else None)
+        toolbox.register("map", pool.map)
+        if shared is not None:
+            evaluate_raw = lambda inds: [tuple(res[:NOBJ]) for res in shared.evaluate(pool.map, inds)]
+        else:
+            evaluate_raw = lambda inds: toolbox.map(toolbox.evaluate, inds)
+        if use_cache:
+            if state is not None and "cache" in state:
+                cache = state["cache"]
+            else:
+                #評価値はペナルティ込みなので、評価値を変える入力は全て条件に含める
+                conditions = (rpm1, rpm2, velo, aerof, tipr, hubr, b, fs, tuple(r_R), oT1, oT2)
+                cache = EvaluationCache(conditions, cache_tol, cache_size, cache_file)
+            evaluate_all = lambda inds: cache.evaluate(inds, evaluate_raw)
+        else:
+            evaluate_all = evaluate_raw
+        # Initialize statistics object
+        stats = tools.Statistics(lambda ind: ind.fitness.values)
+        stats.register("avg", np.mean, axis=0)
+        stats.register("std", np.std, axis=0)
+        stats.register("min", np.min, axis=0)
+        stats.register("max", np.max, axis=0)
+
+        if state is None:
+            logbook = tools.Logbook()
+            logbook.header = "gen", "evals", "hits", "misses", "std", "min", "avg", "max"
 
+            #初期化(個体生成のこと)
+            pop = toolbox.population(n=MU)
+            start = 0
         else:
-            offspring = algorithms.varAnd(pop, toolbox, CXPB, MUTPB)
+            #途中経過から再開
+            pop, logbook, start = state["pop"], state["logbook"], state["gen"] + 1
+
+        #進化の始まり
+        # Begin the generational process
+        for gen in range(start, NGEN):
+
+            if(gen == 0):
+                #0世代目の評価
+                # Evaluate the individuals with an invalid fitness
+                invalid_ind = [ind for ind in pop if not ind.fitness.valid]
+                fitnesses = evaluate_all(invalid_ind)
+                for ind, fit in zip(invalid_ind, fitnesses):
+                    ind.fitness.values = fit
+
+            else:
+                offspring = algorithms.varAnd(pop, toolbox, CXPB, MUTPB)
+                #評価
+                # Evaluate the individuals with an invalid fitness
+                invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
+                fitnesses = evaluate_all(invalid_ind)
+                for ind, fit in zip(invalid_ind, fitnesses):
+                    ind.fitness.values = fit
+
+                #淘汰
+                # Select the next generation population from parents and offspring
+                pop = toolbox.select(pop + offspring, MU)
+
             #評価
-            # Evaluate the individuals with an invalid fitness
-            invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-            fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-            for ind, fit in zip(invalid_ind, fitnesses):
-                ind.fitness.values = fit
-
-            #淘汰
-            # Select the next generation population from parents and offspring
-            pop = toolbox.select(pop + offspring, MU)
-
-        #評価
-        pop_fit = np.array([ind.fitness.values for ind in pop])
-        chords = pop[0][:int(len(pop[0])/2)]
-        betas = pop[0][int(len(pop[0])/2):]
-        radii = [a * tipr for a in r_R]
-        rotorf = "bestRotorgen"+ str(gen)+".txt"
-        rm = RotorModel("bestRotor", tipr, hubr, sn, radii, chords, betas)
-        rm.writefile(rotorf)
-        record = stats.compile(pop)
-        k = 0
-        for ind in pop:
-            k += 1
-            chords = ind[:int(len(ind)/2)]
-            betas = ind[int(len(ind)/2):]
-            radii = [a * tipr for a in r_R]
-            rotorf = "bestRotor" + str(k) + ".txt"
-            rm = RotorModel("bestRotor", tipr, hubr, sn, radii, chords, betas)
-            rm.writefile(rotorf)
-        # Compile statistics about the new population
-        logbook.record(gen=gen, evals=len(invalid_ind), **record)
-        print(logbook.stream)
+            #全個体の遺伝子と評価値をアーカイブに追記
+            if archive is not None:
+                archive.append(gen, pop)
+            record = stats.compile(pop)
+            # Compile statistics about the new population
+            if use_cache:
+                record.update(cache.counters(reset=True))
+            logbook.record(gen=gen, evals=len(invalid_ind), **record)
+            print(logbook.stream)
+            if checkpointer is not None and checkpointer.due(gen):
+                ckpt = {"gen": gen, "pop": pop, "logbook": logbook}
+                if use_cache:
+                    ckpt["cache"] = cache
+                checkpointer.save(ckpt)
 
+        if use_cache:
+            cache.save()
+    finally:
+        if pool is not None:
+            if broker is not None:
+                pool.shutdown()
+            else:
+                pool.close()
+                pool.join()
+        if shared is not None:
+            shared.close()
+        if checkpointer is not None:
+            checkpointer.close()
+        if archive is not None:
+            archive.close()
     return pop, logbook
 
 
+def resume(path=None):
+    """
+    checkpoint_fileから途中経過を読み込み、続きを実行する
+    """
+    return main(checkpoint_file if path is None else path)
+
 if __name__ == "__main__":
-    pop, stats = main()
+    #python main_mp.py resume [チェックポイントファイル] で途中から再開
+    if len(sys.argv) > 2 and sys.argv[1] == "resume":
+        pop, stats = resume(sys.argv[2])
+    else:
+        pop, stats = main()
     pop_fit = np.array([ind.fitness.values for ind in pop])
     try:
         k = 0
@@ -0,0 +1,127 @@
+"""
+評価の各段階の所要時間の計測
+1回の評価をevaluation()で囲み、その中の段階(モデルの書き出し、xrotorの起動、解析、
+結果の読み込み、作業ディレクトリの削除など)をphase(name)で囲むと、
+段階ごとの所要時間[s]が評価ごとの辞書に入る。
+計測はenabledのときだけ行い、無効のときのphaseは何もしないwith文になる。
+
+評価ごとの辞書はmain.Outcome.timingsに入れて返すので、
+プロセスプールのワーカで計測した分も呼び出し元で集計できる。
+呼び出し元ではCollectorで世代ごとにまとめ、writeでJSONL(1行1世代)に書き出す。
+
+    with metrics.evaluation() as timings:
+        with metrics.phase("write"):
+            model.writefile(rotorf)
+"""
+import json
+import time
+import contextvars
+from contextlib import contextmanager
+import numpy as np
+
+#計測するかどうか(enable, disableで切り替える)
+enabled = False
+#ヒストグラムの区切り[s] 1us~100sを1桁4分割
+BUCKETS = 10.0 ** np.arange(-6, 2.01, 0.25)
+#計測中の評価の辞書(スレッドとasyncioのタスクごとに別)
+_current = contextvars.ContextVar("timings", default=None)
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+class _Null(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+_null = _Null()
+
+class _Phase(object):
+    __slots__ = ("name", "timings", "start")
+
+    def __init__(self, name, timings):
+        self.name = name
+        self.timings = timings
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+def phase(name):
+    """
+    計測中の評価があれば、withの中の所要時間をnameに加算する
+    """
+    if not enabled:
+        return _null
+    timings = _current.get()
+    if timings is None:
+        return _null
+    return _Phase(name, timings)
+
+@contextmanager
+def evaluation():
+    """
+    1回の評価の計測
+    中のphaseの所要時間と全体の所要時間("total")が入る辞書を返す(無効のときはNone)
+    """
+    if not enabled:
+        yield None
+        return
+    timings = {}
+    token = _current.set(timings)
+    start = time.perf_counter()
+    try:
+        yield timings
+    finally:
+        timings["total"] = time.perf_counter() - start
+        _current.reset(token)
+
+class Collector(object):
+    """
+    評価ごとの所要時間を集めて段階ごとの分布にまとめるクラス
+
+    # method
+        - add(timings)
+            evaluationの辞書を1つ追加する(Noneは無視)
+        - summary(reset)
+            段階ごとの回数、合計、平均、分位点、最大とヒストグラム(BUCKETSの区切り)の辞書を返す
+            reset=Trueなら返した後に空にする(世代ごとの集計用)
+    """
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, timings):
+        if not timings:
+            return
+        for name, value in timings.items():
+            self.samples.setdefault(name, []).append(value)
+
+    def summary(self, reset=False):
+        phases = {}
+        for name, values in self.samples.items():
+            v = np.asarray(values)
+            p50, p90, p99 = np.percentile(v, [50, 90, 99])
+            hist = np.histogram(np.clip(v, BUCKETS[0], BUCKETS[-1]), bins=BUCKETS)[0]
+            phases[name] = {"count": len(v), "sum": float(v.sum()), "mean": float(v.mean()),
+                            "p50": float(p50), "p90": float(p90), "p99": float(p99),
+                            "max": float(v.max()), "hist": hist.tolist()}
+        if reset:
+            self.samples = {}
+        return phases
+
+def write(path, record):
+    """
+    recordをJSONLのファイルに1行追記する
+    """
+    with open(path, mode="a") as f:
+        f.write(json.dumps(record, default=float) + "\n")
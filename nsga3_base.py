@@ -22,7 +22,14 @@ import sys
 import traceback
 
 #並列処理
-from multiprocessing.dummy import Pool,Value
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from executor import make_executor, call_worker
+from checkpoint import Checkpoint, load_checkpoint
+from selection import sel_nsga3, nsga3_indices
+from population import Population
+from convergence import Convergence
 
 class nsga3(object):
     """
@@ -57,7 +64,32 @@ class nsga3(object):
             突然変異の学習率
             突然変異にmutPolynomialBoundedを指定したときに使用される
         - thread(int)
-            並列処理数
+            並列処理数(Noneなら論理コア数)
+        - parallel(str)
+            並列処理の方式
+            "serial", "thread", "process", "asyncio", "broker"のいずれか
+            詳細はexecutor.make_executorを参照
+        - broker(tuple)
+            parallel="broker"のときのブローカのアドレス(host, port)
+        - checkpoint_file(str)
+            途中経過の保存先(Noneなら保存しない)
+        - checkpoint_interval(int)
+            途中経過を保存する世代の間隔
+        - migration(island.Migration)
+            島モデル(island.py)で実行するときの移住の設定 Noneなら移住しない
+        - steady(bool)
+            Trueなら世代の同期を取らない定常状態GAで進化させる
+            評価が1つ終わるたびに個体群へ入れ、次の子を生成して投入する
+            評価回数の上限はNGEN*MU
+            途中経過の保存と再開には対応していない(main(resume=...)はエラーになる)
+        - select_engine(str)
+            NSGA-IIIの選択の実装
+            "numpy" : selection.sel_nsga3(大きな個体群向け、deapと同じ個体を選ぶ)
+            "deap" : tools.selNSGA3
+        - array_population(bool)
+            Trueなら個体群を配列(population.Population)で持ち、交叉と突然変異を個体群全体にまとめて行う
+            evolveは配列のまま世代を進め(evolve_array)、評価と移住のときだけdeapの個体に変換する
+            evolveをオーバーライドしている継承先ではvaryの交叉と突然変異だけが配列になる
         - weights(tuple)
             (-1.0 or 1.0,)*NOBJ
             評価関数(evaluateメソッドの戻り値)について、
@@ -68,6 +100,21 @@ class nsga3(object):
             evaluateの戻り値が(obj1,obj2,obj3)であるとき、
             obj1、obj3を最大化、obj2を最小化する場合は
             weights = (1.0, -1.0, 1.0)
+        - stagnation_window(int)
+            この世代数の間、最良値(多目的ではハイパーボリューム)が改善しなければ終了する(Noneなら判定しない)
+        - stagnation_tol(float)
+            改善とみなす最良値の変化(相対)
+        - record_hv(bool)
+            Trueならstagnation_windowがNoneでも多目的のハイパーボリューム(hv)をlogbookに記録する
+            hvは目的数と個体数が多いと重いので、停滞の判定に使うときとこれがTrueのときだけ計算する
+        - target(tuple)
+            目標の評価値 全ての目的でこれ以上良い個体が現れたら終了する(Noneなら判定しない)
+        - max_time(float)
+            実行時間の上限[s](Noneなら判定しない)
+        - max_evals(int)
+            評価回数の上限(Noneなら判定しない)
+        - stop_reason(str)
+            NGENより前に終了した理由(convergence.Convergence.stopを参照)
     # method
         - setup
             deapライブラリのtoolboxに必要な関数を登録する
@@ -80,8 +127,37 @@ class nsga3(object):
             - return(array like)
                 サイズNOBJのリストやタプルなど
                 評価値
+        - evaluate_async
+            evaluateのコルーチン版(parallel="asyncio"のとき使用)
+            既定ではevaluateを別スレッドで実行する
+        - evaluate_all
+            個体のリストをまとめて評価する
+        - init_worker
+            parallel="process", "broker"のとき各ワーカプロセスで最初に呼ばれる
         - main
             遺伝的アルゴリズムを実行するメソッド
+        - evolve
+            世代交代型の進化
+        - evolve_array
+            個体群を配列で持つ世代交代型の進化(array_population=True)
+        - vary(pop)
+            algorithms.varAndと同じ手順で子を作る(array_population=Trueなら配列でまとめて行う)
+        - start_convergence(state)
+            収束の指標の計測を始める(再開したときはチェックポイントの履歴を引き継ぐ)
+        - converged(gen, record, values, genes, nevals, fidelity)
+            収束の指標をrecordに追加し、終了条件を満たしたかを返す
+            fidelity(評価値の忠実度)が変わると収束の履歴を取り直す
+        - stop_message(gen)
+            早期終了した理由を表示する
+        - migrate
+            島モデルで実行しているとき、世代ごとに他の島と個体を交換する
+        - evolve_steady
+            定常状態型の進化(steady=True)
+            途中経過の保存には対応していない
+            子の生成、評価、個体群への追加、記録はsteady_children, evaluate_steady,
+            steady_accept, steady_recordで行うので、継承先はこれらをオーバーライドする
+        - resume
+            checkpoint_fileから途中経過を読み込み、続きを実行する
 
     """
     def __init__(self):
@@ -98,27 +174,55 @@ class nsga3(object):
         self.cx_eta = 10
         self.mut_eta = 20
         self.thread = 4
+        self.parallel = "thread"
+        self.broker = ("127.0.0.1", 6000)
+        self.steady = False
+        self.select_engine = "numpy"
+        self.array_population = False
+        self.migration = None
+        self.checkpoint_file = None
+        self.checkpoint_interval = 10
         self.weights = (-1.0)*self.NOBJ
         self.P = 12
+        #早期終了の条件(convergence.pyを参照)
+        self.stagnation_window = None
+        self.stagnation_tol = 1e-6
+        self.record_hv = False
+        self.target = None
+        self.max_time = None
+        self.max_evals = None
+        self.stop_reason = None
         
-    def setup(self):
-        # Create uniform reference point
-        self.ref_points = tools.uniform_reference_points(self.NOBJ, self.P)
-
+    def create(self):
         # Create classes
         creator.create("FitnessMin", base.Fitness, weights=self.weights)
         creator.create("Individual", list, fitness=creator.FitnessMin)
         ##
 
+    def setup(self):
+        # Create uniform reference point
+        self.ref_points = tools.uniform_reference_points(self.NOBJ, self.P)
+
+        self.create()
+
         self.toolbox = base.Toolbox()
         self.toolbox.register("attr_float", self.uniform, self.BOUND_LOW, self.BOUND_UP, self.NDIM)
         self.toolbox.register("individual", tools.initIterate, creator.Individual, self.toolbox.attr_float)
         self.toolbox.register("population", tools.initRepeat, list, self.toolbox.individual)
 
-        self.toolbox.register("evaluate",self.evaluate)
+        if self.parallel in ("process", "broker"):
+            #ワーカ側に複製したオブジェクトのevaluateを呼ぶ
+            self.toolbox.register("evaluate", call_worker, "evaluate")
+        elif self.parallel == "asyncio":
+            self.toolbox.register("evaluate", self.evaluate_async)
+        else:
+            self.toolbox.register("evaluate",self.evaluate)
         self.toolbox.register("mate", tools.cxSimulatedBinaryBounded, low=self.BOUND_LOW, up=self.BOUND_UP, eta=self.cx_eta)
         self.toolbox.register("mutate", tools.mutPolynomialBounded, low=self.BOUND_LOW, up=self.BOUND_UP, eta=self.mut_eta, indpb=1/self.NDIM)
-        self.toolbox.register("select", tools.selNSGA3, ref_points=self.ref_points)
+        select = sel_nsga3 if self.select_engine == "numpy" else tools.selNSGA3
+        self.toolbox.register("select", select, ref_points=self.ref_points)
+        #定常状態GAで子を個体群に入れるときの生存選択
+        self.toolbox.register("replace", select, ref_points=self.ref_points)
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     #(いじるのここから
@@ -127,6 +231,46 @@ class nsga3(object):
     #=====================================================
     def evaluate(self,individual):
         pass
+
+    async def evaluate_async(self, individual):
+        return await asyncio.get_running_loop().run_in_executor(None, self.evaluate, individual)
+
+    def evaluate_all(self, individuals):
+        return self.toolbox.map(self.toolbox.evaluate, individuals)
+
+    #=====================================================
+    #並列処理
+    #=====================================================
+    def start_executor(self):
+        #同時並列数(Noneにすると最大数になる)
+        self.executor = make_executor(self.parallel, self.thread, owner=self, address=self.broker)
+        self.toolbox.register("map", self.executor.map)
+
+    def stop_executor(self):
+        self.executor.shutdown()
+        del self.executor
+        self.toolbox.register("map", map)
+
+    def worker_method(self, name):
+        """
+        executorのmapに渡すためのメソッドを返す
+        parallel="process", "broker"のときはワーカ側のオブジェクトのメソッドを呼ぶ関数になる
+        """
+        if self.parallel in ("process", "broker"):
+            return partial(call_worker, name)
+        return getattr(self, name)
+
+    def init_worker(self):
+        #プロセスプールのワーカではdeapのクラスが未作成のことがある
+        self.create()
+
+    def __getstate__(self):
+        #プロセスプールのワーカへ送れないものを除く
+        state = self.__dict__.copy()
+        for key in ("toolbox", "executor", "checkpointer", "migration", "convergence"):
+            state.pop(key, None)
+        return state
+
     # Toolbox initialization
     def uniform(self,low, up, size=None):
         try:
@@ -139,13 +283,147 @@ class nsga3(object):
     #=====================================================
     #最適化アルゴリズム本体
     #=====================================================
-    def main(self,seed=None):
+    def main(self,seed=None,resume=None):
+        if self.steady and resume is not None:
+            raise ValueError("resume is not supported when steady=True")
         self.setup()
-        #同時並列数(空白にすると最大数になる)
-        self.pool = Pool(self.thread)
-        self.toolbox.register("map", self.pool.map)
+        #途中経過の読み込み(乱数の状態も復元される)
+        state = load_checkpoint(resume) if resume is not None else None
+        self.checkpointer = None
+        if self.checkpoint_file is not None:
+            self.checkpointer = Checkpoint(self.checkpoint_file, self.checkpoint_interval)
+        self.start_executor()
+        try:
+            if self.steady:
+                return self.evolve_steady(seed)
+            return self.evolve(seed, state)
+        finally:
+            self.stop_executor()
+            if self.checkpointer is not None:
+                self.checkpointer.close()
 
-        random.seed(seed)
+    def resume(self, path=None):
+        path = self.checkpoint_file if path is None else path
+        return self.main(resume=path)
+
+    def checkpoint_state(self, gen, pop, logbook):
+        """
+        チェックポイントに保存する状態
+        継承先で保存したいものがあれば追加する
+        """
+        return {"gen": gen, "pop": pop, "logbook": logbook, "convergence": self.convergence}
+
+    def restore_state(self, state):
+        """
+        checkpoint_stateで追加したものを復元する
+        """
+        pass
+
+    def save_checkpoint(self, gen, pop, logbook):
+        #早期終了した世代は間隔に関係なく保存する
+        if self.checkpointer is not None and (self.checkpointer.due(gen) or self.stop_reason is not None):
+            self.checkpointer.save(self.checkpoint_state(gen, pop, logbook))
+
+    def start_convergence(self, state=None):
+        if state is not None and "convergence" in state:
+            self.convergence = state["convergence"]
+        else:
+            self.convergence = Convergence(self.weights, self.BOUND_LOW, self.BOUND_UP)
+        self.convergence.use_hv = self.use_hv()
+        self.convergence.start()
+        self.stop_reason = None
+
+    def converged(self, gen, record, values, genes, nevals, fidelity=None):
+        record.update(self.convergence.update(values, genes, nevals, fidelity))
+        self.stop_reason = self.convergence.stop(self.stagnation_window, self.stagnation_tol, self.target,
+                                                 self.max_time, self.max_evals)
+        return self.stop_reason is not None
+
+    def stop_message(self, gen):
+        print("{0}世代目で終了しました(理由:{1}, 評価回数:{2}, 経過時間:{3:.1f}s)".format(
+            gen, self.stop_reason, self.convergence.evals, self.convergence.elapsed))
+
+    def migrate(self, gen, pop):
+        if self.migration is None:
+            return pop
+        return self.migration.exchange(gen, pop)
+
+    def use_hv(self):
+        #ハイパーボリュームは停滞の判定に使うときか、記録を指定したときだけ計算する
+        return self.NOBJ > 1 and (self.stagnation_window is not None or self.record_hv)
+
+    def log_header(self):
+        #収束の指標(convergence.Convergence.update)の列を含める
+        header = ("gen", "evals", "std", "min", "avg", "max", "dbest", "dmean", "div")
+        return header + ("hv",) if self.use_hv() else header
+
+    def vary(self, pop):
+        if not self.array_population:
+            return algorithms.varAnd(pop, self.toolbox, self.CXPB, self.MUTPB)
+        #配列にまとめて交叉、突然変異し、変化しなかった子は親の複製(付けた属性ごと)に戻す
+        offspring = Population.from_individuals(pop, self.weights).vary(
+            self.BOUND_LOW, self.BOUND_UP, self.CXPB, self.MUTPB, self.cx_eta, self.mut_eta, 1/self.NDIM)
+        return [self.toolbox.clone(ind) if valid else type(ind)(genes.tolist())
+                for ind, genes, valid in zip(pop, offspring.genes, offspring.valid)]
+
+    def evaluate_population(self, pop):
+        """
+        配列の個体群の未評価の個体を評価し、評価した数を返す
+        評価関数にはdeapの個体に変換して渡す
+        """
+        invalid = pop.invalid()
+        if len(invalid):
+            fitnesses = self.evaluate_all(pop.to_individuals(index=invalid))
+            pop.set_values(invalid, [tuple(fit) for fit in fitnesses])
+        return len(invalid)
+
+    def evolve_array(self,seed=None,state=None):
+        stats = tools.Statistics()
+        stats.register("avg", np.mean, axis=0)
+        stats.register("std", np.std, axis=0)
+        stats.register("min", np.min, axis=0)
+        stats.register("max", np.max, axis=0)
+
+        if state is None:
+            random.seed(seed)
+            logbook = tools.Logbook()
+            logbook.header = self.log_header()
+            pop = Population.random(self.MU, self.NDIM, self.BOUND_LOW, self.BOUND_UP, self.weights)
+            start = 0
+        else:
+            pop, logbook, start = state["pop"], state["logbook"], state["gen"] + 1
+            self.restore_state(state)
+        self.start_convergence(state)
+
+        for gen in range(start, self.NGEN):
+            if gen == 0:
+                nevals = self.evaluate_population(pop)
+            else:
+                offspring = pop.vary(self.BOUND_LOW, self.BOUND_UP, self.CXPB, self.MUTPB,
+                                     self.cx_eta, self.mut_eta, 1/self.NDIM)
+                nevals = self.evaluate_population(offspring)
+                #淘汰
+                both = pop.concat(offspring)
+                pop = both.take(nsga3_indices(both.wvalues, self.MU, self.ref_points)[0])
+
+            #他の島との移住(deapの個体でやり取りする)
+            if self.migration is not None:
+                pop = Population.from_individuals(self.migrate(gen, pop.to_individuals()), self.weights)
+
+            record = stats.compile(pop.values)
+            stop = self.converged(gen, record, pop.values, pop.genes, nevals)
+            logbook.record(gen=gen, evals=nevals, **record)
+            print(logbook.stream)
+            self.save_checkpoint(gen, pop, logbook)
+            if stop:
+                self.stop_message(gen)
+                break
+
+        return pop.to_individuals(), logbook
+
+    def evolve(self,seed=None,state=None):
+        if self.array_population:
+            return self.evolve_array(seed, state)
         # Initialize statistics object
         stats = tools.Statistics(lambda ind: ind.fitness.values)
         stats.register("avg", np.mean, axis=0)
@@ -153,35 +431,38 @@ class nsga3(object):
         stats.register("min", np.min, axis=0)
         stats.register("max", np.max, axis=0)
 
-        logbook = tools.Logbook()
-        logbook.header = "gen", "evals", "std", "min", "avg", "max"
+        if state is None:
+            random.seed(seed)
+            logbook = tools.Logbook()
+            logbook.header = self.log_header()
 
-        #初期化(個体生成のこと)
-        pop = self.toolbox.population(n=self.MU)
+            #初期化(個体生成のこと)
+            pop = self.toolbox.population(n=self.MU)
+            start = 0
+        else:
+            #途中経過から再開
+            pop, logbook, start = state["pop"], state["logbook"], state["gen"] + 1
+            self.restore_state(state)
+        self.start_convergence(state)
 
         #進化の始まり
         # Begin the generational process
-        for gen in range(self.NGEN):
+        for gen in range(start, self.NGEN):
 
             if(gen == 0):
                 #0世代目の評価
                 # Evaluate the individuals with an invalid fitness
                 invalid_ind = [ind for ind in pop if not ind.fitness.valid]
-                fitnesses = self.toolbox.map(self.toolbox.evaluate, invalid_ind)
+                fitnesses = self.evaluate_all(invalid_ind)
                 for ind, fit in zip(invalid_ind, fitnesses):
                     ind.fitness.values = fit
 
-                #0世代目の統計
-                # Compile statistics about the population
-                record = stats.compile(pop)
-                logbook.record(gen=0, evals=len(invalid_ind), **record)
-
             else:
-                offspring = algorithms.varAnd(pop, self.toolbox, self.CXPB, self.MUTPB)
+                offspring = self.vary(pop)
                 #評価
                 # Evaluate the individuals with an invalid fitness
                 invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-                fitnesses = self.toolbox.map(self.toolbox.evaluate, invalid_ind)
+                fitnesses = self.evaluate_all(invalid_ind)
                 for ind, fit in zip(invalid_ind, fitnesses):
                     ind.fitness.values = fit
 
@@ -189,16 +470,131 @@ class nsga3(object):
                 # Select the next generation population from parents and offspring
                 pop = self.toolbox.select(pop + offspring, self.MU)
 
+            #他の島との移住
+            pop = self.migrate(gen, pop)
+
             #評価
             pop_fit = np.array([ind.fitness.values for ind in pop])
 
             record = stats.compile(pop)
+            stop = self.converged(gen, record, pop_fit, [list(ind) for ind in pop], len(invalid_ind))
             # Compile statistics about the new population
             logbook.record(gen=gen, evals=len(invalid_ind), **record)
             print(logbook.stream)
+            self.save_checkpoint(gen, pop, logbook)
+            if stop:
+                self.stop_message(gen)
+                break
+
+        return pop, logbook
+
+    def steady_children(self, parents, gen):
+        """
+        定常状態GAで親から評価する子を作る
+        # return
+            - children(list)
+                評価値が無効な子
+        """
+        return [ind for ind in self.vary(parents) if not ind.fitness.valid]
+
+    def evaluate_steady(self, individuals, gen):
+        """
+        定常状態GAで個体を評価し、評価値のリストを返す
+        子の評価が並行して進むよう、ドライバ側のスレッドから呼ばれる
+        継承先の評価の経路(evaluate_all)を通すので、キャッシュなどもそのまま使われる
+        """
+        return self.evaluate_all(individuals)
 
+    def steady_accept(self, individual, gen):
+        """
+        評価が終わった子を個体群に入れるかどうか
+        """
+        return True
+
+    def steady_record(self, gen, pop, logbook, stats, nevals):
+        """
+        定常状態GAでMU回の評価を1世代として記録する
+        # return
+            - stop(bool)
+                終了条件を満たしたか
+        """
+        record = stats.compile(pop)
+        stop = self.converged(gen, record, [ind.fitness.values for ind in pop], [list(ind) for ind in pop], nevals)
+        logbook.record(gen=gen, evals=nevals, **record)
+        print(logbook.stream)
+        return stop
+
+    def evolve_steady(self,seed=None):
+        random.seed(seed)
+        # Initialize statistics object
+        stats = tools.Statistics(lambda ind: ind.fitness.values)
+        stats.register("avg", np.mean, axis=0)
+        stats.register("std", np.std, axis=0)
+        stats.register("min", np.min, axis=0)
+        stats.register("max", np.max, axis=0)
+
+        logbook = tools.Logbook()
+        logbook.header = self.log_header()
+        self.start_convergence()
+
+        #初期個体群だけはまとめて評価する
+        pop = self.toolbox.population(n=self.MU)
+        invalid_ind = [ind for ind in pop if not ind.fitness.valid]
+        fitnesses = self.evaluate_steady(invalid_ind, 0)
+        for ind, fit in zip(invalid_ind, fitnesses):
+            ind.fitness.values = fit
+        if self.steady_record(0, pop, logbook, stats, len(invalid_ind)):
+            self.stop_message(0)
             return pop, logbook
 
+        budget = (self.NGEN - 1) * self.MU
+        submitted = 0
+        evals = 0
+        nevals = 0
+        children = []
+        inflight = {}
+        #evaluate_steadyを並行に呼ぶスレッド(実際の評価はその中でexecutorに投げられる)
+        slots = 1 if self.executor.kind == "serial" else self.executor.workers
+        submitter = ThreadPoolExecutor(slots)
+        try:
+            while evals < budget:
+                gen = evals // self.MU + 1
+                #ワーカが空いている分だけ子を生成して投入
+                while len(inflight) < slots and submitted < budget:
+                    #toolbox.selectは生存選択(NSGA-III)なので、親は個体群から一様に選ぶ
+                    parents = [self.toolbox.clone(ind) for ind in random.sample(pop, 2)]
+                    children = self.steady_children(parents, gen)[:budget - submitted]
+                    if not children:
+                        continue
+                    inflight[submitter.submit(self.evaluate_steady, children, gen)] = children
+                    submitted += len(children)
+
+                #どれか1つ終わるのを待って個体群に入れる
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                stop = False
+                for future in done:
+                    children = inflight.pop(future)
+                    for ind, fit in zip(children, future.result()):
+                        ind.fitness.values = fit
+                        if self.steady_accept(ind, gen):
+                            pop = self.toolbox.replace(pop + [ind], self.MU)
+                        evals += 1
+                        nevals += 1
+                        #MU回の評価を1世代として記録
+                        if evals % self.MU == 0:
+                            if self.steady_record(evals // self.MU, pop, logbook, stats, nevals):
+                                stop = True
+                            nevals = 0
+                            gen = evals // self.MU + 1
+                if stop:
+                    self.stop_message(evals // self.MU)
+                    break
+        finally:
+            #評価中の子は待ってから捨てる
+            submitter.shutdown(wait=True)
+
+        return pop, logbook
+
 if __name__ == "__main__":
     ng = nsga3()
     #翼型最適化開始
@@ -0,0 +1,191 @@
+"""
+配列で持つ個体群
+deapの個体(creator.Individualのリストと評価値のオブジェクト)の代わりに、
+遺伝子を(個体数, NDIM)の連続した配列、評価値を(個体数, NOBJ)の配列で持つ。
+交叉(cxSimulatedBinaryBounded)、突然変異(mutPolynomialBounded)、範囲の処理、
+評価値の有効/無効の管理を個体群全体にまとめて行うので、
+評価が軽いときに目立つ個体ごとの複製と変異の処理時間と、1個体あたりのメモリが減る。
+
+deapの個体との変換(from_individuals, to_individuals)があるので、
+評価や移住などdeapの個体を前提にした処理にはそのまま渡せる。
+乱数はnumpyのGeneratorを使うので、deapの演算子と同じ乱数の種でも同じ子にはならない。
+"""
+import random
+import numpy as np
+from deap import creator
+
+def sbx(a, b, low, up, eta, rng):
+    """
+    SBX交叉(deapのcxSimulatedBinaryBoundedと同じ式)
+    # argument
+        - a, b(ndarray)
+            (組の数, NDIM) 親の組
+        - low, up(ndarray)
+            遺伝子の下限、上限
+        - eta(float)
+        - rng(numpy.random.Generator)
+    # return
+        - (a, b)
+            子の組
+    """
+    #遺伝子ごとに確率0.5で交叉(親が同じ値の遺伝子はそのまま)
+    do = (rng.random(a.shape) <= 0.5) & (np.abs(a - b) > 1e-14)
+    x1 = np.minimum(a, b)
+    x2 = np.maximum(a, b)
+    rand = rng.random(a.shape)
+    flip = rng.random(a.shape) <= 0.5
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        diff = x2 - x1
+        def spread(beta):
+            alpha = 2.0 - beta ** -(eta + 1)
+            return np.where(rand <= 1.0 / alpha, (rand * alpha) ** (1.0 / (eta + 1)),
+                            (1.0 / (2.0 - rand * alpha)) ** (1.0 / (eta + 1)))
+        c1 = 0.5 * (x1 + x2 - spread(1.0 + 2.0 * (x1 - low) / diff) * diff)
+        c2 = 0.5 * (x1 + x2 + spread(1.0 + 2.0 * (up - x2) / diff) * diff)
+    c1 = np.clip(c1, low, up)
+    c2 = np.clip(c2, low, up)
+    return (np.where(do, np.where(flip, c2, c1), a),
+            np.where(do, np.where(flip, c1, c2), b))
+
+def polynomial(x, low, up, eta, indpb, rng):
+    """
+    多項式突然変異(deapのmutPolynomialBoundedと同じ式)
+    # argument
+        - x(ndarray)
+            (個体数, NDIM)
+        - indpb(float)
+            遺伝子ごとの突然変異の確率
+    # return
+        - y(ndarray)
+    """
+    mask = rng.random(x.shape) <= indpb
+    rand = rng.random(x.shape)
+    width = up - low
+    lower = rand < 0.5
+    mut_pow = 1.0 / (eta + 1.0)
+    xy = np.where(lower, 1.0 - (x - low) / width, 1.0 - (up - x) / width)
+    val = np.where(lower, 2.0 * rand + (1.0 - 2.0 * rand) * xy ** (eta + 1),
+                   2.0 * (1.0 - rand) + 2.0 * (rand - 0.5) * xy ** (eta + 1))
+    delta_q = np.where(lower, val ** mut_pow - 1.0, 1.0 - val ** mut_pow)
+    y = np.clip(x + delta_q * width, low, up)
+    return np.where(mask, y, x)
+
+class Population(object):
+    """
+    遺伝子と評価値を配列で持つ個体群
+
+    # attributes
+        - genes(ndarray)
+            (個体数, NDIM) 遺伝子
+        - values(ndarray)
+            (個体数, NOBJ) 評価値(未評価の個体はnan)
+        - valid(ndarray)
+            (個体数,) 評価値が有効かどうか
+        - weights(ndarray)
+            評価値の重み(deapのweightsと同じ)
+    # method
+        - random(n, ndim, low, up, weights, rng)
+            範囲内の一様乱数で個体群を作る
+        - from_individuals(individuals, weights)
+            deapの個体のリストから作る
+        - to_individuals(cls, index)
+            deapの個体のリストに戻す(有効な評価値も設定する)
+        - invalid
+            未評価の個体の添字
+        - set_values(index, values)
+            評価値を設定して有効にする
+        - take(index), concat(other)
+            一部の個体、連結した個体群を返す
+        - vary(low, up, cxpb, mutpb, cx_eta, mut_eta, indpb, rng)
+            algorithms.varAndと同じ手順で子の個体群を作る
+            隣り合う2個体を確率cxpbで交叉し、各個体を確率mutpbで突然変異させ、変化した個体を未評価にする
+    """
+    def __init__(self, genes, values=None, weights=(-1.0,), valid=None):
+        self.genes = np.ascontiguousarray(genes, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        n = len(self.genes)
+        if values is None:
+            values = np.full((n, len(self.weights)), np.nan)
+        self.values = np.ascontiguousarray(values, dtype=float)
+        if valid is None:
+            valid = ~np.isnan(self.values).any(axis=1)
+        self.valid = np.asarray(valid, dtype=bool)
+
+    def __len__(self):
+        return len(self.genes)
+
+    @property
+    def wvalues(self):
+        #大きいほど良い評価値(deapのwvaluesと同じ)
+        return self.values * self.weights
+
+    @classmethod
+    def random(cls, n, ndim, low, up, weights, rng=None):
+        rng = generator() if rng is None else rng
+        low = np.broadcast_to(np.asarray(low, dtype=float), (ndim,))
+        up = np.broadcast_to(np.asarray(up, dtype=float), (ndim,))
+        return cls(rng.uniform(low, up, (n, ndim)), weights=weights)
+
+    @classmethod
+    def from_individuals(cls, individuals, weights=None):
+        if weights is None:
+            weights = individuals[0].fitness.weights
+        genes = np.array([list(ind) for ind in individuals], dtype=float)
+        values = np.full((len(individuals), len(weights)), np.nan)
+        for i, ind in enumerate(individuals):
+            if ind.fitness.valid:
+                values[i] = ind.fitness.values
+        return cls(genes, values, weights)
+
+    def to_individuals(self, cls=None, index=None):
+        cls = creator.Individual if cls is None else cls
+        index = range(len(self)) if index is None else index
+        individuals = []
+        for i in index:
+            ind = cls(self.genes[i].tolist())
+            if self.valid[i]:
+                ind.fitness.values = tuple(self.values[i])
+            individuals.append(ind)
+        return individuals
+
+    def invalid(self):
+        return np.flatnonzero(~self.valid)
+
+    def set_values(self, index, values):
+        self.values[index] = np.asarray(values, dtype=float).reshape(len(index), -1)
+        self.valid[index] = True
+
+    def take(self, index):
+        return Population(self.genes[index], self.values[index], self.weights, self.valid[index])
+
+    def concat(self, other):
+        return Population(np.concatenate((self.genes, other.genes)),
+                          np.concatenate((self.values, other.values)),
+                          self.weights, np.concatenate((self.valid, other.valid)))
+
+    def vary(self, low, up, cxpb, mutpb, cx_eta, mut_eta, indpb, rng=None):
+        rng = generator() if rng is None else rng
+        low = np.broadcast_to(np.asarray(low, dtype=float), self.genes.shape[1:])
+        up = np.broadcast_to(np.asarray(up, dtype=float), self.genes.shape[1:])
+        genes = self.genes.copy()
+        changed = np.zeros(len(self), dtype=bool)
+        #(0, 1), (2, 3), ...の組で交叉
+        pairs = len(self) // 2
+        cross = np.flatnonzero(rng.random(pairs) < cxpb) * 2
+        if len(cross):
+            genes[cross], genes[cross + 1] = sbx(genes[cross], genes[cross + 1], low, up, cx_eta, rng)
+            changed[cross] = changed[cross + 1] = True
+        mutate = np.flatnonzero(rng.random(len(self)) < mutpb)
+        if len(mutate):
+            genes[mutate] = polynomial(genes[mutate], low, up, mut_eta, indpb, rng)
+            changed[mutate] = True
+        values = self.values.copy()
+        values[changed] = np.nan
+        return Population(genes, values, self.weights, self.valid & ~changed)
+
+def generator():
+    """
+    randomモジュールの乱数から作ったnumpyのGenerator
+    random.seedやチェックポイントで復元した乱数の状態に従う
+    """
+    return np.random.default_rng(random.getrandbits(64))
@@ -0,0 +1,216 @@
+"""
+numpyで行うNSGA-IIIの選択
+deapのtools.selNSGA3(nd="log")と同じ生存者を同じ順に返す置き換え用の選択演算子。
+selNSGA3は非優越ソートと参照点への関連付けをPythonのループで行うので、
+人口が数千を超えたりbem.pyで評価が軽くなったりすると選択が律速になる。
+
+    - 非優越ソート : 評価値の行列を辞書順に並べ、先にある点だけが後の点を支配できることを使って
+                     ブロックごとの比較行列からランクを求める
+    - 正規化 : 理想点、極値点、切片はdeapと同じ関数で求める
+    - 関連付け : 参照点への垂直距離を行列積1回で求める
+                 最短の参照点が僅差で決まらない個体だけdeapと同じ式で計算し直す
+    - ニッチング : 乱数の使い方(shuffleの順番と長さ)をdeapと揃えているので、
+                   同じ乱数の種なら同じ個体が選ばれる
+"""
+import numpy as np
+from deap.tools.emo import find_extreme_points, find_intercepts, associate_to_niche, NSGA3Memory
+
+#非優越ソートで一度に比較する点の数
+BLOCK = 256
+#関連付けで一度に計算する個体数
+CHUNK = 4096
+#最短と2番目の距離(2乗)の差がこれ以下ならdeapと同じ式で計算し直す
+TIE_TOL = 1e-9
+
+def nondominated_ranks(w):
+    """
+    非優越ソートのランク(0が第1フロント)
+    # argument
+        - w(ndarray)
+            (点の数, 評価値の数) deapのwvaluesと同じく大きいほど良い
+            重複した行を含まず、辞書順の降順に並んでいること
+    # return
+        - rank(ndarray)
+    """
+    n, m = w.shape
+    if m == 1:
+        #1目的なら並び順がそのままランク
+        return np.arange(n, dtype=np.int64)
+    #目的ごとに連続した配列にしておくと比較が速い
+    cols = np.ascontiguousarray(w.T)
+    #ランク+1(0は支配する点がないこと) 最大でもnなので足りる最小の型にする
+    level = np.zeros(n, dtype=np.min_scalar_type(n))
+    for s in range(0, n, BLOCK):
+        e = min(s + BLOCK, n)
+        block = w[s:e]
+        #辞書順で先にある点qが全目的でp以上ならqはpを支配する(重複がないので等号だけにはならない)
+        dom = cols[0, None, :e] >= block[:, 0, None]
+        for j in range(1, m):
+            dom &= cols[j, None, :e] >= block[:, j, None]
+        #支配する点のランクの最大+1
+        r = (dom[:, :s] * level[None, :s]).max(axis=1) if s > 0 else np.zeros(e - s, dtype=level.dtype)
+        #ブロック内の支配関係は変化がなくなるまで伝える
+        inner = np.tril(dom[:, s:e], -1)
+        while True:
+            new = np.maximum(r, (inner * (r + 1).astype(level.dtype)[None, :]).max(axis=1))
+            if np.array_equal(new, r):
+                break
+            r = new
+        level[s:e] = r + 1
+    return level.astype(np.int64) - 1
+
+def sort_nondominated(w, k):
+    """
+    deapのsortLogNondominatedと同じ順に個体を並べる
+    フロントの中は評価値の辞書順の降順、同じ評価値は元の順
+    # argument
+        - w(ndarray)
+            (個体数, 評価値の数) wvaluesの行列
+        - k(int)
+            選ぶ個体数(合計がk以上になるところまでのフロントを返す)
+    # return
+        - fronts(ndarray list)
+            フロントごとの個体の添字
+    """
+    n, m = w.shape
+    order = np.lexsort([np.arange(n)] + [-w[:, j] for j in range(m - 1, -1, -1)])
+    sw = w[order]
+    #同じ評価値をまとめる
+    first = np.ones(n, dtype=bool)
+    first[1:] = np.any(sw[1:] != sw[:-1], axis=1)
+    group = np.cumsum(first) - 1
+    rank = nondominated_ranks(sw[first])[group]
+    counts = np.bincount(rank)
+    last = min(int(np.searchsorted(np.cumsum(counts), k)), len(counts) - 1)
+    sorted_order = order[np.argsort(rank, kind="stable")]
+    bounds = np.concatenate(([0], np.cumsum(counts[:last + 1])))
+    return [sorted_order[bounds[i]:bounds[i + 1]] for i in range(last + 1)]
+
+def associate(fitnesses, ref_points, best_point, intercepts):
+    """
+    個体を最も近い参照方向に関連付ける
+    deapのassociate_to_nicheと同じ値を返す
+    # return
+        - (niches, distances)
+            参照点の添字と、その参照方向までの垂直距離
+    """
+    fn = (fitnesses - best_point) / (intercepts - best_point + np.finfo(float).eps)
+    norm = np.linalg.norm(ref_points, axis=1)
+    unit = ref_points / norm[:, None]
+    niches = np.empty(len(fn), dtype=np.int64)
+    for s in range(0, len(fn), CHUNK):
+        f = fn[s:s + CHUNK]
+        #垂直距離の2乗 = |f|^2 - (f・単位参照ベクトル)^2
+        proj = f @ unit.T
+        d2 = np.sum(f * f, axis=1)[:, None] - proj * proj
+        niches[s:s + CHUNK] = np.argmin(d2, axis=1)
+        if d2.shape[1] > 1:
+            two = np.partition(d2, 1, axis=1)[:, :2]
+            ties = np.flatnonzero(two[:, 1] - two[:, 0] <= TIE_TOL * (1.0 + np.sum(f * f, axis=1)))
+            if len(ties):
+                niches[s + ties] = associate_to_niche(fitnesses[s + ties], ref_points, best_point, intercepts)[0]
+    #選ばれた参照方向までの距離をdeapと同じ式で計算
+    ref = ref_points[niches]
+    proj = np.sum(fn * ref, axis=1) / norm[niches]
+    distances = np.linalg.norm(proj[:, None] * ref / norm[niches][:, None] - fn, axis=1)
+    return niches, distances
+
+def niching(k, niches, distances, niche_counts):
+    """
+    最後のフロントからk個体を選ぶ
+    deapのnichingと同じ順に同じ長さの配列をshuffleする
+    # return
+        - selected(int list)
+            最後のフロントの中での添字
+    """
+    niche_counts = niche_counts.copy()
+    order = np.argsort(niches, kind="stable")
+    starts = np.searchsorted(niches[order], np.arange(len(niche_counts) + 1))
+    members = [order[starts[i]:starts[i + 1]] for i in range(len(niche_counts))]
+    remaining = np.diff(starts)
+    available = np.ones(len(niches), dtype=bool)
+    selected = []
+    while len(selected) < k:
+        n = k - len(selected)
+        available_niches = remaining > 0
+        min_count = np.min(niche_counts[available_niches])
+        selected_niches = np.flatnonzero(np.logical_and(available_niches, niche_counts == min_count))
+        np.random.shuffle(selected_niches)
+        selected_niches = selected_niches[:n]
+        for niche in selected_niches:
+            niche_individuals = members[niche][available[members[niche]]]
+            np.random.shuffle(niche_individuals)
+            #参照点にまだ個体がなければ最も近い個体、あれば無作為に選ぶ
+            if niche_counts[niche] == 0:
+                sel_index = niche_individuals[np.argmin(distances[niche_individuals])]
+            else:
+                sel_index = niche_individuals[0]
+            available[sel_index] = False
+            remaining[niche] -= 1
+            niche_counts[niche] += 1
+            selected.append(sel_index)
+    return selected
+
+def nsga3_indices(w, k, ref_points, best_point=None, worst_point=None, extreme_points=None):
+    """
+    評価値の行列からNSGA-IIIで選ぶ個体の添字を求める
+    population.Populationの個体群はwvaluesをそのまま渡せる
+    # argument
+        - w(ndarray)
+            (個体数, 評価値の数) wvaluesの行列
+        - k, ref_points, best_point, worst_point, extreme_points
+            sel_nsga3と同じ
+    # return
+        - (index, memory)
+            選ぶ個体の添字(sel_nsga3が返す順)とNSGA3Memory
+    """
+    fronts = sort_nondominated(w, k)
+    nd = np.concatenate(fronts)
+    fitnesses = -w[nd]
+
+    if best_point is not None and worst_point is not None:
+        best_point = np.min(np.concatenate((fitnesses, best_point), axis=0), axis=0)
+        worst_point = np.max(np.concatenate((fitnesses, worst_point), axis=0), axis=0)
+    else:
+        best_point = np.min(fitnesses, axis=0)
+        worst_point = np.max(fitnesses, axis=0)
+
+    extreme_points = find_extreme_points(fitnesses, best_point, extreme_points)
+    front_worst = np.max(fitnesses, axis=0)
+    intercepts = find_intercepts(extreme_points, best_point, worst_point, front_worst)
+    niches, dist = associate(fitnesses, ref_points, best_point, intercepts)
+
+    #最後のフロント以外の個体の参照点ごとの数
+    sel_count = len(nd) - len(fronts[-1])
+    niche_counts = np.bincount(niches[:sel_count], minlength=len(ref_points)).astype(np.int64)
+
+    selected = niching(k - sel_count, niches[sel_count:], dist[sel_count:], niche_counts)
+    index = np.concatenate((nd[:sel_count], fronts[-1][np.array(selected, dtype=np.int64)]))
+    return index, NSGA3Memory(best_point, worst_point, extreme_points)
+
+def sel_nsga3(individuals, k, ref_points, best_point=None, worst_point=None,
+              extreme_points=None, return_memory=False):
+    """
+    NSGA-IIIの選択
+    引数と戻り値はdeapのtools.selNSGA3と同じ(ndは"log"のみ)
+    toolbox.register("select", sel_nsga3, ref_points=ref_points)のように使う
+    # argument
+        - individuals(list)
+        - k(int)
+            選ぶ個体数
+        - ref_points(ndarray)
+            tools.uniform_reference_pointsで作った参照点
+        - best_point, worst_point, extreme_points
+            前の世代までの理想点、最悪点、極値点(selNSGA3WithMemoryと同じ)
+    # return
+        - chosen(list)
+            return_memory=Trueなら(chosen, NSGA3Memory)
+    """
+    if k == 0:
+        return ([], None) if return_memory else []
+    w = np.array([ind.fitness.wvalues for ind in individuals], dtype=float)
+    index, memory = nsga3_indices(w, k, ref_points, best_point, worst_point, extreme_points)
+    chosen = [individuals[i] for i in index]
+    if return_memory:
+        return chosen, memory
+    return chosen
@@ -0,0 +1,108 @@
+"""
+共有メモリを使ったプロセスプールへの個体群の受け渡し
+pool.mapに個体をそのまま渡すと、個体ごとにリストと評価値のオブジェクト(とdeapのクラスの参照)を
+pickleして送り、結果もpickleして受け取る。
+このモジュールでは世代の遺伝子をmultiprocessing.shared_memoryの配列に書き込み、
+ワーカは自分の担当する行を直接読んで、評価値と制約の値を共有の結果の配列に書き戻す。
+プロセス間を行き来するのは行の番号だけになる。
+
+同じマシンのプロセスプール専用(broker.pyのように他のマシンのワーカには使えない)。
+
+    shared = SharedPopulation(MU, NDIM, 3)
+    pool = Pool(4, initializer=attach, initargs=(shared.spec(), analyze))
+    results = shared.evaluate(pool.map, individuals)    # (個体数, 3)
+    shared.close()
+"""
+import numpy as np
+from multiprocessing import shared_memory
+
+class SharedPopulation(object):
+    """
+    遺伝子と結果の共有配列を持つクラス(親プロセス側)
+
+    # attributes
+        - capacity(int)
+            1回に書き込める個体数(超えた分は分けて評価する)
+        - ndim(int)
+            遺伝子の数
+        - nres(int)
+            1個体あたりの結果の数(評価値と制約の値)
+        - genes(ndarray)
+            (capacity, ndim) 共有の遺伝子
+        - results(ndarray)
+            (capacity, nres) 共有の結果(評価前はnan)
+    # method
+        - spec
+            ワーカでattachに渡す共有メモリの名前と大きさ
+        - evaluate(map, individuals, chunksize)
+            個体を共有配列に書き込み、map(run_row, 行番号)でワーカに評価させる
+            ## return
+                - results(ndarray)
+                    (個体数, nres) 結果の複製
+        - close
+            共有メモリを解放する
+    """
+    def __init__(self, capacity, ndim, nres):
+        self.capacity = capacity
+        self.ndim = ndim
+        self.nres = nres
+        itemsize = np.dtype(float).itemsize
+        self.__genes = shared_memory.SharedMemory(create=True, size=max(capacity * ndim * itemsize, 1))
+        self.__results = shared_memory.SharedMemory(create=True, size=max(capacity * nres * itemsize, 1))
+        self.genes = np.ndarray((capacity, ndim), dtype=float, buffer=self.__genes.buf)
+        self.results = np.ndarray((capacity, nres), dtype=float, buffer=self.__results.buf)
+
+    def spec(self):
+        return (self.__genes.name, self.__results.name, self.capacity, self.ndim, self.nres)
+
+    def evaluate(self, map, individuals, chunksize=None):
+        results = np.empty((len(individuals), self.nres))
+        for s in range(0, len(individuals), self.capacity):
+            part = individuals[s:s + self.capacity]
+            n = len(part)
+            self.genes[:n] = np.array(part, dtype=float).reshape(n, self.ndim)
+            self.results[:n] = np.nan
+            if chunksize is None:
+                list(map(run_row, range(n)))
+            else:
+                list(map(run_row, range(n), chunksize))
+            results[s:s + n] = self.results[:n]
+        return results
+
+    def close(self):
+        #配列の参照を先に消さないと共有メモリを閉じられない
+        del self.genes, self.results
+        for shm in (self.__genes, self.__results):
+            shm.close()
+            shm.unlink()
+
+#ワーカ側で接続した共有配列と評価関数
+_worker = None
+
+def attach(spec, func, initializer=None):
+    """
+    プロセスプールのinitializerで呼ぶ
+    # argument
+        - spec(tuple)
+            SharedPopulation.specの戻り値
+        - func(callable)
+            遺伝子のリストを受け取り、nres個の値(評価値と制約の値)を返す関数
+        - initializer(callable)
+            一緒に呼ぶワーカの初期化処理(open_sessionsなど)
+    """
+    global _worker
+    genes_name, results_name, capacity, ndim, nres = spec
+    genes_shm = shared_memory.SharedMemory(name=genes_name)
+    results_shm = shared_memory.SharedMemory(name=results_name)
+    genes = np.ndarray((capacity, ndim), dtype=float, buffer=genes_shm.buf)
+    results = np.ndarray((capacity, nres), dtype=float, buffer=results_shm.buf)
+    _worker = (genes_shm, results_shm, genes, results, func)
+    if initializer is not None:
+        initializer()
+
+def run_row(i):
+    """
+    i行目の遺伝子を評価して結果の行に書き込む(戻り値はなし)
+    """
+    genes_shm, results_shm, genes, results, func = _worker
+    results[i] = func(genes[i].tolist())
@@ -1,7 +1,11 @@
 from scipy.optimize import minimize,shgo
+from scipy.stats import qmc
+import sys
 import numpy as np
-from xrotor import Xrotor
+from xrotor import Xrotor, CputError, read_cput
 from model import RotorModel
+from workspace import scratch
+from executor import make_executor
 import os
 """
 ------------------------------------
@@ -51,54 +55,106 @@ r_R = [0.1, 0.3, 0.5, 0.7, 0.9, 1.0]
 sn = len(r_R)
 aerof = "AG14_Re50000.txt"
 T = 3.0
+parallel = "process"#差分勾配の並列化の方式(executor.make_executorを参照)
+workers = None#並列数(Noneなら論理コア数)
+eps = 1e-3#差分勾配の刻み(変数の範囲に対する比)
 
 def function(x):
     global r_R, tipr, hubr, rpm, velo, sn, aerof
     chords = x[:int(len(x)/2)]
     betas = x[int(len(x)/2):]
     radii = [a * tipr for a in r_R]
-    rotorf = "rotordum1.txt"
-    resultf = "resdum1.txt"
-
-    rm = RotorModel("dumrotor", tipr, hubr, sn, radii, chords, betas)
-    rm.writefile(rotorf)
-    #xrotorコマンド設定
-    xr = Xrotor(2, 0.1)
-    xr.aero(aerof)
-    xr.impo(rotorf)
-    xr.velo = velo
-    xr.rpm = rpm
-    xr.oper(resultf)
-    res = xr.call(timeout = 7)
-    try:
-        if res == None:
-            raise Exception("failed to complete xrotor")
-        else:
-            result = np.loadtxt(resultf, skiprows=3)
-            if len(result) != 13:
-                eff = 0
-                t = 0
+    #評価ごとに一意な作業ディレクトリ(抜けるときにファイルごと削除)
+    with scratch() as ws:
+        rotorf = os.path.join(ws, "rotor")
+        resultf = os.path.join(ws, "res")
+        rm = RotorModel("dumrotor", tipr, hubr, sn, radii, chords, betas)
+        rm.writefile(rotorf)
+        #xrotorコマンド設定
+        xr = Xrotor(2, 0.1)
+        xr.aero(aerof)
+        xr.impo(rotorf)
+        xr.velo = velo
+        xr.rpm = rpm
+        xr.oper()
+        xr.cput(resultf)
+        res = xr.call()
+        try:
+            if res == None:
+                raise CputError("failed to complete xrotor")
             else:
-                eff = result[-1]
-                t = result[10]
-    except Exception as e:
-        print(e)
-        eff = 0
-        t = 0
-
-    try:
-        os.remove(rotorf)
-    except Exception as e:
-        print(e)
-    try:
-        os.remove(resultf)
-    except Exception as e:
-        print(e)
+                result = read_cput(resultf, ncase=1)
+                eff = result["Efficiency"][0]
+                t = result["T"][0]
+        except CputError as e:
+            print(e)
+            eff = 0
+            t = 0
 
     return eff, t
 
-fun = lambda x : -function(x)[0]
-cons = ({'type': 'ineq', 'fun': lambda x: function(x)[1]-T})
+class Problem(object):
+    """
+    SLSQPに渡す目的関数、制約、勾配をまとめたクラス
+    目的関数(効率)と制約(推力)は同じ解析結果から計算するので、
+    同じxについてxrotorを何度も実行しないよう結果を記憶する。
+    勾配は前進差分で計算し、刻みを入れた全ての設計を
+    executorでまとめて並列に解析する。
+
+    # attributes
+        - bounds(tuple list)
+            変数の範囲
+        - eps(float)
+            差分の刻み(変数の範囲に対する比)
+        - executor
+            executor.make_executorで作った実行器
+        - nfev(int)
+            xrotorの実行回数
+    # method
+        - fun, jac
+            目的関数(-効率)とその勾配
+        - con, con_jac
+            制約(推力 - T >= 0)とその勾配
+    """
+    def __init__(self, bounds, executor, eps=1e-3):
+        self.bounds = np.array(bounds, dtype=float)
+        self.executor = executor
+        self.eps = eps
+        self.nfev = 0
+        self.__memo = {}
+
+    def __evaluate(self, points):
+        todo = [p for p in dict.fromkeys(tuple(p) for p in points) if p not in self.__memo]
+        for p, r in zip(todo, self.executor.map(function, [np.array(p) for p in todo])):
+            self.__memo[p] = np.array(r, dtype=float)
+        self.nfev += len(todo)
+        return [self.__memo[tuple(p)] for p in points]
+
+    def evaluate(self, x):
+        return self.__evaluate([np.asarray(x, dtype=float)])[0]
+
+    def gradient(self, x):
+        x = np.asarray(x, dtype=float)
+        h = self.eps * (self.bounds[:, 1] - self.bounds[:, 0])
+        #上限を超える変数は後退差分にする
+        h = np.where(x + h > self.bounds[:, 1], -h, h)
+        points = [x] + [x + np.eye(len(x))[i] * h[i] for i in range(len(x))]
+        values = self.__evaluate(points)
+        # (変数の数, 2) 列は効率、推力
+        return (np.array(values[1:]) - values[0]) / h[:, None]
+
+    def fun(self, x):
+        return -self.evaluate(x)[0]
+
+    def jac(self, x):
+        return -self.gradient(x)[:, 0]
+
+    def con(self, x):
+        return self.evaluate(x)[1] - T
+
+    def con_jac(self, x):
+        return self.gradient(x)[:, 1]
+
 bnds = ((0.005,0.06),)*sn + ((0,50),)*sn
 
 init = (2.0000e-02, 2.0000e-02, 2.0000e-02, 2.0000e-02, 2.0000e-02,
@@ -109,7 +165,85 @@ init = (2.0000e-02, 2.0000e-02, 2.0000e-02, 2.0000e-02, 2.0000e-02,
 #(0.009,0.012,0.0117,0.00964,0.0065,0.006,73.204, 52.122, 38.006, 29.634, 23.030, 20.777)
 #(0.02, 0.02, 0.02, 0.02, 0.02, 0.02, 7.32040000e+01, 5.21220000e+01,3.80060000e+01, 2.96340000e+01, 2.30300000e+01, 2.07770000e+01)
 
-#res = shgo(fun,bounds=bnds,constraints=cons,options = {'disp': True} )
-res = minimize(fun, init, method='SLSQP', bounds=bnds,constraints=cons,options = {'ftol': 1e-9, 'disp': True})
-print(res.x,res.fun)
-#print(res.x)
+def optimize(x0, executor, options = None):
+    """
+    x0からSLSQPで局所最適化する
+    最適解の効率と推力はres.eff, res.thrustに入れる(最後に解析した結果を使うので、xrotorは再実行しない)
+    """
+    if options is None:
+        options = {'ftol': 1e-9, 'disp': True}
+    problem = Problem(bnds, executor, eps)
+    cons = ({'type': 'ineq', 'fun': problem.con, 'jac': problem.con_jac})
+    res = minimize(problem.fun, x0, method='SLSQP', jac=problem.jac, bounds=bnds,constraints=cons,options = options)
+    res.eff, res.thrust = problem.evaluate(res.x)
+    res.nfev_xrotor = problem.nfev
+    return res
+
+def sample(n, method="lhs", seed=None):
+    """
+    bndsの範囲から初期値をn個サンプリングする
+    method : "lhs"(ラテン超方格) or "sobol"
+    """
+    if method == "sobol":
+        sampler = qmc.Sobol(len(bnds), seed=seed)
+    else:
+        sampler = qmc.LatinHypercube(len(bnds), seed=seed)
+    low, up = np.array(bnds, dtype=float).T
+    return qmc.scale(sampler.random(n), low, up)
+
+def refine(x0):
+    """
+    multistartの1本分
+    ワーカプロセスの中で実行するので勾配の計算は並列化しない
+    # return
+        - (x, eff, t, success, nfev)
+    """
+    executor = make_executor("serial")
+    res = optimize(x0, executor, {'ftol': 1e-9, 'disp': False})
+    return res.x, res.eff, res.thrust, res.success, res.nfev_xrotor
+
+def unique(results, tol=1e-2):
+    """
+    同じ局所解に収束したものをまとめる
+    変数の範囲で正規化した距離がtol以下の解は同じとみなし、良い方を残す
+    resultsは良い順に並んでいること
+    """
+    low, up = np.array(bnds, dtype=float).T
+    kept = []
+    for r in results:
+        x = (r[0] - low) / (up - low)
+        if all(np.linalg.norm(x - (k[0] - low) / (up - low)) > tol for k in kept):
+            kept.append(r)
+    return kept
+
+def multistart(n, method="lhs", seed=None, tol=1e-2):
+    """
+    n個の初期値からのSLSQPをプロセスに分けて同時に実行し、
+    重複した局所解を除いて良い順に返す
+    推力の制約を満たすものを先に、その中で効率の高い順に並べる
+    """
+    executor = make_executor("process", workers)
+    try:
+        results = executor.map(refine, list(sample(n, method, seed)))
+    finally:
+        executor.shutdown()
+    results.sort(key=lambda r: (r[2] < T, -r[1]))
+    return unique(results, tol)
+
+if __name__ == "__main__":
+    #python sqp.py multistart [初期値の数] で多点スタート
+    if len(sys.argv) > 1 and sys.argv[1] == "multistart":
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+        results = multistart(n)
+        print("rank  efficiency  thrust[N]  feasible  nfev  x")
+        for k, (x, eff, t, success, nfev) in enumerate(results):
+            print("{0:<4}  {1:<10.5f}  {2:<9.4f}  {3:<8}  {4:<4}  {5}".format(k + 1, eff, t, str(t >= T), nfev, np.round(x, 4)))
+    else:
+        executor = make_executor(parallel, workers)
+        try:
+            #res = shgo(fun,bounds=bnds,constraints=cons,options = {'disp': True} )
+            res = optimize(init, executor)
+        finally:
+            executor.shutdown()
+        print(res.x,res.fun)
+        #print(res.x)
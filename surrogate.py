@@ -0,0 +1,95 @@
+import numpy as np
+import random
+from scipy.interpolate import RBFInterpolator
+
+class Surrogate(object):
+    """
+    評価済み個体の記録から評価値を予測する代理モデル(RBF補間)
+    子個体のうち有望なものだけを実際の解析に回すために使う。
+
+    遺伝子は下限、上限で0~1に正規化してから補間する。
+    記録が増えても計算量が増えすぎないよう、
+    予測点の近傍neighbors点だけで局所的に補間する。
+
+    # attributes
+        - low, up(float list)
+            遺伝子の下限、上限
+        - weights(tuple)
+            評価値の重み(deapのweightsと同じ、大きいほど良い方向)
+        - smoothing(float)
+            RBFの平滑化係数(0なら完全な補間)
+        - neighbors(int)
+            補間に使う近傍点数
+        - maxsize(int)
+            記録する個体数の上限(超えたら古いものから捨てる)
+    # method
+        - add(individuals, fitnesses)
+            評価済み個体を記録に追加する
+        - fit
+            記録からモデルを作り直す
+        - predict(individuals)
+            評価値を予測する (個体数, 評価値の数)
+        - screen(individuals, fraction, explore)
+            予測が良い順にfractionの割合と、残りから無作為にexploreの割合を選ぶ
+            ## return
+                - (selected, rejected)
+    """
+    def __init__(self, low, up, weights, smoothing=1e-6, neighbors=50, maxsize=5000, kernel="linear"):
+        self.low = np.asarray(low, dtype=float)
+        self.up = np.asarray(up, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.smoothing = smoothing
+        self.neighbors = neighbors
+        self.maxsize = maxsize
+        self.kernel = kernel
+        self.__x = np.empty((0, len(self.low)))
+        self.__y = np.empty((0, len(self.weights)))
+        self.__model = None
+
+    def __len__(self):
+        return len(self.__x)
+
+    def __normalize(self, individuals):
+        return (np.asarray(individuals, dtype=float) - self.low) / (self.up - self.low)
+
+    def add(self, individuals, fitnesses):
+        if len(individuals) == 0:
+            return
+        x = self.__normalize(individuals)
+        y = np.asarray(fitnesses, dtype=float).reshape(len(x), -1)
+        self.__x = np.vstack([self.__x, x])[-self.maxsize:]
+        self.__y = np.vstack([self.__y, y])[-self.maxsize:]
+        self.__model = None
+
+    def fit(self):
+        #同じ点が重複していると補間行列が特異になるので除く
+        x, idx = np.unique(self.__x, axis=0, return_index=True)
+        y = self.__y[idx]
+        neighbors = self.neighbors if self.neighbors < len(x) else None
+        self.__model = RBFInterpolator(x, y, kernel=self.kernel, smoothing=self.smoothing,
+                                       neighbors=neighbors, degree=0)
+
+    def predict(self, individuals):
+        if self.__model is None:
+            self.fit()
+        return self.__model(self.__normalize(individuals))
+
+    def screen(self, individuals, fraction, explore=0.0):
+        if len(individuals) == 0:
+            return [], []
+        try:
+            pred = self.predict(individuals)
+        #近傍点が退化してモデルが作れないときは選別しない
+        except np.linalg.LinAlgError:
+            return list(individuals), []
+        #重み付きの和が大きいほど良い
+        score = pred @ self.weights
+        order = list(np.argsort(-score))
+        n = int(np.ceil(len(individuals) * fraction))
+        chosen = order[:n]
+        rest = order[n:]
+        chosen += random.sample(rest, min(len(rest), int(round(len(individuals) * explore))))
+        chosen = set(chosen)
+        selected = [ind for i, ind in enumerate(individuals) if i in chosen]
+        rejected = [ind for i, ind in enumerate(individuals) if i not in chosen]
+        return selected, rejected
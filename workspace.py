@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+import metrics
+
+#RAM上に置かれる一時ディレクトリの候補
+RAM_DIRS = ["/dev/shm", "/run/shm"]
+
+class Workspace(object):
+    """
+    評価ごとに衝突しない作業ディレクトリを払い出すクラス
+    プロセスidで名前を付けていた一時ファイルは、
+    multiprocessing.dummyのスレッド同士で同じ名前になり上書きし合う。
+    このクラスは評価1回ごとに一意なディレクトリを作り、使い終わったら中身ごと消す。
+    既定ではRAM上のディレクトリ(/dev/shmなど)を使い、なければOSの一時ディレクトリを使う。
+
+    # attributes
+        - base(str)
+            作業ディレクトリを作る場所
+        - root(str)
+            このプロセス用のディレクトリ(最初の使用時に作成、終了時に削除)
+            プロセスプールのワーカはatexitを呼ばずにos._exitで終わるので、
+            削除はmultiprocessingの終了処理(Finalize)に登録する
+            fork後の子プロセスは親のディレクトリの中に作るので、子が後始末できずに終わっても親の終了時に消える
+    # method
+        - scratch
+            with文で使う
+            評価1回分のディレクトリのパスを返し、抜けるときに削除する
+            例
+                with workspace.scratch() as ws:
+                    rotorf = os.path.join(ws, "rotor")
+        - cleanup
+            rootごと削除する
+    """
+    def __init__(self, base=None, prefix="optprop"):
+        self.base = base if base is not None else default_base()
+        self.prefix = prefix
+        self.__root = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    @property
+    def root(self):
+        with self.__lock:
+            #fork後の子プロセスは親とは別のディレクトリを使う
+            if self.__root is None or self.__pid != os.getpid():
+                parent = self.__root if self.__root is not None and os.path.isdir(self.__root) else self.base
+                self.__root = tempfile.mkdtemp(prefix="{0}-{1}-".format(self.prefix, os.getpid()), dir=parent)
+                self.__pid = os.getpid()
+                #登録したプロセスでだけ実行される(forkした子では親の分は呼ばれない)
+                Finalize(None, shutil.rmtree, args=(self.__root, True), exitpriority=0)
+            return self.__root
+
+    @contextmanager
+    def scratch(self):
+        with metrics.phase("mkdir"):
+            path = tempfile.mkdtemp(dir=self.root)
+        try:
+            yield path
+        finally:
+            with metrics.phase("cleanup"):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def cleanup(self):
+        with self.__lock:
+            if self.__root is not None and self.__pid == os.getpid():
+                shutil.rmtree(self.__root, ignore_errors=True)
+            self.__root = None
+
+def default_base():
+    """
+    書き込めるRAM上のディレクトリ、なければOSの一時ディレクトリを返す
+    環境変数OPTPROP_SCRATCHで上書きできる
+    """
+    env = os.environ.get("OPTPROP_SCRATCH")
+    if env:
+        return env
+    for d in RAM_DIRS:
+        if os.path.isdir(d) and os.access(d, os.W_OK):
+            return d
+    return tempfile.gettempdir()
+
+#main.py, main_mp.py, sqp.pyで共有する既定の作業領域
+workspace = Workspace()
+
+def scratch():
+    return workspace.scratch()
@@ -1,6 +1,116 @@
 import numpy as np
 import subprocess
 import os
+import threading
+import queue
+import atexit
+import time
+import asyncio
+import weakref
+import shlex
+from collections import deque
+from workspace import scratch
+import metrics
+
+#cputで出力される解析結果の列
+#main.pyが参照しているのはT(10列目)とEfficiency(最終列)
+CPUT_COLUMNS = ("J", "V", "rpm", "Dbeta", "rho", "mu", "VSound",
+                "Ct", "Cp", "P", "T", "Q", "Efficiency")
+CPUT_DTYPE = np.dtype([(name, "<f8") for name in CPUT_COLUMNS])
+
+#セッションを使うかどうか(open_sessionsで切り替える)
+_session_enabled = False
+#スレッドごとのセッション
+_local = threading.local()
+#生成済みセッション(close_sessionsで一括終了する)
+_sessions = []
+_sessions_lock = threading.Lock()
+
+class AdaptiveTimeout(object):
+    """
+    解析の所要時間の分布からxrotorのタイムアウトを決めるクラス
+    正常に終わった直近window回の所要時間のquantile(既定ではp99)をmultiple倍し、
+    floorとceilingの範囲に収めた値をタイムアウトにする。
+    記録がmin_samples回に満たない間とenabled=Falseのときはceilingを使う。
+    発散した設計で毎回ceilingまで待たされるのを避けるためのもの。
+
+    Xrotor.call(AsyncXrotor.call、XrotorBatch.run)でtimeoutを省略すると
+    モジュールのadaptive_timeoutが使われる。プロセスごとに1つ。
+
+    # attributes
+        - quantile(float)
+        - multiple(float)
+        - floor, ceiling(float)
+            タイムアウトの下限、上限[s]
+        - window(int)
+            分布に使う直近の記録数
+        - min_samples(int)
+        - enabled(bool)
+        - runs, timeouts(int)
+            解析回数、そのうちタイムアウトした回数
+    # method
+        - timeout
+            現在のタイムアウト[s]
+        - record(elapsed, ok)
+            解析1回分の所要時間と正常に終わったかどうかを記録する
+        - counters(reset)
+            解析回数、タイムアウト回数、現在のタイムアウトの辞書を返す
+    """
+    def __init__(self, quantile=0.99, multiple=3.0, floor=0.5, ceiling=7.0, window=500, min_samples=30):
+        self.quantile = quantile
+        self.multiple = multiple
+        self.floor = floor
+        self.ceiling = ceiling
+        self.window = window
+        self.min_samples = min_samples
+        self.enabled = True
+        self.runs = 0
+        self.timeouts = 0
+        self.__samples = deque(maxlen=window)
+        self.__value = None
+        self.__lock = threading.Lock()
+
+    def timeout(self):
+        with self.__lock:
+            if not self.enabled or len(self.__samples) < self.min_samples:
+                return self.ceiling
+            #記録が増えたときだけ計算し直す
+            if self.__value is None:
+                value = np.quantile(self.__samples, self.quantile) * self.multiple
+                self.__value = float(np.clip(value, self.floor, self.ceiling))
+            return self.__value
+
+    def record(self, elapsed, ok):
+        with self.__lock:
+            self.runs += 1
+            if ok:
+                self.__samples.append(elapsed)
+                self.__value = None
+            else:
+                self.timeouts += 1
+
+    def counters(self, reset=False):
+        value = self.timeout()
+        with self.__lock:
+            res = {"runs": self.runs, "timeouts": self.timeouts, "timeout": value}
+            if reset:
+                self.runs = 0
+                self.timeouts = 0
+        return res
+
+#プロセス内で共有するタイムアウトの制御
+adaptive_timeout = AdaptiveTimeout()
+
+def split_command(value):
+    """
+    コマンドの文字列を引数のリストに分ける
+    Windowsではパスの\\をそのまま残し(C:\\xrotor\\xrotor.exeのまま)、"で囲んだ部分を1つの引数にする
+    それ以外ではシェルと同じ規則で分ける
+    """
+    if os.name != "nt":
+        return shlex.split(value)
+    #posix=Falseでは囲んだ引用符が残るので外す
+    return [a[1:-1] if len(a) > 1 and a[0] == a[-1] == '"' else a for a in shlex.split(value, posix=False)]
 
 class Xrotor(object):
     """
@@ -34,11 +144,17 @@ class Xrotor(object):
         設計進行速度
     - dens
         大気密度
+    - exe(list)
+        xrotorの実行コマンド
+        環境変数XROTOR_EXEがあればそれを使う(擬似xrotorのfakexrotor.pyに差し替えるときなど)
+        分け方はsplit_commandを参照
     """
+    exe = split_command(os.environ.get("XROTOR_EXE", "xrotor.exe"))
     #oper\nn\n100\n\n
     def __init__(self, nb, fs):
         self.__n = 30
         self.__command = "plop\ng\n\n"
+        self.__aerof = None
         self.__velo = 1.0
         self.__rpm = 160
         self.__nb = nb
@@ -82,15 +198,31 @@ class Xrotor(object):
         self.__dens = value
         self.__command += "dens\n{dens}\n".format(dens = self.__dens)
 
-    def call(self,timeout=7):
+    @property
+    def aerof(self):
+        return self.__aerof
+
+    def call(self,timeout=None):
+        #timeoutを省略するとadaptive_timeoutで決め、所要時間を記録する
+        if timeout is None:
+            start = time.monotonic()
+            res = self.call(adaptive_timeout.timeout())
+            adaptive_timeout.record(time.monotonic() - start, res is not None)
+            return res
+        #open_sessions()済みなら常駐プロセスに流す
+        if _session_enabled:
+            with metrics.phase("solve"):
+                return current_session().run(self.__command, aerof=self.__aerof, timeout=timeout)
         #---xfoilの呼び出し---
-        ps = subprocess.Popen(['xrotor.exe'],
-                              stdin=subprocess.PIPE,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT)
+        with metrics.phase("spawn"):
+            ps = subprocess.Popen(self.exe,
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
         try:
-            self.__command += "quit\n"
-            res = ps.communicate(bytes(self.__command,"ascii"), timeout=timeout)
+            self.quit()
+            with metrics.phase("solve"):
+                res = ps.communicate(bytes(self.__command,"ascii"), timeout=timeout)
         #発散などによってxfoilが無限ループに陥った際の対応
         #タイムアウトによって実現している
         except subprocess.TimeoutExpired:
@@ -124,6 +256,7 @@ class Xrotor(object):
             fname = fname,
         )
         self.__command += pipe
+        self.__aerof = fname
         return pipe
 
     def impo(self, fname):
@@ -179,16 +312,463 @@ class Xrotor(object):
         )
         self.__command += pipe
 
-    def cput(self,fname):
+    def cput(self,fname=None):
         """
         output analysys data as file
+        fnameを省略すると標準出力に書き出す(parse_cputで読む)
         """
         pipe = "oper\ncput\n{fname}\n\n"\
         .format(
-            fname = fname
+            fname = fname if fname is not None else ""
         )
         self.__command += pipe
 
+    def clrc(self):
+        """
+        operで蓄積した解析ケースを消去する
+        """
+        pipe = "oper\nclrc\n\n"
+        self.__command += pipe
+        return pipe
+
+    def quit(self):
+        pipe = "quit\n"
+        self.__command += pipe
+        return pipe
+
+class XrotorBatch(object):
+    """
+    複数のロータ形状を1回のxrotor起動でまとめて解析するクラス
+    aeroの読み込みは1回だけ行い、設計ごとに
+    clrc/impo/oper/cputのブロックを並べたコマンドを流す。
+    結果は設計ごとに別のcputファイルに書き出して読み分ける。
+
+    タイムアウトは設計ごとに決める。結果ファイルが出るたびに期限を延ばし、
+    次の結果が1設計分のタイムアウト内に出なければプロセスを止める。
+    止めた場合やxrotorが途中で落ちた場合は、結果ファイルが出ていない最初の設計を
+    その原因として("timeout"または"failed")除外し、残りの設計だけで再度起動する。
+    そのため発散した設計以外の結果は失われず、1設計の無限ループで失う時間もタイムアウト1回分になる。
+    結果ファイルを監視するので、常駐セッション(open_sessions)は使わず専用のプロセスで起動する。
+
+    # attributes
+        - nb(int)
+            ブレード枚数
+        - fs(float)
+            設計進行速度
+        - aerof(str)
+            aeroファイルパス
+        - velo(float)
+            流入速度
+        - rpms(float list)
+            解析するrpm(cputの行に対応)
+        - n(int)
+            半径方向の解析点数(Noneならxrotorの既定値)
+    # method
+        - run(models, timeout)
+            ## argument
+                - models(RotorModel list)
+                - timeout(float)
+                    1設計あたりのタイムアウト[s](Noneならadaptive_timeoutで決める)
+            ## return
+                - results(list)
+                    設計ごとのcputの表(parse_cputの戻り値)
+                    失敗した設計はNone
+            直前のrunの設計ごとの結果の種類("ok", "timeout", "failed")はstatusに残る
+    """
+    def __init__(self, nb, fs, aerof, velo, rpms, n=None):
+        self.nb = nb
+        self.fs = fs
+        self.aerof = aerof
+        self.velo = velo
+        self.rpms = list(rpms)
+        self.n = n
+
+    def script(self, rotorfs, resultfs):
+        xr = Xrotor(self.nb, self.fs)
+        xr.aero(self.aerof)
+        xr.velo = self.velo
+        for rotorf, resultf in zip(rotorfs, resultfs):
+            xr.clrc()
+            xr.impo(rotorf)
+            if self.n is not None:
+                xr.n = self.n
+            for rpm in self.rpms:
+                xr.rpm = rpm
+                xr.oper()
+            xr.cput(resultf)
+        return xr
+
+    def run(self, models, timeout=None):
+        results = [None] * len(models)
+        self.status = ["failed"] * len(models)
+        adaptive = timeout is None
+        with scratch() as ws:
+            rotorfs = [os.path.join(ws, "rotor{0}".format(i)) for i in range(len(models))]
+            resultfs = [os.path.join(ws, "res{0}".format(i)) for i in range(len(models))]
+            with metrics.phase("write"):
+                for model, rotorf in zip(models, rotorfs):
+                    model.writefile(rotorf)
+            todo = list(range(len(models)))
+            while todo:
+                xr = self.script([rotorfs[i] for i in todo], [resultfs[i] for i in todo])
+                per = adaptive_timeout.timeout() if adaptive else timeout
+                killed, durations = self.watch(xr, [resultfs[i] for i in todo], per)
+                if adaptive:
+                    for d in durations:
+                        adaptive_timeout.record(d, True)
+                done = [i for i in todo if os.path.exists(resultfs[i])]
+                for i in done:
+                    try:
+                        with metrics.phase("parse"):
+                            results[i] = read_cput(resultfs[i], len(self.rpms))
+                        self.status[i] = "ok"
+                    except CputError as e:
+                        print(e)
+                rest = [i for i in todo if i not in done]
+                if not rest:
+                    break
+                #結果が出ていない最初の設計で止まった(落ちた)とみなして除外し、続きから再実行
+                if killed:
+                    self.status[rest[0]] = "timeout"
+                    if adaptive:
+                        adaptive_timeout.record(per, False)
+                todo = rest[1:]
+        return results
+
+    def watch(self, xr, resultfs, per, interval=0.01):
+        """
+        xrの解析を専用のプロセスで実行し、結果ファイルが順に出るのを監視する
+        直前の結果(最初は起動)からper秒以内に次の結果が出なければプロセスを止める
+        # return
+            - (killed, durations)
+                止めたかどうかと、結果が出た設計ごとの所要時間[s]のリスト
+        """
+        xr.quit()
+        with metrics.phase("spawn"):
+            ps = subprocess.Popen(Xrotor.exe, stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        def feed():
+            #無限ループで読まれなくなっても止まらないよう別スレッドで書き込む
+            try:
+                ps.stdin.write(bytes(xr.command, "ascii"))
+                ps.stdin.close()
+            except OSError:
+                pass
+        writer = threading.Thread(target=feed)
+        writer.daemon = True
+        writer.start()
+        durations = []
+        killed = False
+        with metrics.phase("solve"):
+            last = time.monotonic()
+            while len(durations) < len(resultfs):
+                ended = ps.poll() is not None
+                now = time.monotonic()
+                if os.path.exists(resultfs[len(durations)]):
+                    durations.append(now - last)
+                    last = now
+                    continue
+                if ended:
+                    break
+                if now - last > per:
+                    ps.kill()
+                    killed = True
+                    break
+                time.sleep(interval)
+            ps.wait()
+        writer.join()
+        return killed, durations
+
+class CputError(Exception):
+    """
+    cputの出力が読めないときの例外
+    発散やタイムアウトで出力が途中で切れた場合や、表が出力されなかった場合
+    """
+    pass
+
+def parse_cput(data, ncase=None):
+    """
+    xrotorのcputが出力する解析結果の表を読む
+    ファイルを経由せず、Xrotor.callが返す標準出力のbytesや
+    io.BytesIOなどのメモリ上のバッファからも読める。
+    数値がCPUT_COLUMNSの数だけ並ぶ行を表の行とみなし、それ以外の行(見出しやプロンプト)は読み飛ばす。
+
+    # argument
+        - data(bytes, str or file like)
+        - ncase(int)
+            期待するケース数(行数)
+            指定すると行数が違う場合にCputErrorとする
+    # return
+        - result(ndarray)
+            dtype=CPUT_DTYPEの構造化配列
+            result["T"][0]が1ケース目の推力、result["Efficiency"][0]が効率
+    """
+    if hasattr(data, "read"):
+        data = data.read()
+    if isinstance(data, bytes):
+        data = data.decode("ascii", "replace")
+    ncol = len(CPUT_COLUMNS)
+    rows = []
+    for line in data.splitlines():
+        tokens = line.split()
+        values = []
+        for token in tokens:
+            try:
+                values.append(float(token))
+            except ValueError:
+                values.append(None)
+        numeric = [v for v in values if v is not None]
+        if len(tokens) == ncol and len(numeric) == ncol:
+            rows.append(tuple(numeric))
+        #列数は合っているが"******"などで読めない値がある
+        elif len(tokens) == ncol and numeric:
+            raise CputError("malformed cput row: " + line.strip())
+        #表の途中で行が切れている
+        elif rows and tokens and len(numeric) == len(tokens):
+            raise CputError("truncated cput row: " + line.strip())
+    if not rows:
+        raise CputError("no cput table in output")
+    if ncase is not None and len(rows) != ncase:
+        raise CputError("expected {0} cases in cput output, got {1}".format(ncase, len(rows)))
+    result = np.array(rows, dtype=CPUT_DTYPE)
+    if not all(np.isfinite(result[name]).all() for name in CPUT_COLUMNS):
+        raise CputError("non-finite value in cput output")
+    return result
+
+def read_cput(fname, ncase=None):
+    """
+    cputで書き出したファイルを読み込む
+    読めない場合はCputError(ファイルがない場合も含む)
+    # return
+        - result(ndarray)
+            parse_cputと同じ
+    """
+    try:
+        with open(fname, mode='rb') as f:
+            data = f.read()
+    except OSError as e:
+        raise CputError("cput output was not written: {0}".format(e))
+    return parse_cput(data, ncase)
+
+class AsyncXrotor(Xrotor):
+    """
+    Xrotorのasyncio版
+    コマンドの組み立てはXrotorと同じで、callがコルーチンになる。
+    xrotor.exeをasyncio.create_subprocess_execで起動するので、
+    解析中にスレッドを占有せず、1つのプロセスから多数の解析を同時に走らせられる。
+    同時に起動するxrotorの数はイベントループごとのセマフォでlimitに制限する。
+    タイムアウトしたときやタスクがキャンセルされたときはxrotorをkillする。
+
+    # attributes
+        - limit(int)
+            同時に起動するxrotorの最大数(Noneなら論理コア数)
+    # method
+        - call(timeout)
+            await xr.call(timeout=7)のように使う
+            timeoutを省略したときの扱いと戻り値はXrotor.callと同じ
+    """
+    limit = None
+    __sems = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def semaphore(cls):
+        loop = asyncio.get_running_loop()
+        sem = cls.__sems.get(loop)
+        if sem is None:
+            sem = asyncio.Semaphore(cls.limit or os.cpu_count())
+            cls.__sems[loop] = sem
+        return sem
+
+    async def call(self,timeout=None):
+        self.quit()
+        adaptive = timeout is None
+        async with self.semaphore():
+            #起動待ちの時間は含めずに計る
+            if adaptive:
+                timeout = adaptive_timeout.timeout()
+            start = time.monotonic()
+            with metrics.phase("spawn"):
+                ps = await asyncio.create_subprocess_exec(*self.exe,
+                                                          stdin=subprocess.PIPE,
+                                                          stdout=subprocess.PIPE,
+                                                          stderr=subprocess.STDOUT)
+            try:
+                with metrics.phase("solve"):
+                    res = await asyncio.wait_for(ps.communicate(bytes(self.command,"ascii")), timeout=timeout)
+            #発散などによる無限ループはタイムアウトで打ち切る
+            except asyncio.TimeoutError:
+                res = None
+                ps.kill()
+                await ps.wait()
+            except asyncio.CancelledError:
+                ps.kill()
+                raise
+            if adaptive:
+                adaptive_timeout.record(time.monotonic() - start, res is not None)
+        return res
+
+class XrotorSession(object):
+    """
+    xrotor.exeを常駐させ、同じ標準入力に設計ごとのコマンドを流し続けるクラス
+    Xrotor.callのように1設計ごとにプロセスを起動しないため、
+    起動とaeroファイル読み込みのコストは最初の1回だけになる。
+
+    各設計のコマンドの後ろに4文字の番兵コマンドを送り、
+    xrotorが返す"command not recognized"の行に番兵が現れたところを
+    その設計の出力の終わりとみなす。
+    タイムアウトまたはプロセスの異常終了時のみプロセスを再起動する。
+
+    # attributes
+        - exe(list)
+            xrotorの実行コマンド
+        - aerof(str)
+            現在プロセスに読み込まれているaeroファイル名
+            同じファイルなら再読み込みを省略する
+        - restarts(int)
+            プロセスを(再)起動した回数
+    # method
+        - run(command, aerof, timeout)
+            Xrotorが組み立てたコマンドを1設計分実行する
+            ## return
+                - (bytes, None) or None
+                    Xrotor.callと同じ形式
+                    タイムアウト時はNone
+                    プロセスが落ちたときは、単発のプロセスが落ちたときと同じくそこまでの出力を返す
+                    (表が揃わないのでcputの読み込みで失敗になり、タイムアウトとは区別される)
+        - close
+            プロセスを終了する
+    """
+    PLOP = "plop\ng\n\n"
+    CLEAR = "oper\nclrc\n\n"
+    def __init__(self, exe=None):
+        self.exe = exe if exe is not None else Xrotor.exe
+        self.aerof = None
+        self.restarts = 0
+        self.__ps = None
+        self.__out = None
+        self.__count = 0
+
+    @property
+    def alive(self):
+        return self.__ps is not None and self.__ps.poll() is None
+
+    def start(self):
+        self.close()
+        self.__ps = subprocess.Popen(self.exe,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        self.__out = queue.Queue()
+        #Windowsのパイプはselectできないので読み出し専用スレッドを立てる
+        reader = threading.Thread(target=self.__read, args=(self.__ps.stdout, self.__out))
+        reader.daemon = True
+        reader.start()
+        self.aerof = None
+        self.restarts += 1
+        #グラフィック無効化はトグルなので起動時に1回だけ送る
+        self.__write(self.PLOP)
+
+    @staticmethod
+    def __read(stdout, out):
+        while True:
+            chunk = stdout.read1(4096)
+            if not chunk:
+                out.put(None)
+                break
+            out.put(chunk)
+
+    def __write(self, command):
+        self.__ps.stdin.write(bytes(command, "ascii"))
+        self.__ps.stdin.flush()
+
+    def run(self, command, aerof=None, timeout=7):
+        if not self.alive:
+            self.start()
+        #起動時に送ったplopと読み込み済みのaeroは省略する
+        if command.startswith(self.PLOP):
+            command = command[len(self.PLOP):]
+        if aerof is not None and aerof == self.aerof:
+            command = command.replace("aero\nread\n{fname}\n\n".format(fname = aerof), "", 1)
+        #前の設計のケースが残らないようにクリア
+        self.__count = (self.__count + 1) % 1000
+        marker = "@{0:03d}".format(self.__count)
+        try:
+            self.__write(self.CLEAR + command + marker + "\n")
+        except (BrokenPipeError, OSError):
+            self.close()
+            return (b"", None)
+
+        buf = b""
+        token = bytes(marker, "ascii")
+        deadline = time.monotonic() + timeout
+        while True:
+            remain = deadline - time.monotonic()
+            try:
+                if remain <= 0:
+                    raise queue.Empty
+                chunk = self.__out.get(timeout=remain)
+            #発散などによる無限ループはタイムアウトで打ち切って再起動
+            except queue.Empty:
+                self.close()
+                return None
+            #プロセスが落ちた
+            if chunk is None:
+                self.close()
+                return (buf, None)
+            buf += chunk
+            end = buf.find(token)
+            if end >= 0 and buf.find(b"\n", end) >= 0:
+                break
+        self.aerof = aerof
+        return (buf[:buf.find(b"\n", end) + 1], None)
+
+    def close(self):
+        if self.__ps is None:
+            return
+        try:
+            if self.__ps.poll() is None:
+                self.__ps.stdin.write(b"quit\n")
+                self.__ps.stdin.close()
+                self.__ps.wait(timeout=1)
+        except Exception:
+            pass
+        if self.__ps.poll() is None:
+            self.__ps.kill()
+        self.__ps = None
+        self.aerof = None
+
+def current_session():
+    """
+    呼び出し元スレッド(プロセス)専用のXrotorSessionを返す
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = XrotorSession()
+        _local.session = session
+        with _sessions_lock:
+            _sessions.append(session)
+    return session
+
+def open_sessions():
+    """
+    以降のXrotor.callを常駐セッション経由にする
+    評価関数側の変更は不要
+    """
+    global _session_enabled
+    _session_enabled = True
+
+def close_sessions():
+    """
+    セッション経由の実行をやめ、常駐プロセスをすべて終了する
+    """
+    global _session_enabled
+    _session_enabled = False
+    with _sessions_lock:
+        for session in _sessions:
+            session.close()
+
+atexit.register(close_sessions)
+
 if __name__ == "__main__":
     import numpy as np
     xr = Xrotor(2, 1.0)